@@ -0,0 +1,1085 @@
+"""Benchmarks, run from the project root: python -m misc.benchmark [name ...]
+"""
+import asyncio
+import sys
+import time
+import aiohttp
+import numpy as np
+from okex import consts as c, utils
+from okex.public import PublicAPI
+from src.utils import depth_size, float_str, round_to, Precision
+from src.websocket import subscribe_without_login, to_quote
+
+
+def percentiles(samples, unit=1000, label='ms'):
+    """p50/p99 of `samples` in seconds
+    """
+    p50, p99 = np.percentile(np.asarray(samples) * unit, [50, 99])
+    return f'p50 {p50:8.2f} {label}, p99 {p99:8.2f} {label}'
+
+
+async def transport(n=50):
+    """REST latency with a cold connection per request vs. a warm keep-alive pool
+    """
+    cold = []
+    for _ in range(n):
+        begin = time.perf_counter()
+        connector = aiohttp.TCPConnector(force_close=True, use_dns_cache=False)
+        async with aiohttp.ClientSession(base_url=c.API_URL, connector=connector) as session:
+            async with session.get(c.SERVER_TIMESTAMP_URL) as response:
+                await response.read()
+        cold.append(time.perf_counter() - begin)
+
+    publicAPI = PublicAPI()
+    await publicAPI.warm_up()
+    warm = []
+    for _ in range(n):
+        begin = time.perf_counter()
+        async with publicAPI.client.get(c.SERVER_TIMESTAMP_URL) as response:
+            await response.read()
+        warm.append(time.perf_counter() - begin)
+    await publicAPI.aclose()
+    print(f'cold pool  {percentiles(cold)}')
+    print(f'warm pool  {percentiles(warm)}')
+
+
+def signing(n=100000, repeat=5):
+    """Signed headers per second, rebuilding everything per request vs. a prepared signer. Best of `repeat` runs,
+    single runs vary by tens of percent
+    """
+    api_key, secret_key, passphrase = 'api_key', 'secret_key', 'passphrase'
+    request_path = '/api/v5/trade/order'
+    body = '{"instId": "BTC-USDT", "tdMode": "cash", "side": "buy", "ordType": "fok", "sz": "0.01", "px": "20000"}'
+    signer = utils.Signer(api_key, secret_key, passphrase)
+
+    def per_request():
+        timestamp = utils.get_timestamp()
+        sign = utils.sign(utils.pre_hash(timestamp, c.POST, request_path, body), secret_key)
+        utils.get_header(api_key, sign.decode('utf8'), timestamp, passphrase)
+
+    def prepared():
+        signer.header(c.POST, request_path, body)
+
+    def rate(function):
+        best = float('inf')
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            for _ in range(n):
+                function()
+            best = min(best, time.perf_counter() - begin)
+        return n / best
+
+    before, after = rate(per_request), rate(prepared)
+    print(f'per request  {before:10.0f} headers/s')
+    print(f'Signer       {after:10.0f} headers/s ({after / before:.2f}x)')
+
+
+async def faults(failures=3):
+    """Offline fault injection into Client._request through a stubbed session: retries of an idempotent request,
+    an order whose response is lost after it reached the exchange, and a circuit breaker opening and half-opening.
+    Prints attempts and elapsed time of each path and asserts the outcome
+    """
+    import json
+    from urllib.parse import parse_qs
+    from okex.client import Client, CircuitBreaker
+    from okex.exceptions import OkexCircuitOpenException
+    from okex.trade import TradeAPI
+
+    class Response:
+        def __init__(self, status, res):
+            self.status = status
+            self.res = res
+
+        async def __aenter__(self):
+            if isinstance(self.res, Exception):
+                raise self.res
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        async def text(self):
+            return json.dumps(self.res)
+
+    class Session:
+        """Answers requests with handler(method, path, body) -> (status, json) or an exception"""
+        closed = False
+
+        def __init__(self, handler):
+            self.handler = handler
+            self.calls = []
+
+        def request(self, method, path, data=None, headers=None):
+            self.calls.append((method, path))
+            res = self.handler(method, path, data)
+            return Response(*res) if isinstance(res, tuple) else Response(0, res)
+
+    base, cap = c.BACKOFF_BASE, c.BACKOFF_CAP
+    c.BACKOFF_BASE, c.BACKOFF_CAP = 0.001, 0.01
+    sessions = dict(Client.sessions)
+    tradeAPI = TradeAPI('api_key', 'secret_key', 'passphrase')
+    try:
+        # Idempotent GET: dropped connections are retried
+        def flaky(method, path, body):
+            if len(session.calls) <= failures:
+                return aiohttp.ServerDisconnectedError()
+            return 200, dict(code='0', data=[dict(ts='0')])
+
+        Client.sessions[tradeAPI.pool] = session = Session(flaky)
+        begin = time.perf_counter()
+        res = await tradeAPI._request_without_params(c.GET, c.SERVER_TIMESTAMP_URL)
+        assert res['code'] == '0' and len(session.calls) == failures + 1
+        print(f'retry     GET succeeded after {failures} dropped connections, {len(session.calls)} attempts, '
+              f'{(time.perf_counter() - begin) * 1000:.1f} ms')
+
+        # Order reaches the exchange but the response is lost: no resend, found by clOrdId
+        orders = dict()
+
+        def lost_response(method, path, body):
+            if method == c.POST:
+                params = json.loads(body)
+                orders[params['clOrdId']] = params
+                return aiohttp.ServerDisconnectedError()
+            query = parse_qs(path[path.find('?') + 1:])
+            data = [dict(ordId='1', clOrdId=n, sCode='0', sMsg='') for n in query['clOrdId'] if n in orders]
+            return 200, dict(code='0', data=data)
+
+        Client.sessions[tradeAPI.pool] = session = Session(lost_response)
+        order = await tradeAPI.take_spot_order('BTC-USDT', 'buy', 'fok', '0.01', '20000')
+        posts = [n for n in session.calls if n[0] == c.POST]
+        assert len(posts) == 1 and len(orders) == 1 and order['clOrdId'] in orders, (session.calls, order)
+        print(f'order     response lost: {len(posts)} POST, found by clOrdId lookup, ordId {order["ordId"]}')
+
+        # Breaker: opens after BREAKER_THRESHOLD failures, fails fast, lets one trial through after the cooldown
+        healthy = False
+
+        def outage(method, path, body):
+            return (200, dict(code='0', data=[])) if healthy else (503, dict(code='1'))
+
+        Client.sessions[tradeAPI.pool] = session = Session(outage)
+        path = '/api/v5/market/index-tickers'
+        breaker = CircuitBreaker.of(c.GET, path)
+        try:
+            await tradeAPI._request_without_params(c.GET, path)
+            raise AssertionError('breaker did not open')
+        except OkexCircuitOpenException:
+            pass
+        opened = len(session.calls)
+        assert breaker.state == CircuitBreaker.OPEN and opened == c.BREAKER_THRESHOLD
+        try:
+            await tradeAPI._request_without_params(c.GET, path)
+            raise AssertionError('breaker did not fail fast')
+        except OkexCircuitOpenException:
+            assert len(session.calls) == opened
+        assert CircuitBreaker.of(c.POST, path).state == CircuitBreaker.CLOSED
+        # Failed trial opens it again at once
+        breaker.opened_at -= breaker.cooldown
+        try:
+            await tradeAPI._request_without_params(c.GET, path)
+        except OkexCircuitOpenException:
+            pass
+        assert breaker.state == CircuitBreaker.OPEN and len(session.calls) == opened + 1
+        # Successful trial closes it
+        breaker.opened_at -= breaker.cooldown
+        healthy = True
+        await tradeAPI._request_without_params(c.GET, path)
+        assert breaker.state == CircuitBreaker.CLOSED and len(session.calls) == opened + 2
+        print(f'breaker   open after {opened} failures, failed fast, failed trial reopened, successful trial closed')
+    finally:
+        c.BACKOFF_BASE, c.BACKOFF_CAP = base, cap
+        Client.sessions.clear()
+        Client.sessions.update(sessions)
+        CircuitBreaker.breakers.clear()
+
+
+def sizing(target=50000., price_diff=0.002, fee=0.0013, contract_val=10., seed=0):
+    """Cycles to build a `target` USDT position on synthetic thin books, top-of-book vs. depth sizing
+    """
+    rng = np.random.default_rng(seed)
+    tick = 1e-4
+
+    def books():
+        """Five levels a side around mid 1.0 with a random premium and thin, growing sizes
+        """
+        premium = rng.normal(0.004, 0.002)
+        spot_asks = [[f'{1 + (i + 1) * tick:.4f}', f'{rng.exponential(300) * (i + 1):.0f}'] for i in range(5)]
+        swap_bids = [[f'{(1 + premium) - i * tick:.4f}', f'{rng.exponential(30) * (i + 1):.0f}'] for i in range(5)]
+        return spot_asks, swap_bids
+
+    def top(spot_asks, swap_bids, remaining):
+        ask, bid = float(spot_asks[0][0]), float(swap_bids[0][0])
+        if bid < ask * (1 + price_diff + fee):
+            return 0.
+        return min(remaining, float(spot_asks[0][1]), float(swap_bids[0][1]) * contract_val)
+
+    def depth(spot_asks, swap_bids, remaining):
+        return depth_size(spot_asks, swap_bids, remaining, price_diff, fee, contract_val)[0]
+
+    for name, size in dict(top=top, depth=depth).items():
+        remaining, chunks, ticks = target, [], 0
+        while remaining > contract_val:
+            ticks += 1
+            chunk = size(*books(), remaining) // contract_val * contract_val
+            if chunk:
+                chunks.append(chunk)
+                remaining -= chunk
+        print(f'{name:6s} {len(chunks):6d} cycles, {np.mean(chunks):9.1f} avg chunk, {ticks:6d} ticks')
+
+
+async def resubscribe(n=20, rtt=0.05, interval=0.01):
+    """Gap between a fill and the next fresh quote, reconnecting after each fill vs. a persistent stream
+
+    A local server pushes books5 every `interval` seconds and delays each handshake by two round trips of `rtt`
+    seconds, roughly TLS plus the WebSocket upgrade.
+    """
+    import json
+    import websockets
+
+    async def handler(ws, *args):
+        await asyncio.sleep(2 * rtt)
+        await ws.recv()
+        await ws.send(json.dumps(dict(event='subscribe', arg=dict(channel='books5', instId='BTC-USDT'))))
+        while True:
+            data = dict(asks=[['1', '1', '0', '1']], bids=[['1', '1', '0', '1']], ts=str(int(time.time() * 1000)))
+            try:
+                await ws.send(json.dumps(dict(arg=dict(channel='books5', instId='BTC-USDT'), data=[data])))
+            except websockets.ConnectionClosed:
+                return
+            await asyncio.sleep(interval)
+
+    channels = [dict(channel='books5', instId='BTC-USDT')]
+    async with websockets.serve(handler, '127.0.0.1', 0) as server:
+        url = 'ws://127.0.0.1:{}'.format(server.sockets[0].getsockname()[1])
+        before = []
+        for _ in range(n):
+            begin = time.perf_counter()
+            stream = subscribe_without_login(url, channels)
+            await stream.__anext__()
+            before.append(time.perf_counter() - begin)
+            await stream.aclose()
+
+        after = []
+        stream = subscribe_without_login(url, channels)
+        await stream.__anext__()
+        for _ in range(n):
+            # 模拟下单耗时，期间行情积压
+            await asyncio.sleep(5 * interval)
+            begin = time.perf_counter()
+            fresh_after = int(time.time() * 1000)
+            async for book in stream:
+                if int(book['data'][0]['ts']) > fresh_after:
+                    break
+            after.append(time.perf_counter() - begin)
+        await stream.aclose()
+    print(f'resubscribe  {percentiles(before)}')
+    print(f'persistent   {percentiles(after)}')
+
+
+async def basket(coins=10, chunks=5, rtt=0.05):
+    """Startup-to-fully-hedged time of a basket of `coins`, opening one coin after another vs. all at once
+
+    Each REST call takes one round trip of `rtt` seconds under a fresh copy of its endpoint's rate limit, and the
+    books subscription takes two. Every coin follows the calls of `AddPosition.open` and fills in `chunks` hedges.
+    Coins opened one at a time refresh the USDT balance after each hedge, the basket reads it from the allocator.
+    """
+    from okex.account import AccountAPI
+    from okex.trade import TradeAPI
+    from src.allocator import USDTAllocator
+    from src.utils import REST_Semaphore
+
+    def fresh(semaphore):
+        return REST_Semaphore(semaphore._inquiries.maxlen, semaphore._interval)
+
+    async def call(semaphore):
+        async with semaphore:
+            await asyncio.sleep(rtt)
+
+    async def open_coin(s, allocator=None):
+        # spot_inst, swap_inst
+        await asyncio.gather(call(s['instrument']), call(s['instrument']))
+        # usdt_balance
+        await call(s['balance'])
+        # set_swap_lever: get_leverage, check_position_mode, set_leverage, get_leverage
+        await asyncio.gather(call(s['get_leverage']), call(s['config']))
+        await call(s['config'])
+        await call(s['set_leverage'])
+        await call(s['get_leverage'])
+        # add: get_lever, ticker, fees, usdt_balance, books5
+        await call(s['get_leverage'])
+        await call(s['ticker'])
+        await asyncio.gather(call(s['fee']), call(s['fee']), call(s['balance']))
+        await asyncio.sleep(2 * rtt)
+        for _ in range(chunks):
+            await asyncio.gather(call(s['spot_order']), call(s['swap_order']))
+            await asyncio.gather(call(s['order_info']), call(s['order_info']))
+            if not allocator:
+                await call(s['balance'])
+        # is_hedged
+        await asyncio.gather(call(s['balance']), call(s['position']))
+
+    def semaphores():
+        return dict(instrument=REST_Semaphore(20, 2), ticker=REST_Semaphore(20, 2),
+                    balance=fresh(AccountAPI.ACCOUNT_BALANCE_SEMAPHORE),
+                    position=fresh(AccountAPI.ACCOUNT_POSITION_SEMAPHORE),
+                    config=fresh(AccountAPI.ACCOUNT_CONFIG_SEMAPHORE), fee=fresh(AccountAPI.TRADE_FEE_SEMAPHORE),
+                    get_leverage=fresh(AccountAPI.GET_LEVERAGE_SEMAPHORE),
+                    set_leverage=fresh(AccountAPI.SET_LEVERAGE_SEMAPHORE),
+                    spot_order=fresh(TradeAPI.SPOT_MARGIN_SEMAPHORE), swap_order=fresh(TradeAPI.DERIVATIVE_SEMAPHORE),
+                    order_info=fresh(TradeAPI.ORDER_INFO_SEMAPHORE))
+
+    names = [f'C{i}' for i in range(coins)]
+    s = semaphores()
+    begin = time.perf_counter()
+    for _ in names:
+        await open_coin(s)
+    sequential = time.perf_counter() - begin
+
+    s = semaphores()
+    allocator = USDTAllocator(10000., dict.fromkeys(names, 1.))
+    begin = time.perf_counter()
+    await asyncio.gather(*[open_coin(s, allocator) for _ in names])
+    concurrent = time.perf_counter() - begin
+    print(f'one by one  {sequential:8.2f} s')
+    print(f'basket      {concurrent:8.2f} s')
+
+
+async def market_exit(coins=4, spot=10., contracts=100, margin=500.):
+    """Offline end-to-end `ReducePosition.market_exit` of `coins` hedged coins against the fill simulator, with
+    stubbed instruments, account and Mongo collections. The swap book of the last coin is too thin to close the
+    whole short, the others close fully and their positions disappear. Asserts balances, released USDT and records
+    """
+    import collections
+    from src.close_position import ReducePosition
+    from src.okex_api import OKExAPI
+    from src.record import Record
+    from src.simulator import SimulatedExchange
+
+    contract_val, open_price = 0.1, 100.
+    names = [f'C{i}' for i in range(coins)]
+    exchange = SimulatedExchange({f'{n}-USDT-SWAP': contract_val for n in names})
+    exchange.latency = 0
+    for i, name in enumerate(names):
+        depth = contracts // 2 if i == coins - 1 else contracts
+        exchange.books[f'{name}-USDT'].apply('books5', dict(bids=[['99.9', '4'], ['99.8', '20']], asks=[]))
+        exchange.books[f'{name}-USDT-SWAP'].apply('books5', dict(bids=[], asks=[['100.1', '30'],
+                                                                                  ['100.2', str(depth - 30)]]))
+
+    def filled(instId):
+        return sum(n['filled'] for n in exchange.orders.values() if n['instId'] == instId)
+
+    class Public:
+        async def get_specific_instrument(self, instType, instId):
+            return dict(instId=instId, minSz='0.01', lotSz='0.0001', tickSz='0.1', ctVal=str(contract_val),
+                        state='live')
+
+    class Account:
+        """Balances after the simulated fills; OKX lists no position once the short is closed"""
+
+        async def get_coin_balance(self, coin):
+            return dict(details=[dict(availEq=f'{spot - filled(coin + "-USDT"):.10g}')])
+
+        async def get_specific_position(self, instId):
+            if not (pos := filled(instId) - contracts):
+                return []
+            return [dict(mgnMode='isolated', pos=str(pos), margin=str(margin * pos / - contracts), last='100',
+                         avgPx=str(open_price), liqPx='150', upl='0', lever='2')]
+
+    class Collection:
+        def __init__(self):
+            self.calls = []
+
+        def __getattr__(self, name):
+            return lambda *args, **kwargs: self.calls.append((name, args))
+
+    saved = (OKExAPI.api_initiated, getattr(OKExAPI, 'tradeAPI', None), getattr(OKExAPI, 'accountAPI', None),
+             getattr(OKExAPI, 'publicAPI', None), Record.mydb)
+    collections_ = collections.defaultdict(Collection)
+    try:
+        OKExAPI.api_initiated = True
+        OKExAPI.accountAPI, OKExAPI.publicAPI = Account(), Public()
+        exchange.install()
+        Record.mydb = collections_
+        positions = await asyncio.gather(*[ReducePosition(coin=n) for n in names])
+        begin = time.perf_counter()
+        await ReducePosition.market_exit(positions)
+        elapsed = time.perf_counter() - begin
+    finally:
+        (OKExAPI.api_initiated, OKExAPI.tradeAPI, OKExAPI.accountAPI, OKExAPI.publicAPI, Record.mydb) = saved
+
+    deleted = [args[0]['instrument'] for name, args in collections_['Portfolio'].calls if name == 'delete_one']
+    ledgers = [n for name, args in collections_['Ledger'].calls if name == 'insert_many' for n in args[0]]
+    for n in positions:
+        spot_order, swap_order = [m for m in exchange.orders.values() if m['instId'].startswith(n.coin + '-')]
+        assert spot_order['state'] == 'filled' and abs(n.spot_filled_sum - spot) < 1e-9
+        swap_filled = swap_order['filled'] * contract_val
+        released = (swap_filled * open_price - swap_order['notional'] * contract_val - swap_order['paid']
+                    + spot_order['notional'] - spot_order['paid'] + margin * swap_order['filled'] / contracts)
+        assert abs(n.usdt_release - released) < 1e-6, (n.coin, n.usdt_release, released)
+        if n.coin == names[-1]:
+            assert swap_order['state'] == 'canceled' and n.coin not in deleted
+            assert abs(n.swap_position - (contracts - swap_order['filled']) * contract_val) < 1e-9
+        else:
+            assert swap_order['state'] == 'filled' and n.coin in deleted
+            assert n.swap_position == 0 and n.swap_balance == 0
+    assert len(ledgers) == 4 * coins
+    print(f'{coins} coins exited in {elapsed * 1000:.1f} ms, {len(deleted)} closed, '
+          f'{sum(n.usdt_release for n in positions):.2f} USDT released')
+
+
+def precision(n=100000, seed=0):
+    """Order sizing time per tick with round_to/float_str vs. the integer `Precision`, checked against each other
+
+    Where the two disagree, the result is compared with exact decimal arithmetic.
+    """
+    from decimal import Decimal, ROUND_FLOOR
+    rng = np.random.default_rng(seed)
+    # (lotSz, minSz, ctVal) of typical instruments
+    specs = [('0.00000001', '0.00001', '0.01'), ('0.000001', '0.001', '0.1'), ('0.0001', '0.01', '1'),
+             ('0.01', '0.1', '10'), ('1', '10', '1000000'), ('0.1', '1', '100')]
+    trade_fee = -0.001
+
+    def before(depth, size_increment, size_decimals, min_size, contract_val):
+        order_size = round_to(depth, min_size)
+        order_size = round_to(order_size, contract_val)
+        spot_size = round_to(order_size / (1 + trade_fee), size_increment)
+        spot_size = float_str(spot_size, size_decimals)
+        contract_size = round(order_size / contract_val)
+        return order_size, spot_size, f'{contract_size:d}'
+
+    def exact(depth, lot, minimum, contract):
+        order = Decimal(repr(depth))
+        for step in (minimum, contract):
+            order = (order / Decimal(step)).to_integral_value(ROUND_FLOOR) * Decimal(step)
+        spot = (order / (1 + Decimal(repr(trade_fee))) / Decimal(lot)).to_integral_value(ROUND_FLOOR) * Decimal(lot)
+        return str(spot.quantize(Decimal(lot))), str(int(order / Decimal(contract)))
+
+    for lot, minimum, contract in specs:
+        p = Precision(dict(lotSz=lot, minSz=minimum, tickSz='0.01'), dict(ctVal=contract, tickSz='0.01'))
+        args = float(lot), len(lot.partition('.')[2]), float(minimum), float(contract)
+        # 以面值整数倍为主，容易落在取整边界上
+        depths = [float(Decimal(int(k)) * Decimal(minimum)) for k in rng.integers(1, 10 ** 6, n // 2)]
+        depths += [float(x) for x in rng.uniform(0, 1000 * float(contract), n - n // 2)]
+
+        begin = time.perf_counter()
+        old = [before(depth, *args) for depth in depths]
+        old_time = (time.perf_counter() - begin) / n
+        begin = time.perf_counter()
+        new = [p.hedge_sizes(depth, trade_fee) for depth in depths]
+        new_time = (time.perf_counter() - begin) / n
+
+        mismatch = wrong = 0
+        for depth, a, b in zip(depths, old, new):
+            if a[1:] != b[1:] or abs(a[0] - p.size(b[0])) > 1e-9 * max(a[0], 1):
+                mismatch += 1
+                wrong += exact(depth, lot, minimum, contract) != b[1:]
+        print(f'lotSz {lot:10s} ctVal {contract:8s} round_to {old_time * 1e6:6.2f} us, Precision {new_time * 1e6:6.2f} us,'
+              f' {mismatch:5d} differ, {wrong:d} of them wrong')
+
+
+def premium_episodes(recording, sources, quantile=0.99, close=False):
+    """Premium opportunities each quote source would have caught in a recording
+
+    An opportunity is a stretch of time when the premium seen by the finest source stays at or above the `quantile`
+    of its premiums. A source catches it when one of its own updates inside that stretch shows the premium too.
+
+    :param recording: [(receive time, push), ...] of all sources for one spot/swap pair
+    :param sources: Channel names, the finest first
+    :param quantile: Threshold as a quantile of the premiums seen by the first source
+    :param close: Premium of swap ask over spot bid instead of swap bid over spot ask
+    :return: {source: (caught, total, median delay from the start of the opportunity in seconds)}
+    """
+    series = {}
+    for source in sources:
+        books, points = {}, []
+        for received, push in recording:
+            if push['arg']['channel'] != source:
+                continue
+            quote = to_quote(push)
+            books['swap' if quote['instId'].endswith('-SWAP') else 'spot'] = quote
+            if len(books) == 2 and all(books[n]['bids'] and books[n]['asks'] for n in books):
+                if close:
+                    # 平仓时溢价越低越好，取负后同样按越高越好统计
+                    premium = 1 - float(books['swap']['asks'][0][0]) / float(books['spot']['bids'][0][0])
+                else:
+                    premium = float(books['swap']['bids'][0][0]) / float(books['spot']['asks'][0][0]) - 1
+                points.append((received, premium))
+        series[source] = points
+    finest = series[sources[0]]
+    if not finest:
+        return {}
+    threshold = np.quantile([n[1] for n in finest], quantile)
+    episodes, start = [], None
+    for (received, premium), following in zip(finest, finest[1:] + [(finest[-1][0], -np.inf)]):
+        if premium >= threshold and start is None:
+            start = received
+        if start is not None and following[1] < threshold:
+            episodes.append((start, following[0]))
+            start = None
+    result = {}
+    for source, points in series.items():
+        times = np.array([n[0] for n in points])
+        hits = np.array([n[1] >= threshold for n in points])
+        delays = []
+        for begin, end in episodes:
+            window = (times >= begin) & (times <= end) & hits
+            if window.any():
+                delays.append(times[window][0] - begin)
+        result[source] = (len(delays), len(episodes), float(np.median(delays)) if delays else float('nan'))
+    return result
+
+
+async def quote_sources(coin='BTC', seconds=300, quantile=0.99):
+    """Premium opportunities caught by tickers, books5 and bbo-tbt, recorded side by side from the live feed
+    """
+    sources = ['bbo-tbt', 'books5', 'tickers']
+    channels = [dict(channel=source, instId=instId) for source in sources
+                for instId in (f'{coin}-USDT', f'{coin}-USDT-SWAP')]
+    recording = []
+    stream = subscribe_without_login('wss://ws.okx.com:8443/ws/v5/public', channels)
+    deadline = time.perf_counter() + seconds
+    async for push in stream:
+        recording.append((time.perf_counter(), push))
+        if time.perf_counter() > deadline:
+            break
+    await stream.aclose()
+    for close in (False, True):
+        print('close' if close else 'open')
+        for source, (caught, total, delay) in premium_episodes(recording, sources, quantile, close).items():
+            print(f'{source:8s} {caught:5d}/{total:<5d} caught, median delay {delay * 1000:8.1f} ms')
+
+
+def synthetic_frames(coins=150, seconds=60, rate=2000, seed=0):
+    """Raw tickers/books/bbo-tbt frames for `coins` USDT pairs at `rate` frames per second, with receive timestamps
+
+    :return: instIds, [(ns, frame)]
+    """
+    import json
+    rng = np.random.default_rng(seed)
+    instruments = [f'C{i}-USDT' for i in range(coins)] + [f'C{i}-USDT-SWAP' for i in range(coins)]
+    mids = rng.uniform(0.01, 30000, len(instruments))
+    n = seconds * rate
+    ts = time.time_ns() + np.cumsum(rng.exponential(1e9 / rate, n)).astype(np.int64)
+    frames = []
+    for i, t in zip(rng.integers(0, len(instruments), n), ts):
+        instId, mid = instruments[i], mids[i] * (1 + rng.normal(0, 1e-4))
+        levels = [[f'{mid * (1 + k * 1e-4):.6g}', f'{rng.uniform(0, 100):.4f}', '0', str(rng.integers(1, 9))]
+                  for k in range(rng.integers(1, 6))]
+        ms = str(int(t) // 10 ** 6)
+        channel = rng.choice(['books', 'books', 'bbo-tbt', 'tickers'])
+        if channel == 'tickers':
+            data = dict(instType='SPOT', instId=instId, last=levels[0][0], bidPx=levels[0][0], bidSz=levels[0][1],
+                        askPx=levels[-1][0], askSz=levels[-1][1], ts=ms)
+            frame = dict(arg=dict(channel=channel, instId=instId), data=[data])
+        else:
+            data = dict(asks=levels, bids=levels[::-1], ts=ms, checksum=int(rng.integers(-2 ** 31, 2 ** 31)))
+            frame = dict(arg=dict(channel=channel, instId=instId), data=[data])
+            if channel == 'books':
+                frame['action'] = 'update'
+        frames.append((int(t), json.dumps(frame, separators=(',', ':'))))
+    return instruments, frames
+
+
+def capture(coins=150, seconds=60, rate=2000):
+    """Capture throughput on one core: synthetic frames written, read back and compared
+    """
+    import shutil
+    import tempfile
+    import tracemalloc
+    from src.capture import CaptureReader, CaptureWriter
+    instruments, frames = synthetic_frames(coins, seconds, rate)
+    n = len(frames)
+    size = sum(len(m) for _, m in frames)
+
+    path = tempfile.mkdtemp()
+    try:
+        tracemalloc.start()
+        writer = CaptureWriter(path)
+        # Synthetic frames arrive faster than the feed, so chunks are cut by size only
+        writer.chunk_seconds = float('inf')
+        begin = time.perf_counter()
+        for t, m in frames:
+            writer.append(t, m)
+        writer.close()
+        elapsed = time.perf_counter() - begin
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{n} frames, {size / 2 ** 20:.1f} MiB raw -> {writer.bytes_out / 2 ** 20:.1f} MiB, '
+              f'ratio {size / writer.bytes_out:.1f}')
+        print(f'write {n / elapsed:10.0f} frames/s {size / elapsed / 2 ** 20:8.1f} MiB/s, '
+              f'{n / elapsed / rate:.0f}x the feed, peak memory {peak / 2 ** 20:.1f} MiB')
+
+        reader = CaptureReader(path)
+        begin = time.perf_counter()
+        assert list(reader.frames()) == frames
+        print(f'read  {n / (time.perf_counter() - begin):10.0f} frames/s')
+        instId = instruments[0]
+        begin = time.perf_counter()
+        selected = list(reader.frames(instruments=[instId]))
+        assert selected == [m for m in frames if f'"instId":"{instId}"' in m[1]]
+        print(f'read one instrument {len(selected)} frames in {time.perf_counter() - begin:.3f} s')
+    finally:
+        shutil.rmtree(path)
+
+
+async def replay(coins=150, seconds=60, rate=2000, speed=10.):
+    """Replay of a synthetic capture: frames/s at max speed, and delivery delay behind the feed timing at `speed`
+    """
+    import shutil
+    import tempfile
+    from src.capture import CaptureWriter
+    from src.replay import Replay
+    instruments, frames = synthetic_frames(coins, seconds, rate)
+    path = tempfile.mkdtemp()
+    try:
+        writer = CaptureWriter(path)
+        writer.chunk_seconds = float('inf')
+        for t, m in frames:
+            writer.append(t, m)
+        writer.close()
+        channels = [dict(channel=channel, instId=instId) for channel in ('bbo-tbt', 'tickers')
+                    for instId in instruments]
+        expected = sum(1 for _, m in frames if '"bbo-tbt"' in m or '"tickers"' in m)
+
+        player = Replay(path, speed=0)
+        begin = time.perf_counter()
+        count = 0
+        async for _ in player.subscribe('', channels):
+            count += 1
+        elapsed = time.perf_counter() - begin
+        assert count == expected
+        print(f'max speed  {count / elapsed:10.0f} frames/s, {seconds / elapsed:.0f}x the feed')
+
+        # Seek to the middle of the recording
+        middle = frames[len(frames) // 2][0]
+        player = Replay(path, begin=frames[0][0], speed=0)
+        stream = player.subscribe('', channels)
+        await stream.__anext__()
+        player.seek(middle)
+        rest = [n async for n in stream]
+        assert rest and all(int(n['data'][0]['ts']) >= middle // 10 ** 6 for n in rest)
+        print(f'seek       {len(rest)} frames after the middle')
+
+        player = Replay(path, end=frames[0][0] + 10 ** 9 * seconds // 10, speed=speed)
+        delays = []
+        async for _ in player.subscribe('', channels):
+            delays.append(time.monotonic() - player.anchor[1] - (player.clock - player.anchor[0]) / 10 ** 9 / speed)
+        print(f'{speed:g}x delay {percentiles(delays)}')
+    finally:
+        shutil.rmtree(path)
+
+
+async def simulator(coins=150, seconds=60, rate=2000, resting=20):
+    """Book updates per minute applied by the fill simulator, with `resting` limit orders checked on every update.
+    Orders alternate buy and sell just short of the opposite best price, so new crossing liquidity fills them as maker
+    """
+    import json
+    from src.simulator import SimulatedExchange
+    instruments, frames = synthetic_frames(coins, seconds, rate)
+    frames = [(t, json.loads(m)) for t, m in frames]
+    exchange = SimulatedExchange()
+    exchange.latency = 0
+    for t, res in frames[:len(frames) // 10]:
+        exchange.on_frame(t, res)
+    for i, instId in enumerate(instruments[:resting]):
+        book = exchange.books[instId]
+        if not (book.bids and book.asks):
+            continue
+        # 不立即成交的最近价位
+        if buy := i % 2 == 0:
+            price = f'{min(book.asks) * (1 - 2e-5):.8g}'
+        else:
+            price = f'{max(book.bids) * (1 + 2e-5):.8g}'
+        await exchange.take_spot_order(instId=instId, side='buy' if buy else 'sell', order_type='limit', size='1',
+                                       price=price)
+    orders = sum(len(n) for n in exchange.resting.values())
+    assert orders == len(exchange.orders)
+    begin = time.perf_counter()
+    for t, res in frames:
+        exchange.on_frame(t, res)
+    elapsed = time.perf_counter() - begin
+    filled = [n for n in exchange.orders.values() if n['filled']]
+    # 挂单只作为maker成交，成交均价等于挂单价
+    for order in filled:
+        assert abs(order['notional'] / order['filled'] - float(order['px'])) < 1e-9 * float(order['px']), order
+    print(f'{len(frames) / elapsed * 60 / 1e6:.2f} M updates/min with {orders} resting orders, {len(filled)} filled '
+          f"at their limit, {sum(n['state'] == 'filled' for n in filled)} fully")
+
+
+def synthetic_premiums(days=30, interval=10., seed=0):
+    """Premiums sampled every `interval` seconds as by `record`: mean-reverting noise around a drifting level
+
+    :return: timestamp, open_pd, close_pd
+    """
+    rng = np.random.default_rng(seed)
+    n = int(days * 86400 / interval)
+    timestamp = time.time() - days * 86400 + np.cumsum(rng.uniform(0.8, 1.2, n) * interval)
+    level = np.cumsum(rng.normal(0, 2e-6, n))
+    noise = np.zeros(n)
+    shocks = rng.normal(0, 3e-4, n)
+    for i in range(1, n):
+        noise[i] = 0.95 * noise[i - 1] + shocks[i]
+    open_pd = 1e-3 + level + noise
+    return timestamp, open_pd, open_pd + np.abs(rng.normal(1e-3, 2e-4, n))
+
+
+def backtest(days=30, seed=0):
+    """Premium threshold backtest of one coin-month, checked against a plain loop on a short sample
+    """
+    from src.backtest import backtest, rolling_stat
+    timestamp, open_pd, close_pd = synthetic_premiums(days, seed=seed)
+
+    # Rolling statistics and fills against a direct loop over the first two days
+    m = 2 * 8640
+    mean, std, _ = rolling_stat(timestamp[:m], open_pd[:m], 2)
+    for i in range(0, m, 997):
+        window = open_pd[:i + 1][timestamp[:i + 1] > timestamp[i] - 7200]
+        assert abs(mean[i] - window.mean()) < 1e-12
+        assert len(window) < 2 or abs(std[i] - window.std(ddof=1)) < 1e-9
+    kwargs = dict(sigma=1., lookback=2, accelerate_after=2, chunk=0.25, fee=5e-4, every=6, max_hours=12)
+    res = backtest(timestamp[:m], open_pd[:m], **kwargs)
+    fills = []
+    for start in np.unique(np.searchsorted(timestamp[:m], np.arange(timestamp[0] + 7200, timestamp[m - 1], 6 * 3600))):
+        threshold, count, stage = None, 0, -1
+        for i in range(start, m):
+            elapsed = timestamp[i] - timestamp[start]
+            if elapsed > 12 * 3600 or count == 4:
+                break
+            if int(elapsed // 7200) != stage:
+                stage = int(elapsed // 7200)
+                at = np.searchsorted(timestamp[:m], timestamp[start] + stage * 7200) if stage else start
+                window = open_pd[:at + 1][timestamp[:at + 1] > timestamp[at] - 7200]
+                threshold = window.mean() + (1. if not stage else 2.) * window.std(ddof=1)
+            if open_pd[i] - 5e-4 >= threshold:
+                count += 1
+        fills.append(count)
+    assert abs(res['fills'] - np.mean(fills)) < 1e-9, (res['fills'], np.mean(fills))
+
+    for close in (False, True):
+        begin = time.perf_counter()
+        res = backtest(timestamp, close_pd if close else open_pd, close)
+        elapsed = time.perf_counter() - begin
+        print(f"{'close' if close else 'open '} {elapsed * 1000:6.0f} ms, {res['episodes']} episodes, "
+              f"{res['completed']:.0%} completed, {res['fills']:.1f} fills, premium {res['premium']:.4%}, "
+              f"net {res['net']:.4%}, {res['median_hours']:.1f} h median")
+
+
+def sweep(coins=4, days=7, seed=0):
+    """Parameter sweep over synthetic coins: configs/s with 1, 2, 4... worker processes and the speedup over one
+    """
+    import os
+    from src.backtest import backtest
+    from src.sweep import grid, recommend, sweep
+    premiums = dict()
+    for i in range(coins):
+        timestamp, open_pd, close_pd = synthetic_premiums(days, seed=seed + i)
+        premiums[f'C{i}'] = dict(timestamp=timestamp, open_pd=open_pd, close_pd=close_pd)
+    configs = grid()
+    workers, base = 1, 0.
+    while True:
+        table, rate = sweep(premiums, configs, workers=workers)
+        base = base or rate
+        print(f'{workers:2d} workers: {len(configs) * coins} configs, {rate:6.1f} configs/s, {rate / base:4.2f}x')
+        if workers >= (os.cpu_count() or 1):
+            break
+        workers = min(workers * 2, os.cpu_count())
+
+    # Results from shared memory match a direct call
+    best = table['C0'][0]
+    series = premiums['C0']
+    res = backtest(series['timestamp'], series['open_pd'], sigma=best['sigma'], lookback=best['lookback'],
+                   accelerate_after=best['accelerate_after'], chunk=best['chunk'])
+    assert res['net'] == best['net'] and res['fills'] == best['fills']
+    params = recommend(table)
+    print(f"best C0: sigma {best['sigma']}, lookback {best['lookback']} h, accelerate after "
+          f"{best['accelerate_after']} h, chunk {best['chunk']}, completed {best['completed']:.0%}, "
+          f"net {best['net']:.4%}")
+    print(f"recommended: sigma {params['sigma']}, lookback {params['lookback']} h, accelerate after "
+          f"{params['accelerate_after']} h, chunk {params['chunk']}, net {params['net']:.4%}")
+
+
+def synthetic_carry(coins=250, days=90, seed=0):
+    """Funding and 4H candle matrices shaped like `load_carry_data`: persistent per-coin funding levels with noise,
+    random-walk prices with per-coin volatility and a quarter of the coins listed partway through
+    """
+    from src.carry import DAY_MS
+    rng = np.random.default_rng(seed)
+    begin = (int(time.time()) // 86400 - days) * DAY_MS
+    times = begin + np.arange(days * 3, dtype=np.int64) * 8 * 3600 * 1000
+    level = rng.normal(1e-4, 1.5e-4, coins)[:, None]
+    funding = np.zeros((coins, len(times)))
+    for t in range(1, len(times)):
+        funding[:, t] = level[:, 0] + 0.8 * (funding[:, t - 1] - level[:, 0]) + rng.normal(0, 1e-4, coins)
+    listed = np.where(rng.random(coins) < 0.25, rng.integers(0, len(times), coins), 0)
+    funding[np.arange(len(times))[None, :] < listed[:, None]] = np.nan
+    bars = begin + np.arange(days * 6, dtype=np.int64) * 4 * 3600 * 1000
+    volatility = rng.uniform(0.005, 0.03, coins)[:, None]
+    close = 10 * np.exp(np.cumsum(rng.normal(0, 1, (coins, len(bars))) * volatility, axis=1))
+    open_ = np.concatenate((close[:, :1], close[:, :-1]), axis=1)
+    high = np.maximum(open_, close) * (1 + rng.uniform(0, 1, close.shape) * volatility)
+    low = np.minimum(open_, close) * (1 - rng.uniform(0, 1, close.shape) * volatility)
+    candles = np.stack((open_, high, low, close), axis=2)
+    return dict(instruments=[f'C{i}' for i in range(coins)], times=times, funding=funding,
+                bars=bars + 4 * 3600 * 1000, candles=candles)
+
+
+def carry(coins=250, days=90, seed=0):
+    """Funding carry backtest of the default rule grid, with one rule checked against a plain loop
+    """
+    from src.carry import DAY_MS, carry_backtest
+    data = synthetic_carry(coins, days, seed)
+    begin = time.perf_counter()
+    res = carry_backtest(data)
+    elapsed = time.perf_counter() - begin
+    print(f'{len(res)} rules over {coins} coins x {len(data["times"])} settlements in {elapsed * 1000:.0f} ms')
+
+    # 7 days, funding / sqrt(ATR), top 10, every 3 days
+    lookback, top_n, rebalance, fee = 7, 10, 3, 0.0015
+    times, funding, bars, candles = data['times'], data['funding'], data['bars'], data['candles']
+    tr = np.full(candles.shape[:2], np.nan)
+    for i in range(coins):
+        for b in range(1, len(bars)):
+            high, low, close = candles[i, b, 1], candles[i, b, 2], candles[i, b - 1, 3]
+            tr[i, b] = max(high - low, abs(high - close), abs(low - close)) / close
+    first = np.searchsorted(times, times[0] + 30 * DAY_MS)
+    weights, equity, peak, drawdown, turnover = np.zeros(coins), 0., 0., 0., 0.
+    next_rebalance = times[first]
+    for t in range(first, len(times)):
+        if t > first:
+            equity += sum(weights[i] * funding[i, t] for i in range(coins) if weights[i])
+        if times[t] >= next_rebalance and t < len(times) - 1:
+            next_rebalance += rebalance * DAY_MS
+            scores = []
+            for i in range(coins):
+                window = (times > times[t] - lookback * DAY_MS) & (times <= times[t])
+                # Listed for the whole window
+                if np.isnan(funding[i][times <= times[t] - lookback * DAY_MS][-1]):
+                    continue
+                mean = np.nanmean(funding[i, window])
+                atr = np.nanmean(tr[i, (bars > times[t] - lookback * DAY_MS) & (bars <= times[t])])
+                if mean / np.sqrt(atr) > 0:
+                    scores.append((mean / np.sqrt(atr), i))
+            chosen = [i for _, i in sorted(scores, key=lambda n: -n[0])[:top_n]]
+            new = np.zeros(coins)
+            new[chosen] = 1 / len(chosen) if chosen else 0
+            turnover += np.abs(new - weights).sum()
+            equity -= fee * np.abs(new - weights).sum()
+            weights = new
+        if t == len(times) - 1:
+            turnover += weights.sum()
+            equity -= fee * weights.sum()
+        peak = max(peak, equity)
+        drawdown = max(drawdown, peak - equity)
+    rule = next(n for n in res if (n['lookback'], n['exponent'], n['top_n'], n['rebalance']) == (7, 0.5, 10, 3))
+    assert abs(rule['net'] - equity) < 1e-12 and abs(rule['turnover'] - turnover) < 1e-9, (rule, equity, turnover)
+    assert abs(rule['drawdown'] - drawdown) < 1e-12
+    best = res[0]
+    print(f"best: {best['lookback']} days, exponent {best['exponent']}, top {best['top_n']}, every "
+          f"{best['rebalance']} days: net {best['net']:.2%}, APR {best['apr']:.2%}, turnover {best['turnover']:.1f}, "
+          f"drawdown {best['drawdown']:.2%}")
+    print(f"7 days, sqrt(ATR), top 10, every 3 days: net {rule['net']:.2%}, APR {rule['apr']:.2%}, "
+          f"turnover {rule['turnover']:.1f}, drawdown {rule['drawdown']:.2%}")
+
+
+def funding_stats(coins=250, days=90, seed=0):
+    """Funding statistics of all swaps from the in-memory matrix vs. per-instrument lists as before
+    """
+    import statistics
+    from src.funding_rate import FundingRate, history_matrix
+    data = synthetic_carry(coins, days, seed)
+    histories = []
+    for i in range(coins):
+        rows = [dict(instId=f'C{i}-USDT-SWAP', fundingTime=str(t), realizedRate=str(r))
+                for t, r in zip(data['times'], data['funding'][i]) if not np.isnan(r)]
+        histories.append(rows[::-1])
+
+    begin = time.perf_counter()
+    FundingRate.history_ids, FundingRate.history_times, FundingRate.history = history_matrix(histories)
+    FundingRate.history_index = {m: i for i, m in enumerate(FundingRate.history_ids)}
+    FundingRate.history_days = days
+    built = time.perf_counter() - begin
+    for n in (7, 30, 90):
+        begin = time.perf_counter()
+        stats = FundingRate.funding_stats(n)
+        elapsed = time.perf_counter() - begin
+        begin = time.perf_counter()
+        expected = {h[0]['instId']: statistics.mean(float(m['realizedRate']) for m in h[:n * 3])
+                    for h in histories if len(h) >= n * 3}
+        looped = time.perf_counter() - begin
+        mean = {m: v for m, v in zip(stats['instruments'], stats['mean']) if not np.isnan(v)}
+        assert mean.keys() == expected.keys()
+        assert all(abs(mean[m] - expected[m]) < 1e-15 for m in mean)
+        top = stats['instruments'][int(np.nanargmin(stats['rank']))]
+        print(f'{n:2d} days: {len(mean)} instruments in {elapsed * 1000:5.2f} ms, lists {looped * 1000:6.2f} ms, '
+              f'top {top} mean {stats["mean"][FundingRate.history_index[top]]:.4%}, '
+              f'positive {np.nanmean(stats["positive"]):.0%}')
+    print(f'matrix built in {built * 1000:.1f} ms')
+
+    # Settlements from the funding-rate channel extend the matrix
+    last = int(FundingRate.history_times[-1]) + FundingRate.settle_interval
+    FundingRate.append_history('C0-USDT-SWAP', last, 0.001)
+    FundingRate.append_history('NEW-USDT-SWAP', last, 0.002)
+    assert FundingRate.history.shape == (coins + 1, len(data['times']) + 1)
+    assert FundingRate.history[0, -1] == 0.001 and np.isnan(FundingRate.funding_stats(1)['mean'][-1])
+
+
+def volatility(instruments=150, days=7, seed=0):
+    """NATR, Parkinson, Garman-Klass and close-to-close volatility of all instruments in one pass vs.
+    `average_true_range` per instrument
+    """
+    from src.trading_data import average_true_range, candle_matrix, volatility
+    data = synthetic_carry(instruments, days + 1, seed)
+    window = days * 6
+    # get_kline format: newest first, strings, with the extra bar for the first true range
+    candles = [[[str(t - 4 * 3600 * 1000), *map(str, row)] for t, row in zip(data['bars'], data['candles'][i])
+                if not np.isnan(row[0])][::-1][:window + 1] for i in range(instruments)]
+
+    begin = time.perf_counter()
+    atr = [average_true_range(n, days, '4H') for n in candles]
+    looped = time.perf_counter() - begin
+    begin = time.perf_counter()
+    matrix = candle_matrix(candles)[1]
+    stacked = time.perf_counter() - begin
+    begin = time.perf_counter()
+    res = volatility(matrix, window)
+    elapsed = time.perf_counter() - begin
+    assert np.allclose(res['natr'], atr, rtol=1e-12)
+
+    array = np.asarray(candles[0], dtype=np.float64)[::-1, 1:5]
+    o, h, l, c = array[1:].T
+    assert abs(res['parkinson'][0] - np.sqrt(np.mean(np.log(h / l) ** 2) / (4 * np.log(2)))) < 1e-12
+    assert abs(res['garman_klass'][0] - np.sqrt(np.mean(0.5 * np.log(h / l) ** 2 - (2 * np.log(2) - 1) *
+                                                         np.log(c / o) ** 2))) < 1e-12
+    assert abs(res['close_to_close'][0] - np.std(np.log(array[1:, 3] / array[:-1, 3]), ddof=1)) < 1e-12
+    print(f'{instruments} instruments x {window} bars: stacked in {stacked * 1000:.2f} ms, four estimators in '
+          f'{elapsed * 1000:.2f} ms, average_true_range per instrument {looped * 1000:.2f} ms')
+    print(f"median NATR {np.median(res['natr']):.3%}, Parkinson {np.median(res['parkinson']):.3%}, "
+          f"Garman-Klass {np.median(res['garman_klass']):.3%}, close-to-close {np.median(res['close_to_close']):.3%}")
+
+
+def scanner(coins=300, seconds=60, rate=3000, seed=0):
+    """Scanner load on one core: ticker frames of all pairs decoded and applied, and the ranking refreshed every
+    0.5 s of simulated time. Reports the CPU share of real time needed
+    """
+    import json
+    from src.funding_rate import FundingRate
+    from src.scanner import Scanner
+    rng = np.random.default_rng(seed)
+    swaps = [f'C{i}-USDT-SWAP' for i in range(coins)]
+    instruments = swaps + [n[:-5] for n in swaps]
+    funding = rng.normal(1e-4, 1e-4, coins)
+    funding[7] = 0.003
+    FundingRate.rates = {n: dict(current=funding[i], next=funding[i], funding_time=0) for i, n in enumerate(swaps)}
+    price = rng.uniform(1, 100, coins)
+    frames = []
+    for n in rng.integers(0, 2 * coins, seconds * rate):
+        instId = instruments[n]
+        mid = price[n % coins] * (1 + (5e-4 if n < coins else 0.) + rng.normal(0, 2e-4))
+        frames.append(json.dumps(dict(arg=dict(channel='tickers', instId=instId), data=[
+            dict(instId=instId, bidPx=str(mid * (1 - 1e-4)), askPx=str(mid * (1 + 1e-4)), ts='0')])))
+
+    # Two hours of 10 s Ticker records, so that the ranking is not held back for warm-up
+    stamps = 1e9 - np.arange(Scanner.warmup * 360, 0, -1) * 10
+    premium = 5e-4 + rng.normal(0, 2.8e-4, (coins, len(stamps)))
+    premiums = {n[:n.find('-')]: dict(timestamp=stamps, open_pd=premium[i] - 2e-4, close_pd=premium[i] + 2e-4)
+                for i, n in enumerate(swaps)}
+
+    scanner = Scanner()
+    scanner.setup(swaps)
+    scanner.seed(premiums, 1e9)
+    step = int(rate * Scanner.refresh)
+    updates = []
+    begin = time.perf_counter()
+    for i in range(0, len(frames), step):
+        for frame in frames[i:i + step]:
+            scanner.on_ticker(json.loads(frame))
+        start = time.perf_counter()
+        scanner.update(1e9 + i / rate)
+        updates.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - begin
+    assert Scanner.table[0]['coin'] == 'C7', Scanner.table[0]
+    assert abs(np.nanmean(scanner.mean[0]) - 5e-4) < 2e-4
+    print(f'{len(frames)} frames of {2 * coins} instruments in {elapsed:.2f} s: {len(frames) / elapsed:,.0f} frames/s, '
+          f'{elapsed / seconds:.1%} of one core at {rate} frames/s')
+    print(f'refresh of {coins} pairs every {Scanner.refresh} s: {percentiles(updates)}')
+
+
+async def screening(instruments=250, days=7, latency=0.05, concurrency=10, seed=0):
+    """show_profitable_rate pipeline against simulated REST latency and a shared concurrency limit: time to first
+    result and total time, compared with downloading all funding histories before any candles
+    """
+    import contextlib
+    import io
+    import re
+    from src.funding_rate import FundingRate
+    from src.trading_data import Stat
+    data = synthetic_carry(instruments, days + 1, seed)
+    swaps = [f'C{i}-USDT-SWAP' for i in range(instruments)]
+    histories = {n: [dict(instId=n, fundingTime=str(t), realizedRate=str(r))
+                     for t, r in zip(data['times'], data['funding'][i]) if not np.isnan(r)][::-1]
+                 for i, n in enumerate(swaps)}
+    candles = {n[:-5]: [[str(t - 4 * 3600 * 1000), *map(str, row)] for t, row in zip(data['bars'], data['candles'][i])
+                        ][::-1] for i, n in enumerate(swaps)}
+    rest = asyncio.Semaphore(concurrency)
+    selected = []
+    calls = []
+
+    class SimulatedFundingRate(FundingRate):
+        async def get_instruments_ID(self):
+            return swaps
+
+        async def funding_history(self, instId, limit=270):
+            async with rest:
+                await asyncio.sleep(latency)
+            return histories[instId][:limit]
+
+        async def show_selected_rate(self, coinlist):
+            selected.append(coinlist)
+
+    async def get_candles(self, instId, days, bar='4H'):
+        calls.append(instId)
+        async with rest:
+            await asyncio.sleep(latency)
+        return candles[instId][:days * 6 + 1]
+
+    original = Stat.get_candles
+    Stat.get_candles = get_candles
+    try:
+        fundingRate = SimulatedFundingRate()
+        FundingRate.history_days = 0
+        begin = time.perf_counter()
+        histories_ = await asyncio.gather(*[fundingRate.funding_history(n, days * 3) for n in swaps])
+        rates = sorted(((np.mean([float(m['realizedRate']) for m in h]), h[0]['instId']) for h in histories_
+                        if len(h) >= days * 3), reverse=True)[:20]
+        volatility = await Stat().volatilities([n[:n.find('-')] + '-USDT' for _, n in rates], days)
+        expected = sorted(((int(r / np.sqrt(a) * 10000), n[:n.find('-')]) for (r, n), a in
+                           zip(rates, volatility['natr'])), key=lambda n: -n[0])[:10]
+        gathered = time.perf_counter() - begin
+
+        output = io.StringIO()
+        begin = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            await fundingRate.show_profitable_rate(days)
+        elapsed = time.perf_counter() - begin
+    finally:
+        Stat.get_candles = original
+    assert selected[0] == [n for _, n in expected], (selected[0], expected)
+    first = float(re.findall(r'[\d.]+', output.getvalue().strip().splitlines()[-1])[0])
+    refreshes = output.getvalue().count('/' + str(instruments))
+    print(f'{instruments} instruments, {latency * 1000:.0f} ms latency, {concurrency} requests in flight')
+    print(f'gather all funding, then candles: first and only result after {gathered:.2f} s')
+    print(f'pipeline: first result after {first:.1f} s, finished in {elapsed:.2f} s, {refreshes} display refreshes, '
+          f'{len(calls) - len(rates)} candle downloads for coins that left the top {len(rates)}')
+
+
+BENCHMARKS = dict(transport=transport, signing=signing, faults=faults, sizing=sizing, resubscribe=resubscribe,
+                  basket=basket, market_exit=market_exit, precision=precision, quote_sources=quote_sources,
+                  capture=capture, replay=replay, simulator=simulator, backtest=backtest, sweep=sweep,
+                  carry=carry, funding_stats=funding_stats, volatility=volatility,
+                  scanner=scanner, screening=screening)
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        print(name)
+        result = BENCHMARKS[name]()
+        if asyncio.iscoroutine(result):
+            asyncio.get_event_loop().run_until_complete(result)
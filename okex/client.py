@@ -2,12 +2,235 @@ from . import consts as c, utils, exceptions
 from src.codedict import codes
 import asyncio
 import aiohttp
-from datetime import datetime
+import collections
+import contextlib
 import json
+import random
+import time
+from typing import Dict, List
+import src.lang as lang
+
+
+def request_lane(method, request_path):
+    """Priority lane of a REST request
+
+    :param method: GET, POST or DELETE
+    :param request_path: Endpoint without query string
+    """
+    if request_path in (c.TRADE_ORDER, c.PENDING_ORDER):
+        return c.LANE_ORDER if method == c.POST else c.LANE_ORDER_STATUS
+    elif request_path in (c.BATCH_ORDER, c.AMEND_ORDER, c.CANCEL_ORDER, c.BATCH_CANCEL):
+        return c.LANE_ORDER
+    elif request_path.startswith(('/api/v5/account/', '/api/v5/asset/')):
+        return c.LANE_ACCOUNT
+    elif request_path in (c.FUNDING_RATE, c.FUNDING_RATE_HISTORY, c.GET_CANDLES, c.HISTORY_CANDLES):
+        return c.LANE_ANALYTICS
+    else:
+        return c.LANE_MARKET
+
+
+class RequestScheduler:
+    """Dispatch REST requests sharing one connection pool by priority lane
+    """
+
+    def __init__(self, limit=c.REQUEST_LIMIT, lane_limits=c.LANE_LIMITS):
+        """Queued requests of a lower lane are always dispatched before those of a higher lane.
+
+        :param limit: Concurrent requests in total
+        :param lane_limits: Concurrent requests per lane
+        """
+        self.limit = limit
+        self.lane_limits = list(lane_limits)
+        self._active = 0
+        self._lane_active = [0] * len(lane_limits)
+        self._waiters = [collections.deque() for _ in lane_limits]
+        # count, total wait, max wait, total latency
+        self._stats = [[0, 0., 0., 0.] for _ in lane_limits]
+
+    def __repr__(self):
+        return f'RequestScheduler: {self._active}/{self.limit} active, {sum(map(len, self._waiters))} queued'
+
+    def _available(self, lane):
+        return self._active < self.limit and self._lane_active[lane] < self.lane_limits[lane]
+
+    def _take(self, lane):
+        self._active += 1
+        self._lane_active[lane] += 1
+
+    def _wakeup(self):
+        for lane, waiters in enumerate(self._waiters):
+            while waiters and self._available(lane):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self._take(lane)
+                    waiter.set_result(None)
+            if self._active >= self.limit:
+                break
+
+    async def acquire(self, lane):
+        """Wait for a free slot in `lane`. Requests in the same lane are served first in first out.
+        """
+        # Nothing more urgent is waiting.
+        if self._available(lane) and not any(self._waiters[:lane + 1]):
+            self._take(lane)
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters[lane].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Slot was granted just before cancellation.
+                self.release(lane)
+            elif waiter in self._waiters[lane]:
+                # A cancelled waiter may already have been popped by _wakeup.
+                self._waiters[lane].remove(waiter)
+            raise
+
+    def release(self, lane):
+        self._active -= 1
+        self._lane_active[lane] -= 1
+        self._wakeup()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane):
+        """Hold a slot in `lane` for one round trip
+        """
+        begin = time.monotonic()
+        await self.acquire(lane)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(lane)
+            stat = self._stats[lane]
+            stat[0] += 1
+            stat[1] += start - begin
+            stat[2] = max(stat[2], start - begin)
+            stat[3] += time.monotonic() - start
+
+    def metrics(self):
+        """Queue depth and latency of each lane
+
+        :return: {lane name: dict(queued, active, served, avg_wait, max_wait, avg_latency)}
+        """
+        res = dict()
+        for lane, name in enumerate(c.LANE_NAMES):
+            count, wait, max_wait, latency = self._stats[lane]
+            res[name] = dict(queued=len(self._waiters[lane]), active=self._lane_active[lane], served=count,
+                             avg_wait=wait / count if count else 0., max_wait=max_wait,
+                             avg_latency=latency / count if count else 0.)
+        return res
+
+
+class RetryPolicy:
+    """Jittered exponential backoff within an optional deadline
+    """
+
+    def __init__(self, deadline=None, retries=c.MAX_RETRIES):
+        """
+        :param deadline: Seconds to give up after
+        :param retries: Max number of retries
+        """
+        self.expiry = time.monotonic() + deadline if deadline else None
+        self.retries = retries
+        self.attempt = 0
+
+    def remaining(self):
+        return None if self.expiry is None else self.expiry - time.monotonic()
+
+    def timeout(self):
+        """Timeout of the next attempt
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        if remaining <= 0:
+            raise exceptions.OkexDeadlineException('Deadline exceeded')
+        return remaining
+
+    async def backoff(self, reason, minimum=0.):
+        """Sleep before the next attempt, or raise if there is none
+
+        :param reason: Failure of the last attempt
+        :param minimum: Minimum seconds to sleep
+        """
+        self.attempt += 1
+        if self.attempt > self.retries:
+            raise exceptions.OkexRequestException(f'{reason}, {lang.reach_max_retry}')
+        delay = max(minimum, random.uniform(0, min(c.BACKOFF_CAP, c.BACKOFF_BASE * 2 ** self.attempt)))
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            raise exceptions.OkexDeadlineException(f'{reason}, deadline exceeded')
+        await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """Fail fast on an endpoint after consecutive failures
+    """
+    breakers: Dict[tuple, 'CircuitBreaker'] = dict()
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, endpoint, threshold=c.BREAKER_THRESHOLD, cooldown=c.BREAKER_COOLDOWN):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.
+
+    def __repr__(self):
+        return f'CircuitBreaker({self.endpoint}): {self.state}, {self.failures} failures'
+
+    @staticmethod
+    def of(method, endpoint) -> 'CircuitBreaker':
+        """Breaker of one method on one endpoint, so that failed orders do not block order queries
+        """
+        if (method, endpoint) not in CircuitBreaker.breakers:
+            CircuitBreaker.breakers[(method, endpoint)] = CircuitBreaker(f'{method} {endpoint}')
+        return CircuitBreaker.breakers[(method, endpoint)]
+
+    @staticmethod
+    def open_endpoints() -> List[str]:
+        """Endpoints currently failing fast
+        """
+        return [n.endpoint for n in CircuitBreaker.breakers.values() if n.state != CircuitBreaker.CLOSED]
+
+    def check(self):
+        """Raise if the endpoint is failing fast. After `cooldown` one trial request is let through.
+        """
+        if self.state == CircuitBreaker.CLOSED:
+            return
+        elapsed = time.monotonic() - self.opened_at
+        # Also retries a trial that never reported back
+        if elapsed >= self.cooldown:
+            self.state = CircuitBreaker.HALF_OPEN
+            self.opened_at = time.monotonic()
+            return
+        raise exceptions.OkexCircuitOpenException(f'{self.endpoint} retry in {max(self.cooldown - elapsed, 0):.0f}s')
+
+    def success(self):
+        self.failures = 0
+        self.state = CircuitBreaker.CLOSED
+
+    def failure(self):
+        self.failures += 1
+        if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+            self.state = CircuitBreaker.OPEN
+            self.opened_at = time.monotonic()
 
 
 class Client:
-    client = aiohttp.ClientSession(base_url=c.API_URL, timeout=aiohttp.ClientTimeout(5))
+    # Transport settings take effect when a pool is first used.
+    connector_kwargs = dict(limit=c.CONNECTION_LIMIT, limit_per_host=c.CONNECTION_LIMIT_PER_HOST,
+                            ttl_dns_cache=c.DNS_CACHE_TTL, keepalive_timeout=c.KEEPALIVE_TIMEOUT)
+    # Keep signed requests off the pool used by market data and analytics
+    separate_pools = True
+    sessions: Dict[str, aiohttp.ClientSession] = dict()
+    signers: Dict[tuple, utils.Signer] = dict()
+    scheduler = RequestScheduler()
 
     def __init__(self, api_key, api_secret_key, passphrase, use_server_time=False, test=False):
         self.API_KEY = api_key
@@ -15,107 +238,156 @@ class Client:
         self.PASSPHRASE = passphrase
         self.use_server_time = use_server_time
         self.test = test
+        self.pool = 'private' if api_key and self.separate_pools else 'public'
+        # Clients with the same credentials share one signer and clock offset.
+        credentials = (api_key, api_secret_key, passphrase, test)
+        if credentials not in Client.signers:
+            Client.signers[credentials] = utils.Signer(api_key, api_secret_key, passphrase, test)
+        self.signer = Client.signers[credentials]
+
+    @property
+    def client(self) -> aiohttp.ClientSession:
+        """Session of the connection pool shared by all clients of the same kind
+        """
+        session = Client.sessions.get(self.pool)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(**self.connector_kwargs)
+            session = aiohttp.ClientSession(base_url=c.API_URL, connector=connector,
+                                            timeout=aiohttp.ClientTimeout(c.REQUEST_TIMEOUT))
+            Client.sessions[self.pool] = session
+        return session
 
     async def aclose(self):
-        await self.client.close()
+        if (session := Client.sessions.pop(self.pool, None)) and not session.closed:
+            await session.close()
+
+    async def warm_up(self, connections=c.WARM_CONNECTIONS):
+        """Open `connections` keep-alive connections before they are needed
+        """
+
+        async def ping():
+            try:
+                async with self.client.get(c.SERVER_TIMESTAMP_URL) as response:
+                    await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+
+        await asyncio.gather(*[ping() for _ in range(connections)])
 
-    async def _get_timestamp(self):
-        url = c.SERVER_TIMESTAMP_URL
-        async with self.client.get(url) as response:
-            res_json = await response.json()
+    async def keep_warm(self, owner: asyncio.Task, connections=c.WARM_CONNECTIONS):
+        """Keep connections from idling out as long as `owner` is running
+        """
+        while not owner.done():
+            await asyncio.sleep(c.KEEPALIVE_TIMEOUT / 2)
+            await self.warm_up(connections)
+
+    async def _sync_clock(self):
+        """Estimate the offset between server and local clocks
+        """
+        if self.signer.syncing:
+            return
+        self.signer.syncing = True
+        try:
+            sent = time.time()
+            async with self.scheduler.slot(c.LANE_MARKET):
+                async with self.client.get(c.SERVER_TIMESTAMP_URL) as response:
+                    res_json = await response.json()
             if response.status == 200:
-                t = datetime.utcfromtimestamp(int(res_json['data'][0]['ts']) / 1000)
-                t = t.isoformat('T', 'milliseconds')
-                return t + 'Z'
-            else:
-                return ''
+                self.signer.update_offset(res_json['data'][0]['ts'], sent, time.time())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.signer.syncing = False
+
+    async def _send(self, method, request_path, body, lane):
+        """Send one request and read the response while holding a slot
+        """
+        async with self.scheduler.slot(lane):
+            # Signed after queueing, so the wait does not use up the timestamp window.
+            header = self.signer.header(method, request_path, body)
+            async with self.client.request(method, request_path, data=body or None, headers=header) as response:
+                return response.status, await response.text()
+
+    async def _request(self, method, request_path, params, lane=None, deadline=None, breaker=True):
+        """Send a request with retries
 
-    async def _request(self, method, request_path, params):
+        :param lane: Priority lane, inferred from `request_path` by default
+        :param deadline: Seconds to give up after
+        :param breaker: Fail fast while the endpoint is failing. Lookups that decide whether an order was placed
+            pass False and are always sent.
+        """
+        endpoint = request_path
+        if lane is None:
+            lane = request_lane(method, endpoint)
         if method == c.GET:
             request_path += utils.parse_params_to_str(params)
+        elif method not in (c.POST, c.DELETE):
+            raise ValueError
+        body = json.dumps(params) if method == c.POST else ''
+        # An order may be placed twice if it is resent after reaching the server.
+        idempotent = method != c.POST or endpoint not in c.NON_IDEMPOTENT
+        policy = RetryPolicy(deadline)
+        breaker = CircuitBreaker.of(method, endpoint) if breaker else \
+            CircuitBreaker(f'{method} {endpoint}', threshold=float('inf'))
 
-        success = False
-        retry = 0
-        backoff = 1
-        multiplier = 1.1
         # 处理网络异常
-        while not success and retry < 120:
+        while True:
+            breaker.check()
+            if self.use_server_time and time.time() - self.signer.synced_at > c.CLOCK_SYNC_INTERVAL:
+                # 校准服务器时间
+                await self._sync_clock()
             try:
-                # sign & header
-                if self.use_server_time:
-                    # 获取服务器时间
-                    timestamp = await self._get_timestamp()
-                else:
-                    # 获取本地时间
-                    timestamp = utils.get_timestamp()
-
-                body = json.dumps(params) if method == c.POST else ''
-                sign = utils.sign(utils.pre_hash(timestamp, method, request_path, str(body)), self.API_SECRET_KEY)
-                header = utils.get_header(self.API_KEY, sign.decode('utf8'), timestamp, self.PASSPHRASE)
-
-                if self.test:
-                    header['x-simulated-trading'] = '1'
-
-                # send request
-                if method == c.GET:
-                    try:
-                        response = await self.client.get(request_path, headers=header)
-                    except (aiohttp.ClientError, asyncio.TimeoutError):
-                        continue
-                elif method == c.POST:
-                    response = await self.client.post(request_path, data=body, headers=header)
-                elif method == c.DELETE:
-                    response = await self.client.delete(request_path, headers=header)
-                else:
-                    raise ValueError
+                status, text = await asyncio.wait_for(self._send(method, request_path, body, lane), policy.timeout())
+            except aiohttp.ClientConnectorError as e:
+                # Not sent at all
+                breaker.failure()
+                await policy.backoff(f'{endpoint} {e}')
+                continue
             except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                print(e)
-                await asyncio.sleep(backoff)
-                retry += 1
-                backoff *= multiplier
+                breaker.failure()
+                if not idempotent:
+                    raise exceptions.OkexRequestException(f'{endpoint} no response: {e!r}')
+                await policy.backoff(f'{endpoint} {e!r}')
+                continue
+
+            # Cloudflare error
+            if status >= 500:
+                breaker.failure()
+                if not idempotent:
+                    raise exceptions.OkexRequestException(f'{endpoint} server error {status}')
+                await policy.backoff(f'{endpoint} server error {status}')
                 continue
-            else:
-                async with response:
-                    status = response.status
-                    # Cloudflare error
-                    if str(status).startswith('5'):
-                        # print(response)
-                        retry += 1
-                        await asyncio.sleep(30)
-                        continue
-                    try:
-                        text = await response.text()
-                        json_res = await response.json()
-                    except ValueError:
-                        if 'cloudflare' in text:
-                            await asyncio.sleep(backoff)
-                            retry += 1
-                            backoff *= multiplier
-                            continue
-                        raise exceptions.OkexRequestException(f'Invalid Response: {text}')
-                    # Endpoint request timeout
-                    if json_res.get('code') == '50004':
-                        retry += 1
-                        await asyncio.sleep(2)
-                        continue
-                    # Requests too frequent
-                    if status == 429:
-                        retry += 1
-                        print(request_path, codes[json_res['code']])
-                        await asyncio.sleep(2)
-                        continue
-                    success = True
-
-                    # exception handle
-                    if not str(status).startswith('2'):
-                        print(type(json_res['code']), json_res['code'])
-                        print(f'Client error {status}: {request_path}')
-                        raise exceptions.OkexAPIException(status, text, json_res)
-
-        return json_res
-
-    async def _request_without_params(self, method, request_path):
-        return await self._request(method, request_path, {})
-
-    async def _request_with_params(self, method, request_path, params):
-        return await self._request(method, request_path, params)
+            try:
+                json_res = json.loads(text)
+            except ValueError:
+                if 'cloudflare' in text and idempotent:
+                    breaker.failure()
+                    await policy.backoff(f'{endpoint} cloudflare')
+                    continue
+                raise exceptions.OkexRequestException(f'Invalid Response: {text}')
+            # Endpoint request timeout
+            if json_res.get('code') == '50004':
+                breaker.failure()
+                if not idempotent:
+                    raise exceptions.OkexRequestException(f'{endpoint} {codes[json_res["code"]]}')
+                await policy.backoff(f'{endpoint} {codes[json_res["code"]]}')
+                continue
+            # Requests too frequent. Rejected requests are safe to resend.
+            if status == 429:
+                print(request_path, codes[json_res['code']])
+                await policy.backoff(f'{endpoint} {codes[json_res["code"]]}', minimum=1)
+                continue
+            breaker.success()
+
+            # exception handle
+            if not str(status).startswith('2'):
+                print(type(json_res['code']), json_res['code'])
+                print(f'Client error {status}: {request_path}')
+                raise exceptions.OkexAPIException(status, text, json_res)
+            return json_res
+
+    async def _request_without_params(self, method, request_path, lane=None, deadline=None, breaker=True):
+        return await self._request(method, request_path, {}, lane, deadline, breaker)
+
+    async def _request_with_params(self, method, request_path, params, lane=None, deadline=None, breaker=True):
+        return await self._request(method, request_path, params, lane, deadline, breaker)
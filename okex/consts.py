@@ -30,6 +30,7 @@ TRADE_FEE = '/api/v5/account/trade-fee'
 TRADE_ORDER = '/api/v5/trade/order'
 BATCH_ORDER = '/api/v5/trade/batch-orders'
 CANCEL_ORDER = '/api/v5/trade/cancel-order'
+AMEND_ORDER = '/api/v5/trade/amend-order'
 BATCH_CANCEL = '/api/v5/trade/cancel-batch-orders'
 PENDING_ORDER = '/api/v5/trade/orders-pending'
 ACCOUNT_CONFIG = '/api/v5/account/config'
@@ -46,3 +47,45 @@ ASSET_BALANCE = '/api/v5/asset/balances'
 ASSET_TRANSFER = '/api/v5/asset/transfer'
 
 SERVER_TIMESTAMP_URL = '/api/v5/public/time'
+PUBLIC_PATHS = ('/api/v5/public/', '/api/v5/market/')
+# Requests that must not be sent twice
+NON_IDEMPOTENT = (TRADE_ORDER, BATCH_ORDER, MARGIN_BALANCE, ASSET_TRANSFER)
+
+# Transport
+REQUEST_TIMEOUT = 5
+# Connections per pool
+CONNECTION_LIMIT = 64
+CONNECTION_LIMIT_PER_HOST = 64
+# Seconds to cache DNS lookups
+DNS_CACHE_TTL = 600
+# Seconds to keep idle connections open
+KEEPALIVE_TIMEOUT = 60
+# Connections opened ahead of trading
+WARM_CONNECTIONS = 4
+
+# REST request priority lanes, lower value is served first
+LANE_ORDER = 0
+LANE_ORDER_STATUS = 1
+LANE_ACCOUNT = 2
+LANE_MARKET = 3
+LANE_ANALYTICS = 4
+LANE_NAMES = ('order', 'order_status', 'account', 'market', 'analytics')
+# Concurrent requests allowed per lane
+LANE_LIMITS = (32, 32, 16, 16, 8)
+# Concurrent requests allowed in total
+REQUEST_LIMIT = 48
+
+# Retry policy
+MAX_RETRIES = 120
+# Backoff before the n-th retry is drawn from [0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** n)]
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 30
+# Consecutive failures before an endpoint fails fast
+BREAKER_THRESHOLD = 5
+# Seconds before a failing endpoint is tried again
+BREAKER_COOLDOWN = 30
+
+# Seconds between server clock synchronizations
+CLOCK_SYNC_INTERVAL = 300
+# Seconds to keep the lowest round trip clock sample
+CLOCK_SAMPLE_TTL = 3600
@@ -38,3 +38,13 @@ class OkexParamsException(OkexException):
 
     def __str__(self):
         return f'OkexParamsException: {self.message}'
+
+
+class OkexDeadlineException(OkexRequestException):
+    def __str__(self):
+        return f'OkexDeadlineException: {self.message}'
+
+
+class OkexCircuitOpenException(OkexRequestException):
+    def __str__(self):
+        return f'OkexCircuitOpenException: {self.message}'
@@ -1,14 +1,41 @@
 from .client import Client
 from .consts import *
+from .exceptions import OkexRequestException
 from src.codedict import codes
 from src.utils import REST_Semaphore, List
 import asyncio
+import uuid
 
 
 class TradeAPI(Client):
     def __init__(self, api_key, api_secret_key, passphrase, use_server_time=False, test=False):
         super(TradeAPI, self).__init__(api_key, api_secret_key, passphrase, use_server_time, test)
 
+    async def _place_order(self, params: dict, semaphore: REST_Semaphore) -> dict:
+        """下单，网络异常时按客户自定义订单ID查询，避免重复下单
+
+        :param params: 订单参数
+        :param semaphore: 限速
+        """
+        if not params['clOrdId']:
+            params['clOrdId'] = uuid.uuid4().hex
+        try:
+            async with semaphore:
+                order = await self._request_with_params(POST, TRADE_ORDER, params)
+        except OkexRequestException:
+            # The order may have reached the exchange.
+            # Not blocked by the breaker, otherwise a filled leg could be taken as failed and left unhedged.
+            res = await self._request_with_params(GET, TRADE_ORDER, dict(clOrdId=params['clOrdId'],
+                                                                         instId=params['instId']), breaker=False)
+            if res['code'] == '0' and res['data']:
+                return res['data'][0]
+            raise
+        if order['code'] == '0':
+            return order['data'][0]
+        else:
+            code = order['data'][0]['sCode']
+            return dict(ordId='-1', code=code, msg=codes[code])
+
     SPOT_MARGIN_SEMAPHORE = REST_Semaphore(60, 2)
 
     async def take_spot_order(self, instId, side, order_type, size, price='', tgtCcy='', client_oid='') -> dict:
@@ -29,13 +56,7 @@ class TradeAPI(Client):
         """
         params = dict(instId=instId, tdMode='cash', side=side, ordType=order_type, sz=size, px=price, tgtCcy=tgtCcy,
                       clOrdId=client_oid)
-        async with self.SPOT_MARGIN_SEMAPHORE:
-            order = await self._request_with_params(POST, TRADE_ORDER, params)
-        if order['code'] == '0':
-            return order['data'][0]
-        else:
-            code = order['data'][0]['sCode']
-            return dict(ordId='-1', code=code, msg=codes[code])
+        return await self._place_order(params, self.SPOT_MARGIN_SEMAPHORE)
 
     async def take_margin_order(self, instId, side, order_type, size, price='', client_oid='',
                                 reduceOnly=False) -> dict:
@@ -56,13 +77,7 @@ class TradeAPI(Client):
         """
         params = dict(instId=instId, tdMode='cross', ccy='USDT', side=side, ordType=order_type, sz=size, px=price,
                       clOrdId=client_oid, reduceOnly=reduceOnly)
-        async with self.SPOT_MARGIN_SEMAPHORE:
-            order = await self._request_with_params(POST, TRADE_ORDER, params)
-        if order['code'] == '0':
-            return order['data'][0]
-        else:
-            code = order['data'][0]['sCode']
-            return dict(ordId='-1', code=code, msg=codes[code])
+        return await self._place_order(params, self.SPOT_MARGIN_SEMAPHORE)
 
     DERIVATIVE_SEMAPHORE = REST_Semaphore(60, 2)
 
@@ -84,13 +99,7 @@ class TradeAPI(Client):
         """
         params = dict(instId=instId, tdMode='isolated', ccy='USDT', side=side, ordType=order_type, sz=size, px=price,
                       clOrdId=client_oid, reduceOnly=reduceOnly)
-        async with self.DERIVATIVE_SEMAPHORE:
-            order = await self._request_with_params(POST, TRADE_ORDER, params)
-        if order['code'] == '0':
-            return order['data'][0]
-        else:
-            code = order['data'][0]['sCode']
-            return dict(ordId='-1', code=code, msg=codes[code])
+        return await self._place_order(params, self.DERIVATIVE_SEMAPHORE)
 
     BATCH_ORDER_SEMAPHORE = REST_Semaphore(15, 2)
 
@@ -132,7 +141,8 @@ class TradeAPI(Client):
         orders = []
         for task in tasks:
             batch = await task
-            assert batch['code'] == '0', f"{BATCH_ORDER}, msg={codes[batch['code']]}"
+            # 全部或部分失败时各订单的sCode、sMsg仍在data中
+            assert batch['code'] in ('0', '1', '2') and batch['data'], f"{BATCH_ORDER}, msg={codes[batch['code']]}"
             # if batch['code'] != '0':
             #     for order in batch['data']:
             #         print(order)
@@ -141,7 +151,7 @@ class TradeAPI(Client):
 
     ORDER_INFO_SEMAPHORE = REST_Semaphore(60, 2)
 
-    async def get_order_info(self, instId, order_id='', client_oid='') -> dict:
+    async def get_order_info(self, instId, order_id='', client_oid='', deadline=None) -> dict:
         """获取订单信息
 
         GET /api/v5/trade/order 限速： 60次/2s
@@ -149,11 +159,12 @@ class TradeAPI(Client):
         :param instId: 产品ID
         :param order_id: 订单ID
         :param client_oid: 用户自定义ID
+        :param deadline: 超时秒数
         """
         assert order_id or client_oid
         params = dict(ordId=order_id, instId=instId) if order_id else dict(clOrdId=client_oid, instId=instId)
         async with self.ORDER_INFO_SEMAPHORE:
-            res = await self._request_with_params(GET, TRADE_ORDER, params)
+            res = await self._request_with_params(GET, TRADE_ORDER, params, deadline=deadline)
         assert res['code'] == '0', f"{TRADE_ORDER}, msg={codes[res['code']]}"
         return res['data'][0]
 
@@ -178,6 +189,33 @@ class TradeAPI(Client):
             code = order['data'][0]['sCode']
             return dict(ordId='-1', code=code, msg=codes[code])
 
+    AMEND_ORDER_SEMAPHORE = REST_Semaphore(60, 2)
+
+    async def amend_order(self, instId, order_id='', client_oid='', new_size='', new_price='',
+                          cxlOnFail=False) -> dict:
+        """修改当前未成交的挂单
+
+        POST /api/v5/trade/amend-order 限速： 60次/2s
+
+        :param instId: 产品ID
+        :param order_id: 订单ID
+        :param client_oid: 用户自定义ID
+        :param new_size: 修改的新数量，包括已成交数量
+        :param new_price: 修改的新价格
+        :param cxlOnFail: 修改失败时是否自动撤单
+        """
+        assert order_id or client_oid
+        assert new_size or new_price
+        params = dict(ordId=order_id, instId=instId) if order_id else dict(clOrdId=client_oid, instId=instId)
+        params.update(newSz=new_size, newPx=new_price, cxlOnFail=cxlOnFail)
+        async with self.AMEND_ORDER_SEMAPHORE:
+            order = await self._request_with_params(POST, AMEND_ORDER, params)
+        if order['code'] == '0':
+            return order['data'][0]
+        else:
+            code = order['data'][0]['sCode']
+            return dict(ordId='-1', code=code, msg=codes[code])
+
     BATCH_CANCEL_SEMAPHORE = REST_Semaphore(15, 2)
 
     async def batch_cancel(self, orders: List[dict]) -> List[dict]:
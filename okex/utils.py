@@ -1,6 +1,7 @@
 import hmac
 import base64
 import datetime
+import time
 from . import consts as c
 
 
@@ -41,3 +42,70 @@ def signature(timestamp, method, request_path, body, secret_key):
     mac = hmac.new(bytes(secret_key, encoding='utf8'), bytes(message, encoding='utf-8'), digestmod='sha256')
     d = mac.digest()
     return base64.b64encode(d)
+
+
+class Signer:
+    """Request signing with one set of credentials
+    """
+
+    def __init__(self, api_key, secret_key, passphrase, test=False):
+        # HMAC state with the key already absorbed
+        self._mac = hmac.new(bytes(secret_key, encoding='utf8'), digestmod='sha256')
+        self._header = {
+            c.CONTENT_TYPE: c.APPLICATION_JSON,
+            c.OK_ACCESS_KEY: api_key,
+            c.OK_ACCESS_PASSPHRASE: passphrase
+        }
+        self._public_header = {c.CONTENT_TYPE: c.APPLICATION_JSON}
+        if test:
+            self._header['x-simulated-trading'] = '1'
+            self._public_header['x-simulated-trading'] = '1'
+        self.public = not api_key
+        self.syncing = False
+        # Server clock minus local clock in seconds
+        self.offset = 0.
+        # Round trip of the best clock sample
+        self.rtt = float('inf')
+        # Local time of the best clock sample
+        self.sampled_at = 0.
+        self.synced_at = 0.
+        self._second = -1
+        self._prefix = ''
+
+    def sign(self, message: str) -> str:
+        mac = self._mac.copy()
+        mac.update(bytes(message, encoding='utf8'))
+        return base64.b64encode(mac.digest()).decode('utf8')
+
+    def timestamp(self) -> str:
+        """ISO 8601 timestamp in milliseconds, corrected by the clock offset
+        """
+        millisecs = int((time.time() + self.offset) * 1000)
+        second, millisec = divmod(millisecs, 1000)
+        if second != self._second:
+            self._second = second
+            self._prefix = time.strftime('%Y-%m-%dT%H:%M:%S.', time.gmtime(second))
+        return f'{self._prefix}{millisec:03d}Z'
+
+    def header(self, method, request_path, body='') -> dict:
+        # Public endpoints need no signature.
+        if self.public or request_path.startswith(c.PUBLIC_PATHS):
+            return self._public_header.copy()
+        timestamp = self.timestamp()
+        header = self._header.copy()
+        header[c.OK_ACCESS_SIGN] = self.sign(f'{timestamp}{method}{request_path}{body}')
+        header[c.OK_ACCESS_TIMESTAMP] = timestamp
+        return header
+
+    def update_offset(self, server_millisecs, sent, received):
+        """Estimate the clock offset from a server timestamp taken between `sent` and `received`
+
+        Samples with a shorter round trip are more accurate and replace the current estimate.
+        An estimate older than `CLOCK_SAMPLE_TTL` is replaced regardless, as the clocks drift apart.
+        """
+        rtt = received - sent
+        if rtt <= self.rtt or received - self.sampled_at > c.CLOCK_SAMPLE_TTL:
+            self.offset = int(server_millisecs) / 1000 - (sent + received) / 2
+            self.rtt = rtt
+            self.sampled_at = received
+        self.synced_at = received
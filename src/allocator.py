@@ -0,0 +1,48 @@
+from typing import Dict
+
+
+class USDTAllocator:
+    """同时建仓多个币种时在进程内按权重预留USDT，避免各币种争用同一余额
+    """
+
+    def __init__(self, total: float, weights: Dict[str, float]):
+        """
+        :param total: 总USDT
+        :param weights: {币种: 权重}
+        """
+        weight = sum(weights.values())
+        self.weights = {coin: w / weight for coin, w in weights.items()}
+        # 已预留给各币种的USDT
+        self.reserved = {coin: total * w for coin, w in self.weights.items()}
+        # 重新分配后尚未被领取的USDT
+        self.extra = dict.fromkeys(weights, 0.)
+        self.active = set(weights)
+
+    def take_extra(self, coin: str) -> float:
+        """领取重新分配给币种的USDT
+
+        :param coin: 币种
+        :return: 新增预算
+        """
+        extra = self.extra[coin]
+        if extra:
+            self.extra[coin] = 0.
+            self.reserved[coin] += extra
+        return extra
+
+    def release(self, coin: str, used: float) -> float:
+        """币种建仓结束，未用完的预算按权重分给仍在建仓的币种
+
+        :param coin: 币种
+        :param used: 实际使用的USDT
+        :return: 退回的USDT
+        """
+        self.active.discard(coin)
+        unused = max(self.reserved[coin] + self.extra[coin] - used, 0.)
+        self.reserved[coin] = used
+        self.extra[coin] = 0.
+        weight = sum(self.weights[n] for n in self.active)
+        if unused and weight:
+            for n in self.active:
+                self.extra[n] += unused * self.weights[n] / weight
+        return unused
@@ -0,0 +1,128 @@
+import numpy as np
+import src.record as record
+from src.utils import *
+
+
+def load_premiums(coins: List[str], days=30) -> Dict[str, dict]:
+    """从Ticker读取期现差价序列
+
+    :param coins: 币种列表
+    :param days: 最近几天
+    :return: {币种: dict(timestamp=秒, open_pd, close_pd)}，按时间排序的数组
+    """
+    Ticker = record.Record('Ticker')
+    begin = datetime.utcnow() - timedelta(days=days)
+    res = dict()
+    for coin in coins:
+        cursor = Ticker.mycol.find({'instrument': coin, 'timestamp': {'$gt': begin}},
+                                   {'_id': 0, 'timestamp': 1, 'open_pd': 1, 'close_pd': 1}).sort('timestamp', 1)
+        rows = [(n['timestamp'].replace(tzinfo=timezone.utc).timestamp(), n['open_pd'], n['close_pd']) for n in cursor]
+        if rows:
+            timestamp, open_pd, close_pd = np.asarray(rows, dtype=np.float64).T
+            res[coin] = dict(timestamp=timestamp, open_pd=open_pd, close_pd=close_pd)
+    return res
+
+
+def rolling_stat(timestamp: np.ndarray, values: np.ndarray, hours: float):
+    """每个时刻之前hours小时内（含该时刻）的均值和样本标准差，与recent_open_stat相同
+
+    :param timestamp: 秒，递增
+    :param values: 数值
+    :param hours: 窗口小时数
+    :return: 均值, 标准差, 样本数
+    """
+    first = np.searchsorted(timestamp, timestamp - hours * 3600, side='right')
+    # 减去整体均值减小累加误差
+    centered = values - values.mean()
+    s1 = np.concatenate(([0.], np.cumsum(centered)))
+    s2 = np.concatenate(([0.], np.cumsum(centered * centered)))
+    last = np.arange(1, len(values) + 1)
+    count = last - first
+    total = s1[last] - s1[first]
+    mean = total / count
+    var = (s2[last] - s2[first] - total * mean) / np.maximum(count - 1, 1)
+    return mean + values.mean(), np.sqrt(np.maximum(var, 0.)), count
+
+
+def backtest(timestamp: np.ndarray, values: np.ndarray, close=False, sigma=2., lookback=2., accelerate_after=2.,
+             accelerate_sigma=2., chunk=0.1, fee=0.0015, every=1., max_hours=24.) -> dict:
+    """按add、reduce的阈值逻辑向量化回测：每隔every小时开始一次建仓或减仓，
+    开始时阈值为近lookback小时均值加减sigma倍标准差，之后每accelerate_after小时按近accelerate_after小时
+    均值加减accelerate_sigma倍标准差重设。期现差价扣除手续费后满足阈值的每个记录成交chunk，
+    成交1 / chunk次即完成，max_hours小时后未完成的按未完成计。
+
+    :param timestamp: 秒，递增
+    :param values: open_pd或close_pd
+    :param close: 减仓，期现差价不高于阈值时成交
+    :param sigma: 开始时的标准差倍数
+    :param lookback: 开始时统计的小时数
+    :param accelerate_after: 重设阈值的间隔小时数，0为不重设
+    :param accelerate_sigma: 重设阈值的标准差倍数
+    :param chunk: 每次成交占目标数量的比例
+    :param fee: 期现两腿吃单手续费率
+    :param every: 相邻两次开始的间隔小时数
+    :param max_hours: 每次最长小时数
+    :return: dict(episodes=次数, completed=完成比例, fills=平均成交次数, premium=成交时平均期现差价,
+        net=扣除手续费后的平均收益率, hours=完成的平均小时数, median_hours=完成的小时数中位数)
+    """
+    sign = -1. if close else 1.
+    y = sign * values
+    n = len(y)
+    fills_needed = int(np.ceil(1 / chunk - 1e-9))
+    # 每次开始的位置，需要lookback小时的历史
+    starts = np.arange(timestamp[0] + lookback * 3600, timestamp[-1], every * 3600)
+    starts = np.unique(np.searchsorted(timestamp, starts))
+    starts = starts[starts < n]
+    if not len(starts):
+        return dict(episodes=0, completed=0., fills=0., premium=0., net=0., hours=0., median_hours=0.)
+
+    # 各阶段的阈值 [次数, 阶段]
+    mean, std, _ = rolling_stat(timestamp, y, lookback)
+    stages = int(max_hours // accelerate_after) + 1 if accelerate_after else 1
+    threshold = np.empty((len(starts), stages))
+    threshold[:, 0] = mean[starts] + sigma * std[starts]
+    if stages > 1:
+        mean, std, _ = rolling_stat(timestamp, y, accelerate_after)
+        boundaries = timestamp[starts][:, None] + np.arange(1, stages) * accelerate_after * 3600
+        at = np.minimum(np.searchsorted(timestamp, boundaries), n - 1)
+        threshold[:, 1:] = mean[at] + accelerate_sigma * std[at]
+
+    # [次数, 记录]，窗口长度取各次max_hours内记录数的最大值
+    ends = np.searchsorted(timestamp, timestamp[starts] + max_hours * 3600, side='right')
+    length = int((ends - starts).max())
+    index = starts[:, None] + np.arange(length)
+    valid = index < n
+    index = np.minimum(index, n - 1)
+    elapsed = timestamp[index] - timestamp[starts][:, None]
+    valid &= elapsed <= max_hours * 3600
+    stage = np.minimum((elapsed // (accelerate_after * 3600)).astype(np.int64), stages - 1) if stages > 1 else 0
+    limit = np.take_along_axis(threshold, stage, axis=1) if stages > 1 else threshold
+    qualified = valid & (y[index] - fee >= limit)
+
+    # 每个满足阈值的记录成交一次，直到成交次数达到目标
+    count = np.cumsum(qualified, axis=1)
+    filled = qualified & (count <= fills_needed)
+    fills = filled.sum(axis=1)
+    completed = fills == fills_needed
+    done_at = np.argmax(count >= fills_needed, axis=1)
+    hours = (elapsed[np.arange(len(starts)), done_at] / 3600)[completed]
+    total = filled.sum()
+    premium = sign * (y[index] * filled).sum() / total if total else 0.
+    return dict(episodes=len(starts), completed=float(completed.mean()), fills=float(fills.mean()),
+                premium=float(premium), net=float(sign * premium - fee) if total else 0.,
+                hours=float(hours.mean()) if len(hours) else float('nan'),
+                median_hours=float(np.median(hours)) if len(hours) else float('nan'))
+
+
+def backtest_coins(coins: List[str], days=30, close=False, **kwargs) -> Dict[str, dict]:
+    """回测多个币种
+
+    :param coins: 币种列表
+    :param days: 最近几天
+    :param close: 减仓
+    :param kwargs: backtest的参数
+    """
+    res = dict()
+    for coin, series in load_premiums(coins, days).items():
+        res[coin] = backtest(series['timestamp'], series['close_pd' if close else 'open_pd'], close, **kwargs)
+    return res
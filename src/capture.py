@@ -0,0 +1,255 @@
+import json
+import os
+import struct
+import zlib
+from okex.exceptions import OkexRequestException
+from okex.public import PublicAPI
+from src.websocket import subscribe_raw
+from src.utils import *
+
+# 数据块头：标识、压缩后长度、压缩前长度、推送数、首条接收时间ns、末条接收时间ns
+CHUNK_HEADER = struct.Struct('<4sIIIqq')
+CHUNK_MAGIC = b'OKXC'
+# 块内每条推送：接收时间ns、长度，其后为原始推送的UTF-8文本
+FRAME_HEADER = struct.Struct('<qI')
+HOUR_NS = 3600 * 10 ** 9
+
+
+def hour_name(ts: int) -> str:
+    """接收时间所在的UTC小时，即文件名
+
+    :param ts: 接收时间ns
+    """
+    return datetime.utcfromtimestamp(ts // 10 ** 9).strftime('%Y%m%d%H')
+
+
+def frame_instrument(frame: str) -> str:
+    """不解析JSON取出推送的instId
+    """
+    begin = frame.find('"instId":')
+    if begin == -1:
+        return ''
+    begin = frame.find('"', begin + 9) + 1
+    return frame[begin:frame.find('"', begin)]
+
+
+class CaptureWriter:
+    """把原始推送按UTC小时追加写入压缩数据块，每小时一个数据文件(.cap)和一个索引文件(.idx)。
+    内存中只保留一个未压缩的数据块，满chunk_bytes字节或chunk_seconds秒后压缩写入。
+    索引每行对应一个数据块：偏移、长度、时间范围和各instId的推送数。
+    索引写在数据块之后，中断时未写完的数据块没有索引，读取时忽略。
+    """
+    chunk_bytes = 1 << 20
+    chunk_seconds = 1.
+    # zlib压缩等级，1最快
+    level = 1
+
+    def __init__(self, path='capture'):
+        """
+        :param path: 目录
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.hour = ''
+        self.data = None
+        self.index = None
+        self.buffer = bytearray()
+        self.instruments: Dict[str, int] = dict()
+        self.frames = 0
+        self.first = self.last = 0
+        self.begin = time.monotonic()
+        # 累计推送数、接收字节数和写入字节数
+        self.total_frames = self.bytes_in = self.bytes_out = 0
+
+    def open(self, hour: str):
+        self.close()
+        self.hour = hour
+        self.data = open(os.path.join(self.path, hour + '.cap'), 'ab')
+        self.index = open(os.path.join(self.path, hour + '.idx'), 'a', encoding='utf-8')
+
+    def append(self, ts: int, frame: str):
+        """追加一条推送
+
+        :param ts: 接收时间ns
+        :param frame: 原始推送
+        """
+        if ts // HOUR_NS != self.last // HOUR_NS or not self.hour:
+            self.flush()
+            self.open(hour_name(ts))
+        raw = frame.encode()
+        if not self.frames:
+            self.first = ts
+            self.begin = time.monotonic()
+        self.last = ts
+        self.buffer += FRAME_HEADER.pack(ts, len(raw))
+        self.buffer += raw
+        self.frames += 1
+        instId = frame_instrument(frame)
+        self.instruments[instId] = self.instruments.get(instId, 0) + 1
+        self.total_frames += 1
+        self.bytes_in += len(raw)
+        if len(self.buffer) >= self.chunk_bytes or time.monotonic() - self.begin >= self.chunk_seconds:
+            self.flush()
+
+    def flush(self):
+        """压缩并写入当前数据块及其索引
+        """
+        if not self.frames:
+            return
+        compressed = zlib.compress(self.buffer, self.level)
+        offset = self.data.tell()
+        self.data.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(compressed), len(self.buffer), self.frames,
+                                          self.first, self.last))
+        self.data.write(compressed)
+        self.data.flush()
+        self.index.write(json.dumps(dict(offset=offset, length=CHUNK_HEADER.size + len(compressed), first=self.first,
+                                         last=self.last, frames=self.frames, instruments=self.instruments),
+                                    separators=(',', ':')) + '\n')
+        self.index.flush()
+        self.bytes_out += CHUNK_HEADER.size + len(compressed)
+        self.buffer = bytearray()
+        self.instruments = dict()
+        self.frames = 0
+
+    def close(self):
+        self.flush()
+        if self.data:
+            self.data.close()
+            self.index.close()
+            self.data = self.index = None
+
+
+class CaptureReader:
+    """按时间和instId读取CaptureWriter写入的推送
+    """
+
+    def __init__(self, path='capture'):
+        """
+        :param path: 目录
+        """
+        self.path = path
+
+    def hours(self, begin=0, end=0) -> List[str]:
+        """时间范围内已有的小时文件名
+
+        :param begin: 开始时间ns
+        :param end: 结束时间ns，0为不限
+        """
+        hours = sorted(n[:-4] for n in os.listdir(self.path) if n.endswith('.idx'))
+        first = hour_name(begin) if begin else ''
+        last = hour_name(end) if end else '9'
+        return [n for n in hours if first <= n <= last]
+
+    def chunks(self, hour: str, instruments=None, begin=0, end=0) -> List[dict]:
+        """小时内包含指定instId且与时间范围重叠的数据块索引
+
+        :param hour: 小时文件名
+        :param instruments: instId集合，None为全部
+        :param begin: 开始时间ns
+        :param end: 结束时间ns，0为不限
+        """
+        res = []
+        with open(os.path.join(self.path, hour + '.idx'), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    chunk = json.loads(line)
+                except json.JSONDecodeError:
+                    # 写入中断的最后一行
+                    break
+                if chunk['last'] < begin or end and chunk['first'] > end:
+                    continue
+                if instruments is None or not instruments.isdisjoint(chunk['instruments']):
+                    res.append(chunk)
+        return res
+
+    def frames(self, begin=0, end=0, instruments=None):
+        """按接收顺序读取推送
+
+        :param begin: 开始时间ns
+        :param end: 结束时间ns，0为不限
+        :param instruments: instId列表，None为全部
+        :return: (接收时间ns, 原始推送)
+        """
+        instruments = set(instruments) if instruments is not None else None
+        for hour in self.hours(begin, end):
+            with open(os.path.join(self.path, hour + '.cap'), 'rb') as f:
+                for chunk in self.chunks(hour, instruments, begin, end):
+                    f.seek(chunk['offset'])
+                    magic, length, size, count, first, last = CHUNK_HEADER.unpack(f.read(CHUNK_HEADER.size))
+                    assert magic == CHUNK_MAGIC
+                    buffer = zlib.decompress(f.read(length))
+                    view = memoryview(buffer)
+                    position = 0
+                    for _ in range(count):
+                        ts, n = FRAME_HEADER.unpack_from(buffer, position)
+                        position += FRAME_HEADER.size
+                        frame = str(view[position:position + n], 'utf-8')
+                        position += n
+                        if ts < begin or end and ts > end:
+                            continue
+                        if instruments is None or frame_instrument(frame) in instruments:
+                            yield ts, frame
+
+
+capturing = False
+
+
+def capture_market(path='capture'):
+    """在单独进程中运行行情采集
+    """
+    global capturing
+    if not capturing:
+        capturing = True
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                loop.run_until_complete(capture(path))
+            except (aiohttp.ClientError, OkexRequestException):
+                print(lang.network_interruption)
+                time.sleep(30)
+
+
+async def capture(path='capture', url='wss://ws.okx.com:8443/ws/v5/public', report=60):
+    """采集全部USDT永续合约及对应现货的tickers、books、bbo-tbt和资金费率原始推送
+
+    :param path: 目录
+    :param url: 公共频道地址
+    :param report: 输出采集速率的间隔秒数
+    """
+    print(lang.capture_market.format(os.path.abspath(path)))
+    publicAPI = PublicAPI()
+    swaps = [n['instId'] for n in await publicAPI.get_instruments('SWAP') if n['instId'].find('-USDT-') != -1]
+    await publicAPI.aclose()
+    instruments = swaps + [n[:n.find('-SWAP')] for n in swaps]
+    # 每种频道一个连接
+    subscriptions = [[dict(channel=channel, instId=n) for n in instruments]
+                     for channel in ('tickers', 'books', 'bbo-tbt')]
+    subscriptions.append([dict(channel='funding-rate', instId=n) for n in swaps])
+
+    writer = CaptureWriter(path)
+    queue = asyncio.Queue(maxsize=10000)
+
+    async def receive(channels):
+        async for item in subscribe_raw(url, channels):
+            await queue.put(item)
+
+    tasks = [asyncio.create_task(receive(n)) for n in subscriptions]
+    begin = time.monotonic()
+    frames, bytes_in, bytes_out = 0, 0, 0
+    try:
+        while True:
+            try:
+                ts, frame = await asyncio.wait_for(queue.get(), timeout=writer.chunk_seconds)
+                writer.append(ts, frame)
+            except asyncio.TimeoutError:
+                writer.flush()
+            if (elapsed := time.monotonic() - begin) >= report:
+                print(lang.capture_rate.format((writer.total_frames - frames) / elapsed,
+                                               (writer.bytes_in - bytes_in) / elapsed / 1024,
+                                               (writer.bytes_out - bytes_out) / elapsed / 1024))
+                begin = time.monotonic()
+                frames, bytes_in, bytes_out = writer.total_frames, writer.bytes_in, writer.bytes_out
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
@@ -0,0 +1,166 @@
+import itertools
+import numpy as np
+from okex.exceptions import OkexRequestException
+from src.funding_rate import FundingRate
+from src.trading_data import candle_matrix, true_range_matrix, Stat
+from src.utils import *
+
+DAY_MS = 86400 * 1000
+BAR_MS = dict(m=60 * 1000, H=3600 * 1000, D=DAY_MS)
+# 默认规则网格：统计天数、波动率指数(0为只看资金费，0.5即show_profitable_rate的除以sqrt(ATR))、持有币种数、调仓间隔天数
+LOOKBACKS = (1, 3, 7, 14, 30)
+EXPONENTS = (0., 0.5, 1.)
+TOP_NS = (1, 3, 5, 10, 20)
+REBALANCES = (1, 3, 7, 14)
+
+
+async def load_carry_data(fundingRate: FundingRate, days=90, bar='4H') -> dict:
+    """下载全部USDT永续合约最近days天资金费及现货K线
+
+    :param fundingRate: FundingRate实例
+    :param days: 天数
+    :param bar: K线粒度
+    :return: dict(instruments=币种, times=结算时间ms, funding=资金费矩阵, bars=K线收盘时间ms, candles=K线矩阵)
+    """
+    await fundingRate.load_history(days)
+    times = FundingRate.history_times
+    first = np.searchsorted(times, times[-1] - days * DAY_MS, side='right') if len(times) else 0
+    times, funding = times[first:], FundingRate.history[:, first:]
+    instruments = [n[:n.find('-')] for n in FundingRate.history_ids]
+    stat = Stat()
+
+    async def spot_candles(coin):
+        try:
+            return await stat.get_candles(coin + '-USDT', days, bar)
+        except OkexRequestException:
+            # 没有现货
+            return []
+
+    bars, candles = candle_matrix(await asyncio.gather(*[spot_candles(n) for n in instruments]))
+    return dict(instruments=instruments, times=times, funding=funding,
+                bars=bars + int(bar[:-1]) * BAR_MS[bar[-1]], candles=candles)
+
+
+def window_mean(values: np.ndarray, stamps: np.ndarray, times: np.ndarray, window: int):
+    """每个时刻之前window ms内（含该时刻）每行非NaN值的均值
+
+    :param values: 行 x 列
+    :param stamps: 各列时间ms，递增
+    :param times: 计算的时刻ms
+    :param window: 窗口ms
+    :return: 均值矩阵, 个数矩阵
+    """
+    valid = ~np.isnan(values)
+    total = np.concatenate((np.zeros((len(values), 1)), np.cumsum(np.where(valid, values, 0.), axis=1)), axis=1)
+    count = np.concatenate((np.zeros((len(values), 1)), np.cumsum(valid, axis=1)), axis=1)
+    last = np.searchsorted(stamps, times, side='right')
+    first = np.searchsorted(stamps, times - window, side='right')
+    count = count[:, last] - count[:, first]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (total[:, last] - total[:, first]) / count, count
+
+
+def carry_scores(data: dict, lookback: float, exponent: float) -> np.ndarray:
+    """每次结算后各币种的排名分数：近lookback天平均资金费除以平均相对振幅的exponent次方。
+    上线不足lookback天、没有K线或平均资金费不为正的为NaN
+
+    :param data: load_carry_data的返回值
+    :param lookback: 统计天数
+    :param exponent: 波动率指数
+    :return: 币种 x 结算时间
+    """
+    times, funding = data['times'], data['funding']
+    window = int(lookback * DAY_MS)
+    mean, _ = window_mean(funding, times, times, window)
+    # 最早的资金费记录之前未上线，或者超出下载范围
+    listed = times[np.argmax(~np.isnan(funding), axis=1)]
+    mean[listed[:, None] > times[None, :] - window] = np.nan
+    if exponent:
+        atr, count = window_mean(true_range_matrix(data['candles']), data['bars'], times, window)
+        with np.errstate(divide='ignore'):
+            mean = mean / atr ** exponent
+        mean[count == 0] = np.nan
+    mean[~(mean > 0)] = np.nan
+    return mean
+
+
+def carry_backtest(data: dict, lookbacks=LOOKBACKS, exponents=EXPONENTS, top_ns=TOP_NS, rebalances=REBALANCES,
+                   fee=0.0015) -> List[dict]:
+    """回测定期按分数选前N个币种等权持有期现套利仓位的资金费收益。各规则从同一时刻开始，
+    调仓时按权重变化收取开平仓成本，结束时全部平仓。收益均为占仓位价值的比例
+
+    :param data: load_carry_data的返回值
+    :param lookbacks: 统计天数
+    :param exponents: 波动率指数
+    :param top_ns: 持有币种数
+    :param rebalances: 调仓间隔天数
+    :param fee: 开仓或平仓单位仓位价值的成本，期现两腿吃单手续费
+    :return: 每个规则一个dict(lookback, exponent, top_n, rebalance, carry=资金费收益, cost=开平仓成本, net=净收益,
+        apr=年化净收益, turnover=累计换手, drawdown=最大回撤, holdings=平均持有币种数)
+    """
+    times, funding = data['times'], np.nan_to_num(data['funding'])
+    begin = np.searchsorted(times, times[0] + max(lookbacks) * DAY_MS) if len(times) else 0
+    if begin >= len(times) - 1:
+        return []
+    days = (times[-1] - times[begin]) / DAY_MS
+    top_ns = np.asarray(top_ns)
+    res = []
+    for lookback, exponent in itertools.product(lookbacks, exponents):
+        score = carry_scores(data, lookback, exponent)[:, begin:]
+        # 各结算时间的名次，0为最高
+        order = np.argsort(-np.nan_to_num(score, nan=-np.inf), axis=0, kind='stable')
+        rank = np.empty_like(order)
+        np.put_along_axis(rank, order, np.arange(len(score))[:, None], axis=0)
+        # [N, 币种, 结算时间] 等权权重
+        selected = (rank[None] < top_ns[:, None, None]) & ~np.isnan(score)[None]
+        weights = selected / np.maximum(selected.sum(axis=1, keepdims=True), 1)
+        for rebalance in rebalances:
+            # 调仓的列，第i列收取的资金费按此前最近一次调仓的权重
+            columns = np.unique(np.searchsorted(times[begin:], times[begin] + np.arange(0, days, rebalance) * DAY_MS))
+            held = weights[:, :, columns[np.searchsorted(columns, np.arange(1, len(times) - begin)) - 1]]
+            carry = (held * funding[None, :, begin + 1:]).sum(axis=1)
+            # 调仓及最后平仓的权重变化
+            path = np.concatenate((np.zeros(weights.shape[:2] + (1,)), weights[:, :, columns],
+                                   np.zeros(weights.shape[:2] + (1,))), axis=2)
+            turnover = np.abs(np.diff(path, axis=2)).sum(axis=1)
+            # 每列结算后的开平仓成本，第0列为开仓
+            cost = np.zeros((len(top_ns), len(times) - begin))
+            np.add.at(cost.T, columns, fee * turnover[:, :-1].T)
+            cost[:, -1] += fee * turnover[:, -1]
+            equity = np.cumsum(np.concatenate((np.zeros((len(top_ns), 1)), carry), axis=1) - cost, axis=1)
+            drawdown = (np.maximum.accumulate(np.maximum(equity, 0.), axis=1) - equity).max(axis=1)
+            holdings = (held > 0).sum(axis=1).mean(axis=1)
+            for j, top_n in enumerate(top_ns):
+                res.append(dict(lookback=lookback, exponent=exponent, top_n=int(top_n), rebalance=rebalance,
+                                carry=float(carry[j].sum()), cost=float(cost[j].sum()), net=float(equity[j, -1]),
+                                apr=float(equity[j, -1] / days * 365), turnover=float(turnover[j].sum()),
+                                drawdown=float(drawdown[j]), holdings=float(holdings[j])))
+    res.sort(key=lambda n: n['net'], reverse=True)
+    return res
+
+
+def format_rule(n: dict) -> str:
+    return (f"{n['lookback']:5g}{n['exponent']:6.1f}{n['top_n']:5d}{n['rebalance']:6g}{n['carry']:9.2%}"
+            f"{n['cost']:8.2%}{n['net']:9.2%}{n['apr']:9.2%}{n['turnover']:9.1f}{n['drawdown']:9.2%}")
+
+
+async def show_carry_backtest(fundingRate: FundingRate, days=90, top=10):
+    """回测资金费套利选币规则，输出最好的规则和当前show_profitable_rate的规则
+
+    :param fundingRate: FundingRate实例
+    :param days: 天数
+    :param top: 输出的规则数
+    """
+    data = await load_carry_data(fundingRate, days)
+    begin = time.perf_counter()
+    res = carry_backtest(data)
+    fprint(lang.carry_backtest.format(len(data['instruments']), len(data['times']), len(res),
+                                      time.perf_counter() - begin))
+    fprint(lang.carry_header)
+    for n in res[:top]:
+        fprint(format_rule(n))
+    # 菜单默认统计7天，除以sqrt(ATR)，显示前十
+    fprint(lang.carry_current)
+    for n in res:
+        if n['lookback'] == 7 and n['exponent'] == 0.5 and n['top_n'] == 10:
+            fprint(format_rule(n))
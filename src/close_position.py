@@ -1,4 +1,5 @@
 from src.okex_api import *
+from src.scheduler import Schedule
 
 
 class ReducePosition(OKExAPI):
@@ -17,167 +18,98 @@ class ReducePosition(OKExAPI):
         self.fee_total = 0.
         self.spot_notional = 0.
         self.swap_notional = 0.
+        # 在途订单组及其数量，chunks为本次全部订单组
+        self.in_flight = set()
+        self.chunks: List[asyncio.Task] = []
+        self.pending = 0.
+        # 有订单完成，需要更新现货余额
+        self.stale = False
+        self.accounting: Optional[asyncio.Lock] = None
 
     async def hedge(self):
         """减仓以达到完全对冲
         """
 
     async def place_close_order(self, bid_price: str, spot_size: str, ask_price: str, contract_size: str):
-        spot_order_info = swap_order_info = spot_order_state = swap_order_state = dict()
-
-        spot_task = create_task(
-            self.tradeAPI.take_spot_order(instId=self.spot_ID, side='sell', size=spot_size, price=bid_price,
-                                          order_type='fok'))
-        swap_task = create_task(
-            self.tradeAPI.take_swap_order(instId=self.swap_ID, side='buy', size=contract_size, price=ask_price,
-                                          order_type='fok', reduceOnly=True))
-        spot_res, swap_res = await gather(spot_task, swap_task, return_exceptions=True)
-
-        if (not isinstance(spot_res, OkexAPIException)) and (not isinstance(swap_res, OkexAPIException)):
-            spot_order, swap_order = spot_task.result(), swap_task.result()
-        else:
-            if spot_res is OkexAPIException:
-                swap_order = swap_task.result()
-                swap_order_info = await self.tradeAPI.get_order_info(instId=self.swap_ID, order_id=swap_order['ordId'])
-                fprint(swap_order_info)
-                fprint(spot_res)
-            elif swap_res is OkexAPIException:
-                spot_order = spot_task.result()
-                if swap_res.code in ('50026', '51022'):
-                    fprint(lang.futures_market_down)
-                spot_order_info = await self.tradeAPI.get_order_info(instId=self.spot_ID, order_id=spot_order['ordId'])
-                fprint(spot_order_info)
-                fprint(swap_res)
-            self.exitFlag = True
+        """平仓一组期现对冲并记账，多组同时在途时只串行记账
+        """
+        result = await self.hedge_chunk('sell', spot_size, bid_price, contract_size, ask_price)
+        if not result:
             return
+        async with self.accounting:
+            await self.record_fills(*result)
 
-        async def check_order():
-            nonlocal spot_order_info, swap_order_info, spot_order_state, swap_order_state
-            # 查询订单信息
-            if spot_order['ordId'] != '-1' and swap_order['ordId'] != '-1':
-                spot_order_info, swap_order_info = await gather(
-                    self.tradeAPI.get_order_info(instId=self.spot_ID, order_id=spot_order['ordId']),
-                    self.tradeAPI.get_order_info(instId=self.swap_ID, order_id=swap_order['ordId']))
-                spot_order_state = spot_order_info['state']
-                swap_order_state = swap_order_info['state']
-            # 下单失败
-            else:
-                if spot_order['ordId'] == '-1':
-                    fprint(lang.spot_order_failed)
-                    fprint(spot_order)
-                    self.exitFlag = True
-                else:
-                    fprint(lang.swap_order_failed)
-                    fprint(swap_order)
-                    if swap_order['code'] in ('50023', '51030'):
-                        kwargs = dict(instId=self.spot_ID, order_id=spot_order['ordId'])
-                        spot_order_info = await self.tradeAPI.get_order_info(**kwargs)
-                        spot_order_state = spot_order_info['state']
-                        await self.funding_settled()
-                        swap_order_state = 'canceled'
-                    else:
-                        if swap_order['code'] in ('50026', '51022'):
-                            fprint(lang.futures_market_down)
-                        self.exitFlag = True
+    async def record_fills(self, spot_order_info: dict, swap_order_info: dict):
+        """按两腿成交记账并检查对冲
 
-        await check_order()
-        if self.exitFlag:
+        :param spot_order_info: 现货订单信息
+        :param swap_order_info: 合约订单信息
+        """
+        prev_swap_balance = self.swap_balance
+        holding = await self.swap_holding(self.swap_ID)
+        # 空单全部平掉后没有持仓
+        self.swap_balance = holding['margin'] if holding else 0.
+        self.swap_position = - holding['pos'] * self.contract_val if holding else 0.
+        spot_filled = float(spot_order_info['accFillSz'])
+        swap_filled = float(swap_order_info['accFillSz']) * self.contract_val
+        self.spot_filled_sum += spot_filled
+        self.swap_filled_sum += swap_filled
+        spot_price = float(spot_order_info['avgPx'])
+        swap_price = float(swap_order_info['avgPx'])
+        spot_fee = float(spot_order_info['fee'])
+        swap_fee = float(swap_order_info['fee'])
+        rpl = swap_filled * (self.open_price - swap_price)
+        # margin_recoup = - Δswap_balance + rpl + swap_fee
+        # 现货成交量加保证金变动
+        self.usdt_release += (rpl + spot_filled * spot_price + spot_fee + swap_fee
+                              + prev_swap_balance - self.swap_balance)
+        self.fee_total += spot_fee + swap_fee
+        self.spot_notional += spot_filled * spot_price
+        self.swap_notional -= swap_filled * swap_price
+
+        # 对冲检查
+        if abs(spot_filled - swap_filled) < self.contract_val:
+            target_position_prev = self.target_position
+            self.target_position -= swap_filled
+            fprint(lang.hedge_success.format(swap_filled, self.coin), lang.remaining.format(self.target_position))
+            mydict = dict(account=self.account, instrument=self.coin, op='reduce',
+                          size=target_position_prev)
+            Record('OP').mycol.find_one_and_update(mydict, {'$set': {'size': self.target_position}})
+        else:
+            fprint(lang.hedge_fail.format(self.coin, spot_filled, swap_filled))
+            self.exitFlag = True
             return
 
-        # 其中一单撤销
-        while spot_order_state != 'filled' or swap_order_state != 'filled':
-            # print(spot_order_state+','+swap_order_state)
-            if spot_order_state == 'filled':
-                if swap_order_state == 'canceled':
-                    fprint(lang.swap_order_retract, swap_order_state)
-                    try:
-                        buy_price = round_to(1.01 * float(ask_price), self.tick_size)
-                        buy_price = float_str(buy_price, self.tick_decimals)
-                        kwargs = dict(instId=self.swap_ID, side='buy', size=contract_size, price=buy_price,
-                                      order_type='limit', reduceOnly=True)
-                        swap_order = await self.tradeAPI.take_swap_order(**kwargs)
-                    except Exception as e:
-                        fprint(e)
-                        self.exitFlag = True
-                        break
-                else:
-                    fprint(lang.swap_order_state, swap_order_state)
-                    fprint(lang.await_status_update)
-            elif swap_order_state == 'filled':
-                if spot_order_state == 'canceled':
-                    fprint(lang.spot_order_retract, spot_order_state)
-                    try:
-                        sell_price = round_to(0.99 * float(bid_price), self.tick_size)
-                        sell_price = float_str(sell_price, self.tick_decimals)
-                        kwargs = dict(instId=self.spot_ID, side='sell', size=spot_size, price=sell_price,
-                                      order_type='limit')
-                        spot_order = await self.tradeAPI.take_spot_order(**kwargs)
-                    except Exception as e:
-                        fprint(e)
-                        self.exitFlag = True
-                        break
-                else:
-                    fprint(lang.spot_order_state, spot_order_state)
-                    fprint(lang.await_status_update)
-            elif spot_order_state == 'canceled' and swap_order_state == 'canceled':
-                # fprint(lang.both_order_failed)
-                break
-            else:
-                fprint(lang.await_status_update)
-
-            await check_order()
-            if self.exitFlag:
-                break
+    def submit_close_order(self, order_size: float, bid_price: str, spot_size: str, ask_price: str,
+                           contract_size: str):
+        """下单后不等待成交，在途数量计入pending
+        """
 
-        # 下单成功
-        if spot_order_state == 'filled' and swap_order_state == 'filled':
-            prev_swap_balance = self.swap_balance
-            holding = await self.swap_holding(self.swap_ID)
-            self.swap_balance = holding['margin']
-            self.swap_position = - holding['pos'] * self.contract_val
-            spot_filled = float(spot_order_info['accFillSz'])
-            swap_filled = float(swap_order_info['accFillSz']) * self.contract_val
-            self.spot_filled_sum += spot_filled
-            self.swap_filled_sum += swap_filled
-            spot_price = float(spot_order_info['avgPx'])
-            swap_price = float(swap_order_info['avgPx'])
-            spot_fee = float(spot_order_info['fee'])
-            swap_fee = float(swap_order_info['fee'])
-            rpl = swap_filled * (self.open_price - swap_price)
-            # margin_recoup = - Δswap_balance + rpl + swap_fee
-            # 现货成交量加保证金变动
-            self.usdt_release += (rpl + spot_filled * spot_price + spot_fee + swap_fee
-                                  + prev_swap_balance - self.swap_balance)
-            self.fee_total += spot_fee + swap_fee
-            self.spot_notional += spot_filled * spot_price
-            self.swap_notional -= swap_filled * swap_price
-
-            # 对冲检查
-            if abs(spot_filled - swap_filled) < self.contract_val:
-                target_position_prev = self.target_position
-                self.target_position -= swap_filled
-                fprint(lang.hedge_success.format(swap_filled, self.coin), lang.remaining.format(self.target_position))
-                mydict = dict(account=self.account, instrument=self.coin, op='reduce',
-                              size=target_position_prev)
-                Record('OP').mycol.find_one_and_update(mydict, {'$set': {'size': self.target_position}})
-            else:
-                fprint(lang.hedge_fail.format(self.coin, spot_filled, swap_filled))
+        async def execute():
+            try:
+                await self.place_close_order(bid_price, spot_size, ask_price, contract_size)
+            except Exception:
                 self.exitFlag = True
-                return
-        elif spot_order_state == 'canceled' and swap_order_state == 'canceled':
-            return
-        else:
-            self.exitFlag = True
-            return
+                raise
+            finally:
+                self.pending -= order_size
+                self.stale = True
+
+        self.pending += order_size
+        task = create_task(execute())
+        self.in_flight.add(task)
+        self.chunks.append(task)
+        task.add_done_callback(self.in_flight.discard)
 
     @manager.submit
-    async def reduce(self, usdt_size=0.0, target_size=0.0, price_diff=0.002, accelerate_after=0):
+    async def reduce(self, usdt_size=0.0, target_size=0.0, price_diff=0.002, accelerate_after=0, horizon=0):
         """减仓期现组合
 
         :param usdt_size: U本位目标仓位
         :param target_size: 币本位目标仓位
         :param price_diff: 期现差价
         :param accelerate_after: 几小时后加速
+        :param horizon: 按TWAP计划在几小时内完成，代替accelerate_after
         :return: 释放USDT
         :rtype: float
         """
@@ -210,6 +142,9 @@ class ReducePosition(OKExAPI):
         OP = Record('OP')
         mydict = dict(account=self.account, instrument=self.coin, op='reduce', size=self.target_position)
         OP.insert(mydict)
+        schedule = Schedule(self.target_position, horizon) if horizon else None
+        # 计划内的期现差价和落后时的最宽期现差价
+        planned_pd = loose_pd = price_diff
 
         self.spot_filled_sum = 0.
         self.swap_filled_sum = 0.
@@ -219,80 +154,100 @@ class ReducePosition(OKExAPI):
         self.swap_notional = 0.
         time_to_accelerate = datetime.utcnow() + timedelta(hours=accelerate_after)
 
-        channels = [dict(channel='tickers', instId=self.spot_ID), dict(channel='tickers', instId=self.swap_ID)]
-        spot_ticker = swap_ticker = None
-        self.exitFlag = False
+        # 查询手续费率
+        spot_fee, swap_fee = await gather(self.spot_trade_fee(), self.swap_trade_fee())
+        fee = - spot_fee - swap_fee
 
-        # 如果仍未减仓完毕
-        while self.target_position >= self.contract_val and not self.exitFlag:
-            # 下单后重新订阅
-            async for ticker in subscribe_without_login(self.public_url, channels):
-                if self.exitFlag:
+        channels = [dict(channel=self.quote_channel, instId=self.spot_ID),
+                    dict(channel=self.quote_channel, instId=self.swap_ID)]
+        spot_book = swap_book = None
+        self.exitFlag = False
+        self.pending = 0.
+        self.stale = False
+        self.chunks = []
+        self.accounting = asyncio.Lock()
+        await self.warm_up()
+
+        # 如果仍未减仓完毕，下单后沿用同一行情流，丢弃下单前的行情
+        fresh_after = 0
+        stream = self.market_stream(self.public_url, channels)
+        async for book in stream:
+            if self.exitFlag or (self.target_position < self.contract_val and not self.in_flight):
+                break
+            # 没有在途订单时更新现货余额
+            if self.stale and not self.in_flight:
+                spot_position = await self.spot_position()
+                self.target_position = min(self.target_position, spot_position, self.swap_position)
+                self.stale = False
+            if schedule:
+                # 每个时间片更新近期期现差价，落后于计划时向均值放宽
+                if schedule.next_slice(self.swap_filled_sum):
+                    if recent := trading_data.Stat(self.coin).recent_close_stat(schedule.window):
+                        loose_pd = max(recent['avg'], planned_pd)
+                    planned = schedule.planned(schedule.elapsed_slices())
+                    fprint(lang.schedule_progress.format(self.coin, self.swap_filled_sum, planned,
+                                                         schedule.tracking_error()))
+                price_diff = schedule.premium(self.swap_filled_sum, planned_pd, loose_pd)
+            # 判断是否加速
+            elif accelerate_after and datetime.utcnow() > time_to_accelerate:
+                Stat = trading_data.Stat(self.coin)
+                assert (recent := Stat.recent_close_stat(accelerate_after)), lang.fetch_ticker_first
+                price_diff = recent['avg'] - 2 * recent['std']
+                time_to_accelerate = datetime.utcnow() + timedelta(hours=accelerate_after)
+
+            quote = to_quote(book)
+            # 供追单改价使用
+            self.books[quote['instId']] = quote
+            if quote['ts'] <= fresh_after:
+                continue
+            if quote['instId'] == self.spot_ID:
+                spot_book = quote
+            elif quote['instId'] == self.swap_ID:
+                swap_book = quote
+            else:
+                continue
+            if not (spot_book and swap_book) or len(self.in_flight) >= self.chunks_in_flight:
+                continue
+
+            # 按深度计算VWAP溢价满足price_diff的最大数量，以及现货最低卖出价、合约最高买入价，扣除在途数量
+            depth, bid_price, ask_price = depth_size(spot_book['bids'], swap_book['asks'],
+                                                     self.target_position - self.pending, price_diff, fee,
+                                                     self.contract_val, close=True)
+            # 按计划只放出本时间片的数量，并只吃掉部分深度
+            if schedule:
+                depth = schedule.size(self.swap_filled_sum, self.pending, depth)
+
+            # 如果不满足期现溢价
+            if depth < self.contract_val:
+                pass
+            else:
+                if self.target_position > spot_position:
+                    fprint(lang.insufficient_spot)
+                    self.exitFlag = True
+                    break
+                elif self.target_position > self.swap_position:
+                    fprint(lang.insufficient_margin)
+                    self.exitFlag = True
                     break
-                # 判断是否加速
-                if accelerate_after and datetime.utcnow() > time_to_accelerate:
-                    Stat = trading_data.Stat(self.coin)
-                    assert (recent := Stat.recent_close_stat(accelerate_after)), lang.fetch_ticker_first
-                    price_diff = recent['avg'] - 2 * recent['std']
-                    time_to_accelerate = datetime.utcnow() + timedelta(hours=accelerate_after)
-
-                ticker = ticker['data'][0]
-                if ticker['instId'] == self.spot_ID:
-                    spot_ticker = ticker
-                elif ticker['instId'] == self.swap_ID:
-                    swap_ticker = ticker
-                else:
-                    continue
-                if not (spot_ticker and swap_ticker):
-                    continue
-
-                # 现货最高卖出价
-                best_bid = float(spot_ticker['bidPx'])
-                # 合约最低买入价
-                best_ask = float(swap_ticker['askPx'])
-
-                # 如果不满足期现溢价
-                if best_ask > best_bid * (1 + price_diff):
-                    # print(f'当前期现差价: {(best_ask - best_bid) / best_bid:.3%} > {price_diff:.3%}')
-                    pass
                 else:
-                    if self.target_position > spot_position:
-                        fprint(lang.insufficient_spot)
-                        self.exitFlag = True
-                        break
-                    elif self.target_position > self.swap_position:
-                        fprint(lang.insufficient_margin)
-                        self.exitFlag = True
-                        break
+                    # 计算下单数量
+                    units, spot_size, contract_size = self.precision.hedge_sizes(depth)
+                    order_size = self.precision.size(units)
+                    # print(contract_size, spot_size, self.min_size)
+
+                    # 下单，如果资金费不是马上更新
+                    if order_size > 0 and not self.funding_settling():
+                        self.submit_close_order(order_size, bid_price, spot_size, ask_price, contract_size)
+                        # 等待下单后的新行情
+                        fresh_after = self.update_time(spot_book, swap_book)
+                        spot_book = swap_book = None
                     else:
-                        # 计算下单数量
-                        best_bid_size = float(spot_ticker['bidSz'])
-                        best_ask_size = float(swap_ticker['askSz'])
-                        order_size = min(self.target_position, best_bid_size, best_ask_size * self.contract_val)
-                        order_size = round_to(order_size, self.min_size)
-                        order_size = round_to(order_size, self.contract_val)
-                        # print(order_size)
-                        contract_size = round(order_size / self.contract_val)
-                        contract_size = f'{contract_size:d}'
-                        spot_size = round_to(order_size, self.size_increment)
-                        spot_size = float_str(spot_size, self.size_decimals)
-                        # print(contract_size, spot_size, self.min_size)
-
-                        # 下单，如果资金费不是马上更新
-                        if order_size > 0 and not self.funding_settling():
-                            await self.place_close_order(spot_ticker['bidPx'], spot_size, swap_ticker['askPx'],
-                                                         contract_size)
-
-                            if self.exitFlag:
-                                break
-
-                            spot_position = await self.spot_position()
-                            self.target_position = min(self.target_position, spot_position, self.swap_position)
-                            # 重新订阅
-                            break
-                        else:
-                            # print('订单太小', order_size)
-                            pass
+                        # print('订单太小', order_size)
+                        pass
+
+        await stream.aclose()
+        # 等待全部订单组完成，有一组失败时不记账
+        await self.wait_chunks(self.chunks)
 
         if self.spot_notional:
             Ledger = Record('Ledger')
@@ -309,6 +264,9 @@ class ReducePosition(OKExAPI):
         OP.delete(mydict)
         await self.update_portfolio()
         fprint(lang.reduced_amount.format(self.swap_filled_sum, self.coin))
+        if schedule:
+            schedule.track(self.swap_filled_sum)
+            fprint(lang.tracking_error.format(self.coin, schedule.tracking_error()))
         if self.usdt_release:
             fprint(lang.spot_recoup.format(self.usdt_release))
             await self.add_margin(self.usdt_release)
@@ -351,105 +309,131 @@ class ReducePosition(OKExAPI):
         self.swap_notional = 0.
         time_to_accelerate = datetime.utcnow() + timedelta(hours=accelerate_after)
 
-        channels = [dict(channel='tickers', instId=self.spot_ID), dict(channel='tickers', instId=self.swap_ID)]
-        spot_ticker = swap_ticker = None
-        self.exitFlag = False
+        # 查询手续费率
+        spot_fee, swap_fee = await gather(self.spot_trade_fee(), self.swap_trade_fee())
+        fee = - spot_fee - swap_fee
 
-        # 如果仍未减仓完毕
-        while self.target_position > 0 and not self.exitFlag:
-            # 下单后重新订阅
-            async for ticker in subscribe_without_login(self.public_url, channels, verbose=False):
-                if self.exitFlag:
+        channels = [dict(channel=self.quote_channel, instId=self.spot_ID),
+                    dict(channel=self.quote_channel, instId=self.swap_ID)]
+        spot_book = swap_book = None
+        self.exitFlag = False
+        self.pending = 0.
+        self.stale = False
+        self.chunks = []
+        self.accounting = asyncio.Lock()
+        await self.warm_up()
+
+        # 如果仍未减仓完毕，下单后沿用同一行情流，丢弃下单前的行情
+        fresh_after = 0
+        stream = self.market_stream(self.public_url, channels, verbose=False)
+        async for book in stream:
+            if self.exitFlag or (self.target_position <= 0 and not self.in_flight):
+                break
+            # 没有在途订单时更新现货余额
+            if self.stale and not self.in_flight:
+                spot_position = await self.spot_position()
+                self.target_position = min(self.target_position, spot_position, self.swap_position)
+                self.stale = False
+            # 判断是否加速
+            if accelerate_after and datetime.utcnow() > time_to_accelerate:
+                Stat = trading_data.Stat(self.coin)
+                assert (recent := Stat.recent_close_stat(accelerate_after)), lang.fetch_ticker_first
+                price_diff = recent['avg'] - 2 * recent['std']
+                time_to_accelerate = datetime.utcnow() + timedelta(hours=accelerate_after)
+
+            quote = to_quote(book)
+            # 供追单改价使用
+            self.books[quote['instId']] = quote
+            if quote['ts'] <= fresh_after:
+                continue
+            if quote['instId'] == self.spot_ID:
+                spot_book = quote
+            elif quote['instId'] == self.swap_ID:
+                swap_book = quote
+            else:
+                continue
+            if not (spot_book and swap_book) or len(self.in_flight) >= self.chunks_in_flight:
+                continue
+
+            # 按深度计算VWAP溢价满足price_diff的最大数量，以及现货最低卖出价、合约最高买入价，扣除在途数量
+            depth, bid_price, ask_price = depth_size(spot_book['bids'], swap_book['asks'],
+                                                     self.target_position - self.pending, price_diff, fee,
+                                                     self.contract_val, close=True)
+
+            # 如果不满足期现溢价
+            if depth < self.contract_val:
+                pass
+            else:
+                if self.target_position > spot_position:
+                    fprint(lang.insufficient_spot)
+                    self.exitFlag = True
+                    break
+                elif self.target_position > self.swap_position:
+                    fprint(lang.insufficient_swap)
+                    self.exitFlag = True
                     break
-                # 判断是否加速
-                if accelerate_after and datetime.utcnow() > time_to_accelerate:
-                    Stat = trading_data.Stat(self.coin)
-                    assert (recent := Stat.recent_close_stat(accelerate_after)), lang.fetch_ticker_first
-                    price_diff = recent['avg'] - 2 * recent['std']
-                    time_to_accelerate = datetime.utcnow() + timedelta(hours=accelerate_after)
-
-                ticker = ticker['data'][0]
-                if ticker['instId'] == self.spot_ID:
-                    spot_ticker = ticker
-                elif ticker['instId'] == self.swap_ID:
-                    swap_ticker = ticker
-                else:
-                    continue
-                if not (spot_ticker and swap_ticker):
-                    continue
-
-                # 现货最高卖出价
-                best_bid = float(spot_ticker['bidPx'])
-                # 合约最低买入价
-                best_ask = float(swap_ticker['askPx'])
-
-                # 如果不满足期现溢价
-                if best_ask > best_bid * (1 + price_diff):
-                    # print(f'当前期现差价: {(best_ask - best_bid) / best_bid:.3%} > {price_diff:.3%}')
-                    pass
                 else:
-                    if self.target_position > spot_position:
-                        fprint(lang.insufficient_spot)
-                        self.exitFlag = True
-                        break
-                    elif self.target_position > self.swap_position:
-                        fprint(lang.insufficient_swap)
-                        self.exitFlag = True
-                        break
-                    else:
-                        # 计算下单数量
-                        best_bid_size = float(spot_ticker['bidSz'])
-                        best_ask_size = float(swap_ticker['askSz'])
-
-                        if self.target_position < self.swap_position:  # spot=target=1.9 swap=2.0
-                            order_size = min(self.target_position, round_to(best_bid_size, self.min_size),
-                                             best_ask_size * self.contract_val)  # order=1.9 or 1
-                            contract_size = round(order_size / self.contract_val)  # 2 or 1
-                            spot_size = round_to(order_size, self.size_increment)  # 1.9 or 1
-                            remnant = (spot_position - spot_size) / self.min_size
-                            # print(order_size, contract_size, spot_size, remnant)
-                            # 必须一次把现货出完
-                            if remnant >= 1:
-                                order_size = contract_size * self.contract_val
-                                spot_size = round_to(order_size, self.size_increment)
-                            elif round(remnant) > 0 and remnant < 1:  # 1.9-1=0.9<1
-                                continue
-                            else:  # 1.9-1.9=0
-                                pass
-                        else:  # spot=2.1 swap=target=2.0
-                            order_size = min(self.target_position, round_to(best_bid_size, self.min_size),
-                                             best_ask_size * self.contract_val)  # order=2 or 1, 1.5
-                            contract_size = round(order_size / self.contract_val)  # 2 or 1
-                            spot_size = round_to(order_size, self.size_increment)  # 2 or 1, 1.5
-                            remnant = (spot_position - spot_size) / self.min_size
-                            # 必须一次把现货出完
-                            if remnant >= 1:  # 2.1-1>1
-                                order_size = contract_size * self.contract_val
-                                spot_size = round_to(order_size, self.size_increment)
-                            elif remnant < 1:  # 2.1-2=0.1
-                                if spot_position <= best_bid_size:  # 2.1<3
-                                    spot_size = spot_position  # 2->2.1
-                                else:
-                                    continue
-                        contract_size = f'{contract_size:d}'
-                        spot_size = float_str(spot_size, self.size_decimals)
-
-                        # 下单，如果资金费不是马上更新
-                        if order_size > 0 and not self.funding_settling():
-                            await self.place_close_order(spot_ticker['bidPx'], spot_size, swap_ticker['askPx'],
-                                                         contract_size)
-
-                            if self.exitFlag:
-                                break
-
-                            spot_position = await self.spot_position()
-                            self.target_position = min(self.target_position, spot_position, self.swap_position)
-                            # 重新订阅
-                            break
-                        else:
-                            # print('订单太小', order_size)
+                    # 计算下单数量
+                    # 边际价格以内的现货深度
+                    best_bid_size = sum(float(n[1]) for n in spot_book['bids']
+                                        if float(n[0]) >= float(bid_price))
+
+                    # 最后一组须等在途订单完成，按最新余额一次出完，数量以整数单位计算
+                    precision = self.precision
+                    spot_free = precision.units(spot_position - self.pending)
+                    order = precision.units(depth)
+                    order = min(order - order % precision.min_units, precision.units(self.target_position))
+                    contracts = round(order / precision.ct_units)
+                    spot = order - order % precision.lot_units
+                    remnant = (spot_free - spot) / precision.min_units
+                    if self.target_position < self.swap_position:  # spot=target=1.9 swap=2.0 order=1.9 or 1
+                        # print(order, contracts, spot, remnant)
+                        # 必须一次把现货出完
+                        if remnant >= 1:
+                            order = contracts * precision.ct_units
+                            spot = order - order % precision.lot_units
+                        elif self.in_flight or (round(remnant) > 0 and remnant < 1):  # 1.9-1=0.9<1
+                            continue
+                        else:  # 1.9-1.9=0
                             pass
+                    else:  # spot=2.1 swap=target=2.0 order=2 or 1, 1.5
+                        # 必须一次把现货出完
+                        if remnant >= 1:  # 2.1-1>1
+                            order = contracts * precision.ct_units
+                            spot = order - order % precision.lot_units
+                        elif remnant < 1:  # 2.1-2=0.1
+                            if not self.in_flight and spot_position <= best_bid_size:  # 2.1<3
+                                spot = precision.units(spot_position)  # 2->2.1
+                            else:
+                                continue
+                    order_size = precision.size(order)
+                    contract_size = str(contracts)
+                    spot_size = precision.spot_str(spot)
+
+                    # 下单，如果资金费不是马上更新
+                    if order_size > 0 and not self.funding_settling():
+                        self.submit_close_order(order_size, bid_price, spot_size, ask_price, contract_size)
+                        # 等待下单后的新行情
+                        fresh_after = self.update_time(spot_book, swap_book)
+                        spot_book = swap_book = None
+                    else:
+                        # print('订单太小', order_size)
+                        pass
 
+        await stream.aclose()
+        # 等待全部订单组完成，有一组失败时不记账
+        await self.wait_chunks(self.chunks)
+
+        mydict = dict(account=self.account, instrument=self.coin, op='close')
+        OP.delete(mydict)
+        self.record_close()
+        return self.usdt_release
+
+    def record_close(self, closed=True):
+        """平仓记账，删除持仓记录
+
+        :param closed: 已全部平仓
+        """
         if self.spot_notional:
             Ledger = Record('Ledger')
             timestamp = datetime.utcnow()
@@ -463,10 +447,72 @@ class ReducePosition(OKExAPI):
                            position=self.usdt_release)
             Ledger.mycol.insert_many([mydict1, mydict2, mydict3, mydict4])
 
-        mydict = dict(account=self.account, instrument=self.coin, op='close')
-        OP.delete(mydict)
-        Record('Portfolio').mycol.delete_one(dict(account=self.account, instrument=self.coin))
+        if closed:
+            Record('Portfolio').mycol.delete_one(dict(account=self.account, instrument=self.coin))
         fprint(lang.closed_amount.format(self.swap_filled_sum, self.coin))
         if self.usdt_release:
             fprint(lang.spot_recoup.format(self.usdt_release))
-        return self.usdt_release
+
+    async def exit_orders(self) -> List[dict]:
+        """不看期现溢价，以市价单卖出全部现货、平掉全部空单
+
+        :return: 现货和合约订单参数，没有持仓时为空
+        """
+        spot_position, holding = await gather(self.spot_position(), self.swap_holding())
+        if not holding or not holding['pos']:
+            fprint(lang.nonexistent_position.format(self.swap_ID))
+            return []
+        self.swap_balance = holding['margin']
+        self.open_price = holding['avgPx']
+        self.swap_position = - holding['pos'] * self.contract_val
+        self.target_position = min(spot_position, self.swap_position)
+        self.spot_filled_sum = 0.
+        self.swap_filled_sum = 0.
+        self.usdt_release = 0.
+        self.fee_total = 0.
+        self.spot_notional = 0.
+        self.swap_notional = 0.
+        spot_size = self.precision.spot_str(self.precision.units(spot_position))
+        contract_size = f'{round(- holding["pos"]):d}'
+        return [dict(instId=self.spot_ID, tdMode='cash', side='sell', ordType='market', sz=spot_size),
+                dict(instId=self.swap_ID, tdMode='isolated', side='buy', ordType='market', sz=contract_size,
+                     reduceOnly=True)]
+
+    async def settle_exit(self, spot_order: dict, swap_order: dict):
+        """等待市价单完成后记账
+
+        :param spot_order: 批量下单返回的现货订单
+        :param swap_order: 批量下单返回的合约订单
+        """
+        infos = []
+        closed = True
+        for instId, order in ((self.spot_ID, spot_order), (self.swap_ID, swap_order)):
+            if order['sCode'] != '0':
+                fprint(lang.exit_order_failed.format(instId, order['sMsg']))
+                infos.append(dict(accFillSz='0', avgPx='0', fee='0'))
+                closed = False
+                continue
+            info = await self.tradeAPI.get_order_info(instId=instId, order_id=order['ordId'])
+            while info['state'] not in ('filled', 'canceled'):
+                await asyncio.sleep(self.chase_interval)
+                info = await self.tradeAPI.get_order_info(instId=instId, order_id=order['ordId'])
+            closed = closed and info['state'] == 'filled'
+            infos.append(dict(info, avgPx=info['avgPx'] or '0', fee=info['fee'] or '0'))
+        await self.record_fills(*infos)
+        self.record_close(closed)
+
+    @staticmethod
+    async def market_exit(positions: List['ReducePosition']):
+        """多个币种同时市价退出，各币种的两腿订单合并批量下单，每次最多20个
+
+        :param positions: 各币种的ReducePosition
+        """
+        orders = await gather(*[n.exit_orders() for n in positions])
+        positions = [n for n, m in zip(positions, orders) if m]
+        orders = [n for m in orders for n in m]
+        if not orders:
+            return
+        fprint(lang.fast_exit.format(len(positions), len(orders)))
+        results = await OKExAPI.tradeAPI.batch_order(orders)
+        # 返回结果与订单顺序一致，每个币种两单
+        await gather(*[n.settle_exit(results[2 * i], results[2 * i + 1]) for i, n in enumerate(positions)])
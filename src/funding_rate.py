@@ -1,24 +1,63 @@
-from typing import List
+from typing import Dict, List, Set
+import heapq
+from okex.exceptions import OkexRequestException
 from okex.public import PublicAPI
-import statistics
+import numpy as np
 import src.record as record
 import src.trading_data as trading_data
+from src.websocket import subscribe_without_login
 from src.utils import *
 from src.lang import *
 
 
+def history_matrix(histories: List[List[dict]]):
+    """把各合约的历史资金费排成 合约 x 结算时间 的矩阵
+
+    :param histories: 各合约get_historical_funding_rate的结果
+    :return: instId列表, 结算时间ms, 实际资金费率矩阵（缺失为NaN）
+    """
+    histories = [n for n in histories if n]
+    instruments = [n[0]['instId'] for n in histories]
+    times = np.unique(np.concatenate([np.array([int(m['fundingTime']) for m in n], dtype=np.int64)
+                                      for n in histories])) if histories else np.zeros(0, dtype=np.int64)
+    matrix = np.full((len(histories), len(times)), np.nan)
+    for i, n in enumerate(histories):
+        columns = np.searchsorted(times, np.array([int(m['fundingTime']) for m in n], dtype=np.int64))
+        matrix[i, columns] = [float(m['realizedRate']) for m in n]
+    return instruments, times, matrix
+
+
 # @debug_timer
 class FundingRate:
     publicAPI: PublicAPI
+    public_url: str
+    # 资金费率频道推送 {instId: dict(current=当期, next=预测, funding_time=结算时间)}
+    rates: Dict[str, dict] = dict()
+    # 最近一次记录结算的时间 {instId: fundingTime}
+    settled: Dict[str, int] = dict()
+    stream_task: Optional[asyncio.Task] = None
+    # 结算后查询实际资金费的任务
+    settle_tasks: Set[asyncio.Task] = set()
+    # 已结算资金费矩阵 合约 x 结算时间，缺失为NaN，结算时由资金费率频道追加
+    history_ids: List[str] = []
+    history_index: Dict[str, int] = dict()
+    history_times = np.zeros(0, dtype=np.int64)
+    history = np.zeros((0, 0))
+    history_days = 0
+    # 结算间隔ms，超过此时间没有追加说明频道漏掉了结算
+    settle_interval = 8 * 3600 * 1000
 
     def __init__(self, account=3):
         if account == 3:
             FundingRate.publicAPI = PublicAPI(test=True)
+            FundingRate.public_url = 'wss://wspap.okx.com:8443/ws/v5/public?brokerId=9999'
         else:
             FundingRate.publicAPI = PublicAPI()
+            FundingRate.public_url = 'wss://ws.okx.com:8443/ws/v5/public'
 
     @staticmethod
     async def aclose():
+        FundingRate.stop_stream()
         if hasattr(FundingRate, 'publicAPI'):
             await FundingRate.publicAPI.aclose()
 
@@ -29,12 +68,89 @@ class FundingRate:
         """
         return [n['instId'] for n in await self.publicAPI.get_instruments('SWAP') if n['instId'].find('USDT') != -1]
 
+    def start_stream(self):
+        """后台订阅全部USDT永续合约资金费率频道
+        """
+        if not FundingRate.stream_task or FundingRate.stream_task.done():
+            FundingRate.stream_task = asyncio.get_event_loop().create_task(self.stream())
+
+    @staticmethod
+    def stop_stream():
+        if FundingRate.stream_task:
+            FundingRate.stream_task.cancel()
+            FundingRate.stream_task = None
+
+    async def stream(self):
+        """订阅资金费率频道，更新内存中的资金费率，结算时查询实际资金费
+        """
+        channels = [dict(channel='funding-rate', instId=m) for m in await self.get_instruments_ID()]
+        async for res in subscribe_without_login(self.public_url, channels):
+            for data in res.get('data', []):
+                instId = data['instId']
+                funding_time = int(data['fundingTime'])
+                previous = FundingRate.rates.get(instId)
+                FundingRate.rates[instId] = dict(current=float(m) if (m := data['fundingRate']) else 0.,
+                                                 next=float(m) if (m := data['nextFundingRate']) else 0.,
+                                                 funding_time=funding_time)
+                # 结算后fundingTime更新为下一期
+                if previous and funding_time > previous['funding_time']:
+                    task = asyncio.create_task(self.settle(instId, previous['funding_time']))
+                    FundingRate.settle_tasks.add(task)
+                    task.add_done_callback(FundingRate.settle_tasks.discard)
+
+    async def settle(self, instId: str, funding_time: int, retries=30, interval=10):
+        """查询一期结算的实际资金费写入矩阵。推送的当期费率是预测值，与实际资金费可能不同。
+        只有记录行情的进程写入Funding，记录与record轮询写入的相同
+
+        :param instId: 合约
+        :param funding_time: 结算时间ms
+        :param retries: 查询不到该期结算时重试的次数，仍查询不到由record轮询补上
+        :param interval: 重试间隔秒数
+        """
+        for _ in range(retries):
+            try:
+                history = await self.publicAPI.get_historical_funding_rate(instId=instId, limit='3')
+            except (aiohttp.ClientError, OkexRequestException):
+                history = []
+            for n in history:
+                if int(n['fundingTime']) == funding_time:
+                    realized_rate = float(n['realizedRate'])
+                    FundingRate.settled[instId] = funding_time
+                    FundingRate.append_history(instId, funding_time, realized_rate)
+                    if record.recording:
+                        record.Record('Funding').insert(dict(instrument=instId[:instId.find('-')],
+                                                             timestamp=utcfrommillisecs(funding_time),
+                                                             funding=realized_rate))
+                    return
+            await asyncio.sleep(interval)
+
+    async def wait_stream(self, instruments: List[str], timeout=5.):
+        """等待频道推送列表中全部合约
+
+        :return: 是否全部收到
+        """
+        self.start_stream()
+        begin = time.monotonic()
+        while not all(m in FundingRate.rates for m in instruments):
+            if time.monotonic() - begin > timeout:
+                return False
+            await asyncio.sleep(0.1)
+        return True
+
+    async def get_funding_time(self, instrument_id) -> dict:
+        """当期和预测资金费，优先使用频道推送
+        """
+        self.start_stream()
+        if rate := FundingRate.rates.get(instrument_id):
+            return dict(instId=instrument_id, fundingRate=rate['current'], nextFundingRate=rate['next'])
+        return await self.publicAPI.get_funding_time(instId=instrument_id)
+
     async def current(self, instrument_id=''):
         """当期资金费
 
         :param instrument_id: 币种合约
         """
-        current_rate = (await self.publicAPI.get_funding_time(instId=instrument_id))['fundingRate']
+        current_rate = (await self.get_funding_time(instrument_id))['fundingRate']
         return float(current_rate) if current_rate else 0.
 
     async def next(self, instrument_id=''):
@@ -42,7 +158,7 @@ class FundingRate:
 
         :param instrument_id: 币种合约
         """
-        next_rate = (await self.publicAPI.get_funding_time(instId=instrument_id))['nextFundingRate']
+        next_rate = (await self.get_funding_time(instrument_id))['nextFundingRate']
         return float(next_rate) if next_rate else 0.
 
     async def current_next(self, instrument_id=''):
@@ -50,7 +166,7 @@ class FundingRate:
 
         :param instrument_id: 币种合约
         """
-        funding_rate = await self.publicAPI.get_funding_time(instId=instrument_id)
+        funding_rate = await self.get_funding_time(instrument_id)
         current_rate = float(m) if (m := funding_rate['fundingRate']) else 0.
         next_rate = float(m) if (m := funding_rate['nextFundingRate']) else 0.
         return current_rate, next_rate
@@ -59,7 +175,9 @@ class FundingRate:
     async def show_current_rate(self):
         """显示当前资金费
         """
-        task_list = [self.publicAPI.get_funding_time(instId=m) for m in await self.get_instruments_ID()]
+        instruments = await self.get_instruments_ID()
+        await self.wait_stream(instruments)
+        task_list = [self.get_funding_time(m) for m in instruments]
         funding_rate_list = []
         for funding_time in await asyncio.gather(*task_list):
             instId = funding_time['instId']
@@ -85,6 +203,78 @@ class FundingRate:
         return await query_with_pagination(self.publicAPI.get_historical_funding_rate, tag='fundingTime',
                                            page_size=100, limit=limit, instId=instId)
 
+    async def load_history(self, days=90):
+        """下载全部USDT永续合约最近days天实际资金费到内存矩阵，已下载且未漏掉结算时直接返回
+
+        :param days: 天数
+        """
+        if self.history_ready(days):
+            return
+        task_list = [self.funding_history(instId=m, limit=days * 3) for m in await self.get_instruments_ID()]
+        instruments, times, matrix = history_matrix(await asyncio.gather(*task_list))
+        FundingRate.history_ids, FundingRate.history_times, FundingRate.history = instruments, times, matrix
+        FundingRate.history_index = {m: i for i, m in enumerate(instruments)}
+        FundingRate.history_days = days if len(times) else 0
+        self.start_stream()
+
+    @staticmethod
+    def history_ready(days: int) -> bool:
+        """内存矩阵已包含最近days天且未漏掉结算
+        """
+        return FundingRate.history_days >= days and time.time() * 1000 < FundingRate.history_times[-1] + \
+            FundingRate.settle_interval + 600 * 1000
+
+    @staticmethod
+    def append_history(instId: str, funding_time: int, rate: float):
+        """把频道推送的结算资金费写入矩阵
+
+        :param instId: 合约
+        :param funding_time: 结算时间ms
+        :param rate: 资金费率
+        """
+        if not FundingRate.history_days:
+            return
+        if (row := FundingRate.history_index.get(instId)) is None:
+            # 新上线合约
+            row = FundingRate.history_index[instId] = len(FundingRate.history_ids)
+            FundingRate.history_ids = FundingRate.history_ids + [instId]
+            FundingRate.history = np.concatenate((FundingRate.history, np.full((1, len(FundingRate.history_times)),
+                                                                               np.nan)))
+        column = np.searchsorted(FundingRate.history_times, funding_time)
+        if column == len(FundingRate.history_times) or FundingRate.history_times[column] != funding_time:
+            FundingRate.history_times = np.insert(FundingRate.history_times, column, funding_time)
+            FundingRate.history = np.insert(FundingRate.history, column, np.nan, axis=1)
+        FundingRate.history[row, column] = rate
+
+    @staticmethod
+    def funding_stats(days=7) -> dict:
+        """一次计算全部合约最近days天资金费统计值，上线不满days天的合约为NaN
+
+        :param days: 天数
+        :return: dict(instruments=instId列表, mean=均值, median=中位数, std=标准差, positive=正资金费比例,
+            rank=按均值排名，0为最高)
+        """
+        times, history = FundingRate.history_times, FundingRate.history
+        res = dict(instruments=FundingRate.history_ids)
+        for key in ('mean', 'median', 'std', 'positive', 'rank'):
+            res[key] = np.full(len(history), np.nan)
+        if not len(times):
+            return res
+        first = np.searchsorted(times, times[-1] - days * 86400 * 1000, side='right')
+        # 窗口开始前已上线且未下线
+        valid = ~np.isnan(history)
+        full = (np.argmax(valid, axis=1) <= first) & valid[:, first:].any(axis=1)
+        window = history[full, first:]
+        res['mean'][full] = np.nanmean(window, axis=1)
+        res['median'][full] = np.nanmedian(window, axis=1)
+        res['std'][full] = np.nanstd(window, axis=1)
+        res['positive'][full] = (window > 0).sum(axis=1) / (~np.isnan(window)).sum(axis=1)
+        order = np.argsort(-res['mean'][full], kind='stable')
+        rank = np.empty(len(order))
+        rank[order] = np.arange(len(order))
+        res['rank'][full] = rank
+        return res
+
     async def get_recent_rate(self, days=7):
         """返回最近资金费列表
 
@@ -92,17 +282,10 @@ class FundingRate:
         :rtype: List[dict]
         """
         assert isinstance(days, int) and 0 < days <= 90
-        limit = days * 3
-        task_list = [self.funding_history(instId=m, limit=limit) for m in await self.get_instruments_ID()]
-        funding_rate_list = []
-        for historical_funding_rate in await asyncio.gather(*task_list):
-            instId = historical_funding_rate[0]['instId']
-            if len(historical_funding_rate) < limit:
-                continue
-            realized_rate = [float(n['realizedRate']) for n in historical_funding_rate]
-            instrumentID = instId[:instId.find('-')]
-            funding_rate_list.append(dict(instrument=instrumentID, funding_rate=statistics.mean(realized_rate)))
-        return funding_rate_list
+        await self.load_history()
+        stats = self.funding_stats(days)
+        return [dict(instrument=instId[:instId.find('-')], funding_rate=float(mean))
+                for instId, mean in zip(stats['instruments'], stats['mean']) if not np.isnan(mean)]
 
     # @debug_timer
     async def show_nday_rate(self, days: int):
@@ -123,26 +306,13 @@ class FundingRate:
     async def print_30day_rate(self):
         """输出最近30天平均资金费到文件
         """
-        task_list = [self.funding_history(instId=m, limit=90) for m in await self.get_instruments_ID()]
-        funding_rate_list = []
-        for historical_funding_rate in await asyncio.gather(*task_list):
-            instId = historical_funding_rate[0]['instId']
-            # pprint(historical_funding_rate)
-            # 永续合约上线不一定有30天
-            if len(historical_funding_rate) < 21:
-                # print(m + "上线不到7天。")
-                pass
-            elif len(historical_funding_rate) < 90:
-                # print(m + "上线不到30天。")
-                realized_rate = [float(n['realizedRate']) for n in historical_funding_rate]
-                funding_rate_list.append(
-                    {'instrument_id': instId, '7day_funding_rate': statistics.mean(realized_rate[:21]),
-                     '30day_funding_rate': 0})
-            else:
-                realized_rate = [float(n['realizedRate']) for n in historical_funding_rate]
-                funding_rate_list.append(
-                    {'instrument_id': instId, '7day_funding_rate': statistics.mean(realized_rate[:21]),
-                     '30day_funding_rate': statistics.mean(realized_rate[:90])})
+        await self.load_history()
+        week, month = self.funding_stats(7), self.funding_stats(30)
+        # 永续合约上线不一定有30天，不到7天的不输出
+        funding_rate_list = [{'instrument_id': instId, '7day_funding_rate': float(m),
+                              '30day_funding_rate': 0 if np.isnan(n) else float(n)}
+                             for instId, m, n in zip(week['instruments'], week['mean'], month['mean'])
+                             if not np.isnan(m)]
 
         funding_rate_list.sort(key=lambda x: x['30day_funding_rate'], reverse=True)
         funding_rate_list.sort(key=lambda x: x['7day_funding_rate'], reverse=True)
@@ -203,20 +373,130 @@ class FundingRate:
         print(f"Found: {found}, Inserted: {inserted}")
 
     # @debug_timer
-    async def show_profitable_rate(self, days=7):
-        """显示收益最高十个币种资金费
+    async def show_profitable_rate(self, days=7, candidates=20, top=10, workers=8, candle_workers=2, batch=3,
+                                   refresh=1.):
+        """显示收益最高十个币种资金费。各合约依次经过下载资金费、筛选、下载K线、计算投资价值，
+        每算完一批币种更新排名，最多每refresh秒刷新一次显示。结果与先下载全部资金费取前candidates个再计算投资价值相同。
+        进入前candidates名的币种排队下载K线，每批一次计算波动率，排队中被挤出前candidates名的不再下载
+
+        :param days: 统计天数
+        :param candidates: 按平均资金费筛选的币种数
+        :param top: 显示的币种数
+        :param workers: 下载资金费的并发请求数
+        :param candle_workers: 同时下载K线的批数
+        :param batch: 每批最多的币种数
+        :param refresh: 刷新显示的最短间隔秒数
         """
         assert isinstance(days, int) and 0 < days <= 90
-        funding_rate_list = await self.get_recent_rate(days)
-        funding_rate_list.sort(key=lambda x: x['funding_rate'], reverse=True)
-        funding_rate_list = funding_rate_list[:20]
-        funding_rate_list = [n['instrument'] for n in await trading_data.Stat().profitability(funding_rate_list, days)]
-        await self.show_selected_rate(funding_rate_list)
+        begin = time.monotonic()
+        instruments = await self.get_instruments_ID()
+        # 资金费矩阵已下载时不再逐个下载
+        stats = self.funding_stats(days) if self.history_ready(days) else None
+        means = dict(zip(stats['instruments'], stats['mean'])) if stats else dict()
+        funding_limit = asyncio.Semaphore(workers)
+        stat = trading_data.Stat()
+        # 已到达的平均资金费前candidates名，最小堆
+        leaders: List[tuple] = []
+        # 等待下载K线的 (平均资金费, instId)
+        queue: asyncio.Queue = asyncio.Queue()
+        results: Dict[str, dict] = dict()
+        first_result = shown = 0.
+        done = 0
+        previous = []
+
+        async def screen(instId):
+            if stats:
+                if np.isnan(rate := means.get(instId, np.nan)):
+                    return
+            else:
+                try:
+                    async with funding_limit:
+                        history = await self.funding_history(instId=instId, limit=days * 3)
+                except (aiohttp.ClientError, OkexRequestException) as e:
+                    fprint(instId, e)
+                    return
+                if len(history) < days * 3:
+                    return
+                rate = float(np.mean([float(n['realizedRate']) for n in history]))
+            # 不在目前的前candidates名，最终也不会在
+            if len(leaders) < candidates:
+                heapq.heappush(leaders, (rate, instId))
+            elif rate > leaders[0][0]:
+                heapq.heapreplace(leaders, (rate, instId))
+            else:
+                return
+            queue.put_nowait((rate, instId))
+
+        async def spot_candles(instrument):
+            try:
+                return await stat.get_candles(instrument + '-USDT', days)
+            except (aiohttp.ClientError, OkexRequestException) as e:
+                # 没有现货或网络异常
+                fprint(instrument, e)
+                return []
+
+        async def score():
+            while True:
+                items = [await queue.get()]
+                while len(items) < batch and not queue.empty():
+                    items.append(queue.get_nowait())
+                # 排队期间已被挤出前candidates名
+                if selected := [n for n in items if n in leaders]:
+                    coins = [n[1][:n[1].find('-')] for n in selected]
+                    _, candles = trading_data.candle_matrix(await asyncio.gather(*[spot_candles(m) for m in coins]))
+                    natr = trading_data.volatility(candles, days * 1440 // trading_data.bar_minutes('4H'))['natr']
+                    for (rate, instId), coin, atr in zip(selected, coins, natr):
+                        results[instId] = dict(instId=instId, instrument=coin, funding_rate=rate,
+                                               profitability=int(rate / np.sqrt(atr) * 10000) if atr > 0 else 0)
+                    publish()
+                for _ in items:
+                    queue.task_done()
+
+        def ranking():
+            admitted = {n[1] for n in leaders}
+            return heapq.nlargest(top, (n for n in results.values() if n['instId'] in admitted),
+                                  key=lambda n: (n['profitability'], n['funding_rate']))
+
+        def display(ranked):
+            fprint(coin_funding_value)
+            for n in ranked:
+                fprint(f"{n['instrument']:9s}{n['funding_rate']:7.3%}"
+                       f"{n['funding_rate'] * 3 * 365:8.2%}{n['profitability']:8d}")
+
+        def publish():
+            nonlocal first_result, shown, previous
+            first_result = first_result or time.monotonic() - begin
+            if (ranked := ranking()) != previous and time.monotonic() - shown >= refresh:
+                fprint(screen_progress.format(done, len(instruments), time.monotonic() - begin))
+                display(ranked)
+                previous, shown = ranked, time.monotonic()
+
+        scorers = [asyncio.create_task(score()) for _ in range(candle_workers)]
+        try:
+            for task in asyncio.as_completed([screen(m) for m in instruments]):
+                await task
+                done += 1
+            joined = asyncio.create_task(queue.join())
+            await asyncio.wait([joined, *scorers], return_when=asyncio.FIRST_COMPLETED)
+            for n in scorers:
+                if n.done():
+                    # 计算出错
+                    n.result()
+        finally:
+            for n in scorers:
+                n.cancel()
+        ranked = ranking()
+        if ranked != previous:
+            display(ranked)
+        fprint(screen_time.format(first_result, time.monotonic() - begin))
+        await self.show_selected_rate([n['instrument'] for n in ranked])
 
     async def show_selected_rate(self, coinlist):
         """显示列表币种当前资金费
         """
-        task_list = [self.publicAPI.get_funding_time(instId=n + '-USDT-SWAP') for n in coinlist]
+        instruments = [n + '-USDT-SWAP' for n in coinlist]
+        await self.wait_stream(instruments)
+        task_list = [self.get_funding_time(m) for m in instruments]
         funding_rate_list = []
         for funding_time in await asyncio.gather(*task_list):
             instrument = funding_time['instId'][:funding_time['instId'].find('-')]
@@ -64,6 +64,9 @@ main_menu_text = _("""
 4   Portfolio related
 5   Fetch ticker
 6   Task manager
+7   Capture market data
+8   Sweep premium thresholds
+9   Opportunity scanner
 q   Quit
 """)
 # """
@@ -73,6 +76,9 @@ q   Quit
 # 4   账户数据
 # 5   记录行情
 # 6   任务管理器
+# 7   采集行情原始数据
+# 8   回测期现差价阈值参数
+# 9   实时套利机会排名
 # q   退出
 # """
 
@@ -106,6 +112,8 @@ funding_menu_text = _("""
 4   Last x days funding rates for all
 5   Last 30 days funding rates for all
 6   Write 30 days funding rates to file
+7   Open basket
+8   Backtest funding carry
 b   Back
 """)
 # """
@@ -115,6 +123,8 @@ b   Back
 # 4   显示全币种最近x天资金费
 # 5   显示全币种最近30天资金费
 # 6   写入最近30天资金费
+# 7   多币种同时建仓
+# 8   回测资金费套利选币规则
 # b   返回
 # """
 
@@ -124,6 +134,7 @@ account_menu_text = _("""
 3   History PnL
 4   Cumulative PnL
 5   Delete record
+6   Close all
 b   Back
 """)
 # """
@@ -132,6 +143,7 @@ b   Back
 # 3   历史收益
 # 4   累计收益
 # 5   删除记录
+# 6   全部平仓
 # b   返回
 # """
 
@@ -139,11 +151,13 @@ manager_menu = _("""
 1   Task list
 2   Remove completed tasks
 3   Stop all
+4   REST request metrics
 b   Back""")
 # """
 # 1   任务列表
 # 2   清理已完成
 # 3   全部停止
+# 4   请求统计
 # b   返回"""
 
 manager_sub_menu = _("""
@@ -401,3 +415,90 @@ input_q_abort = _('Input q to abort\n')
 
 network_interruption = _('Network interruption')
 # "网络中断"
+
+lane_metrics = _('Lane          Queued  Active  Served  Avg wait  Max wait  Latency')
+# "通道          排队    进行中  已完成  平均等待  最长等待  延迟"
+
+circuit_open = _('Endpoints failing, no new orders: {}')
+# "接口故障，暂停下单：{}"
+
+chase_timeout = _('Chasing {} timed out, taking {} with IOC')
+# "{}追单超时，以IOC成交{}"
+
+input_fast_exit = _('Enter y to exit at market without premium check, otherwise close at premium\n')
+# "输入y不看溢价市价退出，否则按溢价平仓\n"
+
+fast_exit = _('Market exit of {:d} coins, {:d} orders')
+# "市价退出{:d}个币种，共{:d}单"
+
+exit_order_failed = _('{} market order failed: {}')
+# "{}市价单失败：{}"
+
+close_progress_title = _('Coin      Closed          Remaining       USDT released')
+# "币种      已平仓          剩余            释放USDT"
+
+close_progress_row = _('{:10s}{:<16f}{:<16f}{:<16.2f}{}')
+# "{:10s}{:<16f}{:<16f}{:<16.2f}{}"
+
+done_text = _('Done')
+# "完成"
+
+input_basket = _('Input coins with optional weights, e.g. BTC:2 ETH:1 DOT\n')
+# "输入币种及权重，如BTC:2 ETH:1 DOT\n"
+
+basket_extra = _('{} received {:.2f} USDT from finished coins')
+# "{}获得已结束币种的{:.2f} USDT"
+
+basket_released = _('{} finished, {:.2f} USDT returned to the basket')
+# "{}结束，{:.2f} USDT退回预算"
+
+schedule_progress = _('{} filled {:f}, planned {:f}, tracking error {:.2%}')
+# "{}已成交{:f}，计划{:f}，跟踪误差{:.2%}"
+
+tracking_error = _('{} schedule tracking error: {:.2%}')
+# "{}计划跟踪误差：{:.2%}"
+
+resync_metrics = _('Depth channel                 Resyncs Avg recovery  Max recovery')
+# "深度频道                      重新订阅 平均恢复  最长恢复"
+
+capture_market = _('Capturing raw market data into {}')
+# "采集行情原始数据到{}"
+
+capture_rate = _('{:.0f} frames/s, received {:.1f} KB/s, written {:.1f} KB/s')
+# "每秒{:.0f}条推送，接收{:.1f} KB/s，写入{:.1f} KB/s"
+
+sweep_coin = _('{} premium threshold backtest, best first')
+# "{}期现差价阈值回测，从优到劣"
+
+sweep_header = _('sigma lookback accelerate  chunk completed  fills       net  hours')
+# "倍数  统计小时 加速小时    比例  完成比例  成交次数  净收益  小时"
+
+sweep_rate = _('{} sweep: {} configs, {:.1f} configs/s')
+# "{}参数回测：{}组，每秒{:.1f}组"
+
+sweep_recommended = _('Recommended {} parameters: sigma {}, lookback {} h, accelerate after {} h, chunk {}, net {:.4%}')
+# "推荐{}参数：{}倍标准差，统计{}小时，{}小时后加速，每次{}，净收益{:.4%}"
+
+carry_backtest = _('{} coins, {} settlements, {} rules backtested in {:.2f} s')
+# "{}个币种，{}次结算，{}个规则，回测用时{:.2f}秒"
+
+carry_header = _(' Days   Vol  Top Every    Carry    Cost      Net      APR Turnover Drawdown')
+# " 天数 波动率 币种数 调仓天数 资金费  成本    净收益    年化   换手  最大回撤"
+
+carry_current = _('Top 10 for arbitrage, 7 days:')
+# "显示收益最高十个币种，7天："
+
+scanner_updated = _('Top {} opportunities, updated {:.1f} s ago')
+# "前{}个套利机会，{:.1f}秒前更新"
+
+scanner_header = _('Crypto    Funding     Next  Premium    Entry     Exit    Carry  Capture    Score')
+# "币种       资金费     预测   期现差价  开仓阈值  平仓阈值  资金费收益 差价收益  预期收益"
+
+screen_progress = _('{}/{} instruments, {:.1f} s')
+# "{}/{}个合约，{:.1f}秒"
+
+screen_time = _('First result in {:.1f} s, finished in {:.1f} s')
+# "{:.1f}秒出现第一个结果，{:.1f}秒完成"
+
+chunk_failed = _('{} hedge chunk failed, not booked: {!r}')
+# "{}一组对冲失败，未记账：{!r}"
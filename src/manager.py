@@ -1,4 +1,6 @@
 from collections import OrderedDict
+from okex.client import Client
+from src.websocket import resync_metrics
 from src.utils import *
 
 
@@ -56,6 +58,17 @@ class Manager:
             print(f'{i + 1}   {task.get_name()}')
         print('b   Back')
 
+    @staticmethod
+    def show_metrics():
+        print(lang.lane_metrics)
+        for name, m in Client.scheduler.metrics().items():
+            print(f"{name:14s}{m['queued']:<8d}{m['active']:<8d}{m['served']:<8d}"
+                  f"{m['avg_wait']:<10.3f}{m['max_wait']:<10.3f}{m['avg_latency']:.3f}")
+        if metrics := resync_metrics():
+            print(lang.resync_metrics)
+            for name, m in metrics.items():
+                print(f"{name:30s}{m['resyncs']:<8d}{m['avg_recovery']:<14.3f}{m['max_recovery']:.3f}")
+
     async def join(self):
         await asyncio.gather(*self.tasks.keys())
 
@@ -79,6 +92,8 @@ class Manager:
                 self.clear()
             elif command == '3':
                 await self.stop()
+            elif command == '4':
+                self.show_metrics()
             elif command == 'b':
                 return
             else:
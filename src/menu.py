@@ -2,11 +2,16 @@ from src.close_position import ReducePosition
 from src.funding_rate import FundingRate
 from src.monitor import Monitor
 from src.open_position import AddPosition
+from src.scanner import Scanner
+from src.sweep import load_params
 from src.trading_data import Stat
 from src.okex_api import *
 from src.lang import *
 from src.utils import *
+import src.capture as capture
+import src.carry as carry
 import src.record as record
+import src.sweep as sweep
 
 loop = asyncio.get_event_loop()
 
@@ -132,22 +137,88 @@ async def back_track_all(accountid: int):
         fprint(back_track_funding.format(coin, inserted))
 
 
-async def close_all(accountid: int):
-    """全部平仓
+async def close_all(accountid: int, fast=False):
+    """全部平仓，各币种同时进行，共用REST限速
 
     :param accountid: 账号id
+    :param fast: 不看期现溢价，批量市价退出
     """
+    coinlist = await get_coinlist(accountid)
+    positions = await gather(*[ReducePosition(coin=coin, account=accountid) for coin in coinlist])
+    # 已下线的币种
+    positions = [n for n in positions if n.exist]
+    if fast:
+        await ReducePosition.market_exit(positions)
+        return
     fundingRate = FundingRate()
-    for coin in await get_coinlist(accountid):
+    rates = await gather(*[fundingRate.current(n.coin + '-USDT-SWAP') for n in positions])
+    closing, tasks = [], []
+    for reducePosition, current_rate in zip(positions, rates):
+        coin = reducePosition.coin
         stat = Stat(coin=coin)
         if recent := stat.recent_close_stat(4):
             close_pd = recent['avg'] - 2 * recent['std']
-            fprint(funding_close.format(coin, await fundingRate.current(coin + '-USDT-SWAP'),
-                                        recent['avg'], recent['std'], recent['min'], close_pd))
-            reducePosition = await ReducePosition(coin=coin, account=accountid)
-            await reducePosition.close(close_pd, 2)
+            fprint(funding_close.format(coin, current_rate, recent['avg'], recent['std'], recent['min'], close_pd))
+            closing.append(reducePosition)
+            tasks.append(await reducePosition.close(close_pd, 2))
         else:
             fprint(fetch_ticker_first)
+    await close_progress(closing, tasks)
+
+
+async def close_progress(positions: List[ReducePosition], tasks: List[asyncio.Future], interval=10):
+    """定时显示各币种平仓进度，直到全部完成
+
+    :param positions: 各币种的ReducePosition
+    :param tasks: 对应的平仓任务
+    :param interval: 显示间隔秒数
+    """
+    pending = set(tasks)
+    while pending:
+        _, pending = await asyncio.wait(pending, timeout=interval)
+        fprint(close_progress_title)
+        for reducePosition, task in zip(positions, tasks):
+            fprint(close_progress_row.format(reducePosition.coin, reducePosition.swap_filled_sum,
+                                             reducePosition.target_position, reducePosition.usdt_release,
+                                             done_text if task.done() else ''))
+
+
+async def open_basket(accountid: int):
+    """按权重同时建仓多个币种
+
+    :param accountid: 账号id
+    """
+    weights = dict()
+    for n in (await ainput(loop, input_basket)).upper().split():
+        coin, _, weight = n.partition(':')
+        try:
+            weights[coin] = float(weight) if weight else 1.
+            assert weights[coin] > 0
+        except (ValueError, AssertionError):
+            fprint(wrong_command)
+            return
+    while True:
+        try:
+            usdt = float(await ainput(loop, input_USDT))
+            assert usdt >= 0
+        except:
+            continue
+        try:
+            leverage = float(await ainput(loop, input_leverage))
+            assert leverage > 0
+        except:
+            continue
+        break
+    hours = 2
+    price_diff = dict()
+    for coin in list(weights):
+        if recent := Stat(coin).recent_open_stat(hours):
+            price_diff[coin] = recent['avg'] + 2 * recent['std']
+        else:
+            fprint(coin, fetch_ticker_first)
+            weights.pop(coin)
+    if weights:
+        loop.create_task(AddPosition.open_basket(weights, usdt, leverage, price_diff, hours, accountid))
 
 
 async def import_position(accountid: int, coin: str):
@@ -221,6 +292,21 @@ async def main_menu(accountid: int):
                 process.join(0.2)
             elif command == '6':
                 await manager.menu()
+            elif command == '7':
+                multiprocessing.set_start_method('spawn', True)
+                capture_process = multiprocessing.Process(target=capture.capture_market)
+                capture_process.start()
+                capture_process.join(0.2)
+            elif command == '8':
+                await loop.run_in_executor(None, sweep.sweep_recorded)
+            elif command == '9':
+                Scanner(accountid).start()
+                # 至少刷新min_samples次才有排名
+                for _ in range(20):
+                    if Scanner.table or Scanner.task.done():
+                        break
+                    await asyncio.sleep(0.5)
+                Scanner.show()
             elif command == 'q':
                 break
             else:
@@ -229,6 +315,9 @@ async def main_menu(accountid: int):
     finally:
         if 'process' in locals():
             process.kill()
+        if 'capture_process' in locals():
+            capture_process.kill()
+        Scanner.stop()
         await Stat.aclose()
         await Monitor.aclose()
         await FundingRate.aclose()
@@ -263,11 +352,11 @@ async def crypto_menu(accountid: int):
                     continue
                 addPosition = await AddPosition(coin=coin, account=accountid)
                 stat = Stat(coin)
-                hours = 2
-                if recent := stat.recent_open_stat(hours):
-                    open_pd = recent['avg'] + 2 * recent['std']
+                params = load_params('open', coin)
+                if recent := stat.recent_open_stat(params['lookback']):
+                    open_pd = recent['avg'] + params['sigma'] * recent['std']
                     add_task = await addPosition.open(usdt_size=usdt, leverage=leverage, price_diff=open_pd,
-                                                      accelerate_after=hours)
+                                                      accelerate_after=params['accelerate_after'])
 
                     async def _():
                         await add_task
@@ -286,10 +375,11 @@ async def crypto_menu(accountid: int):
                     continue
                 reducePosition = await ReducePosition(coin=coin, account=accountid)
                 stat = Stat(coin)
-                hours = 2
-                if recent := stat.recent_close_stat(hours):
-                    close_pd = recent['avg'] - 2 * recent['std']
-                    await reducePosition.reduce(usdt_size=usdt, price_diff=close_pd, accelerate_after=hours)
+                params = load_params('close', coin)
+                if recent := stat.recent_close_stat(params['lookback']):
+                    close_pd = recent['avg'] - params['sigma'] * recent['std']
+                    await reducePosition.reduce(usdt_size=usdt, price_diff=close_pd,
+                                                accelerate_after=params['accelerate_after'])
                 else:
                     fprint(fetch_ticker_first)
                 break
@@ -308,10 +398,10 @@ async def crypto_menu(accountid: int):
         elif command == '5':
             reducePosition = await ReducePosition(coin=coin, account=accountid)
             stat = Stat(coin)
-            hours = 2
-            if recent := stat.recent_close_stat(hours):
-                close_pd = recent['avg'] - 2 * recent['std']
-                await reducePosition.close(price_diff=close_pd, accelerate_after=hours)
+            params = load_params('close', coin)
+            if recent := stat.recent_close_stat(params['lookback']):
+                close_pd = recent['avg'] - params['sigma'] * recent['std']
+                await reducePosition.close(price_diff=close_pd, accelerate_after=params['accelerate_after'])
             else:
                 fprint(fetch_ticker_first)
         elif command == '6':
@@ -383,6 +473,10 @@ async def funding_menu(accountid: int):
             await fundingRate.show_nday_rate(30)
         elif command == '6':
             await fundingRate.print_30day_rate()
+        elif command == '7':
+            await open_basket(accountid)
+        elif command == '8':
+            await carry.show_carry_backtest(fundingRate)
         elif command == 'b':
             break
         else:
@@ -414,6 +508,9 @@ async def account_menu(accountid: int):
             Record = record.Record('Ledger')
             delete_result = Record.mycol.delete_many(dict(account=accountid, instrument=coin))
             fprint(deleted.format(delete_result.deleted_count))
+        elif command == '6':
+            command = await ainput(loop, input_fast_exit)
+            await close_all(accountid=accountid, fast=command == 'y')
         elif command == 'b':
             break
         else:
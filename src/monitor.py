@@ -1,6 +1,9 @@
+from okex.client import CircuitBreaker
+from okex.exceptions import OkexRequestException
 from src.close_position import ReducePosition
 from src.funding_rate import FundingRate
 from src.open_position import AddPosition
+from src.sweep import load_params
 from src.okex_api import *
 
 
@@ -101,8 +104,12 @@ class Monitor(OKExAPI):
         spot_trade_fee, swap_trade_fee, liquidation_price = await gather(self.spot_trade_fee(), self.swap_trade_fee(),
                                                                          self.liquidation_price())
         trade_fee = spot_trade_fee + swap_trade_fee
+        # 回测得出的期现差价阈值参数
+        open_params, close_params = load_params('open', self.coin), load_params('close', self.coin)
 
         task_started = False
+        # 上次输出的故障接口，变化时才再输出
+        failing: List[str] = []
         time_to_accelerate = None
         accelerated = False
         adding = reducing = False
@@ -161,6 +168,13 @@ class Monitor(OKExAPI):
                     last = float(swap_ticker['last'])
                     # 线程未创建
                     if not task_started:
+                        # 接口故障时不开新任务
+                        if open_endpoints := CircuitBreaker.open_endpoints():
+                            if open_endpoints != failing:
+                                fprint(lang.circuit_open.format(', '.join(open_endpoints)))
+                                failing = open_endpoints
+                            continue
+                        failing = []
                         # 接近强平价，现货减仓
                         if liquidation_price < last * (1 + 1 / (leverage + 1)):
                             if not await self.is_hedged():
@@ -173,9 +187,10 @@ class Monitor(OKExAPI):
                                           title='自动减仓')
                             Ledger.mycol.insert_one(mydict)
 
-                            # 期现差价控制在2个标准差
-                            assert (recent := Stat.recent_close_stat()), lang.fetch_ticker_first
-                            close_pd = recent['avg'] - 2 * recent['std']
+                            # 期现差价控制在sigma个标准差
+                            assert (recent := Stat.recent_close_stat(close_params['lookback'])), \
+                                lang.fetch_ticker_first
+                            close_pd = recent['avg'] - close_params['sigma'] * recent['std']
 
                             swap_position = await self.swap_position()
                             target_size = swap_position / (leverage + 1) ** 2
@@ -185,7 +200,8 @@ class Monitor(OKExAPI):
                             reduce_task = await reducePosition.reduce(target_size=target_size, price_diff=close_pd)
                             task_started = True
                             reducing = True
-                            time_to_accelerate = datetime.utcnow() + timedelta(hours=2)
+                            time_to_accelerate = datetime.utcnow() + timedelta(
+                                hours=close_params['accelerate_after'])
 
                         # 保证金过多，现货加仓
                         if margin_reducible and liquidation_price > last * (1 + 1 / (leverage - 1)):
@@ -199,9 +215,10 @@ class Monitor(OKExAPI):
                                           title='自动加仓')
                             Ledger.mycol.insert_one(mydict)
 
-                            # 期现差价控制在2个标准差
-                            assert (recent := Stat.recent_open_stat()), lang.fetch_ticker_first
-                            open_pd = recent['avg'] + 2 * recent['std']
+                            # 期现差价控制在sigma个标准差
+                            assert (recent := Stat.recent_open_stat(open_params['lookback'])), \
+                                lang.fetch_ticker_first
+                            open_pd = recent['avg'] + open_params['sigma'] * recent['std']
 
                             if not addPosition:
                                 addPosition = await AddPosition(self.coin, self.account)
@@ -212,7 +229,8 @@ class Monitor(OKExAPI):
                                 add_task = await addPosition.add(usdt_size=usdt_size, price_diff=open_pd)
                                 task_started = True
                                 adding = True
-                                time_to_accelerate = datetime.utcnow() + timedelta(hours=2)
+                                time_to_accelerate = datetime.utcnow() + timedelta(
+                                    hours=open_params['accelerate_after'])
                             else:
                                 # Liquidation price can't be less than open price.
                                 fprint(lang.no_margin_reduce)
@@ -237,14 +255,16 @@ class Monitor(OKExAPI):
                                 reduce_task = await reducePosition.reduce(target_size=target_size, price_diff=close_pd)
                                 reducing = True
                                 accelerated = True
-                                time_to_accelerate = datetime.utcnow() + timedelta(hours=2)
+                                time_to_accelerate = datetime.utcnow() + timedelta(
+                                    hours=close_params['accelerate_after'])
 
                             if timestamp > time_to_accelerate:
                                 reducePosition.exitFlag = True
                                 while not reduce_task.done():
                                     await asyncio.sleep(0.1)
 
-                                assert (recent := Stat.recent_close_stat(2)), lang.fetch_ticker_first
+                                hours = close_params['accelerate_after']
+                                assert (recent := Stat.recent_close_stat(hours)), lang.fetch_ticker_first
                                 close_pd = recent['avg'] - 2 * recent['std']
 
                                 liquidation_price, swap_position = await gather(self.liquidation_price(),
@@ -252,14 +272,15 @@ class Monitor(OKExAPI):
                                 target_size = swap_position * (1 - liquidation_price / last / (1 + 1 / leverage))
                                 reduce_task = await reducePosition.reduce(target_size=target_size, price_diff=close_pd)
                                 reducing = True
-                                time_to_accelerate = datetime.utcnow() + timedelta(hours=2)
+                                time_to_accelerate = datetime.utcnow() + timedelta(hours=hours)
                         elif adding and not add_task.done():
                             if timestamp > time_to_accelerate:
                                 addPosition.exitFlag = True
                                 while not add_task.done():
                                     await asyncio.sleep(0.1)
 
-                                assert (recent := Stat.recent_open_stat(2)), lang.fetch_ticker_first
+                                hours = open_params['accelerate_after']
+                                assert (recent := Stat.recent_open_stat(hours)), lang.fetch_ticker_first
                                 open_pd = recent['avg'] + 2 * recent['std']
 
                                 # liquidation_price = await self.liquidation_price()
@@ -268,7 +289,7 @@ class Monitor(OKExAPI):
                                 if (usdt_size := usdt_size - add_task.result()) > 0:
                                     add_task = await addPosition.add(usdt_size=usdt_size, price_diff=open_pd)
                                     adding = True
-                                    time_to_accelerate = datetime.utcnow() + timedelta(hours=2)
+                                    time_to_accelerate = datetime.utcnow() + timedelta(hours=hours)
                         else:
                             liquidation_price = await self.liquidation_price()
                             adding = reducing = task_started = False
@@ -277,3 +298,6 @@ class Monitor(OKExAPI):
             except aiohttp.ClientError:
                 print(lang.network_interruption)
                 await asyncio.sleep(30)
+            except OkexRequestException as e:
+                fprint(e)
+                await asyncio.sleep(10)
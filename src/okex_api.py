@@ -5,7 +5,7 @@ from okex.exceptions import OkexException, OkexAPIException
 from src.config import Key
 from src.record import Record
 import src.trading_data as trading_data
-from src.websocket import subscribe_without_login
+from src.websocket import subscribe_without_login, to_quote
 from src.manager import *
 from asyncio import create_task, gather
 
@@ -22,6 +22,16 @@ class OKExAPI:
     accountAPI: AccountAPI
     tradeAPI: TradeAPI
     publicAPI: PublicAPI
+    # 同时在途的对冲订单组数
+    chunks_in_flight = 3
+    # 追单改价间隔秒数、相对原下单价的最大滑点、超时秒数
+    chase_interval = 0.5
+    max_slippage = 0.01
+    chase_timeout = 10
+    # 交易循环的盘口来源：tickers、books5或bbo-tbt
+    quote_channel = 'books5'
+    # 交易循环的行情流，接口同subscribe_without_login，回放时由Replay.install()替换
+    market_stream = staticmethod(subscribe_without_login)
 
     def __init__(self, coin: str = None, account=3):
         self.account = account
@@ -57,6 +67,8 @@ class OKExAPI:
             self.swap_info = None
             self.exitFlag = False
             self.exist = True
+            # 交易循环推送的最新盘口 {instId: to_quote()}
+            self.books = dict()
         else:
             self.exist = False
 
@@ -79,6 +91,7 @@ class OKExAPI:
                 self.contract_val = float(self.swap_info['ctVal'])
                 self.tick_size = float(self.swap_info['tickSz'])
                 self.tick_decimals = num_decimals(self.swap_info['tickSz'])
+                self.precision = Precision(self.spot_info, self.swap_info)
             except Exception as e:
                 fprint(f'{type(self).__name__}__await__({self.coin}) error')
                 fprint(e)
@@ -108,6 +121,12 @@ class OKExAPI:
         if not swap_ID: swap_ID = self.swap_ID
         return await self.publicAPI.get_specific_instrument('SWAP', swap_ID)
 
+    async def warm_up(self):
+        """预热连接池，交易期间保持连接
+        """
+        await gather(self.tradeAPI.warm_up(), self.publicAPI.warm_up(1))
+        create_task(self.tradeAPI.keep_warm(asyncio.current_task()))
+
     async def check_account_level(self):
         """检查账户模式，需开通合约交易
         """
@@ -157,6 +176,250 @@ class OKExAPI:
         while (await self.swap_inst())['state'] == 'settlement':
             await asyncio.sleep(1)
 
+    @staticmethod
+    def update_time(*args):
+        """订单或行情的最新更新时间，早于此时间的行情已过期
+
+        :param args: 订单信息或行情
+        :rtype: int
+        """
+        return max((int(n.get('uTime') or n.get('ts') or 0) for n in args if n), default=0)
+
+    async def chase_leg(self, instId: str, side: str, size: str, price: str, reduce_only=False) -> dict:
+        """追单：以最新盘口挂限价单，按间隔改价，超时后在最大滑点内以IOC成交剩余数量
+
+        :param instId: 产品ID
+        :param side: buy或sell
+        :param size: 数量
+        :param price: 原下单价格
+        :param reduce_only: 只减仓
+        :return: 合并后的订单信息
+        """
+        buy = side == 'buy'
+        spot = instId == self.spot_ID
+        # 最差可接受价格
+        limit = float(price) * (1 + self.max_slippage if buy else 1 - self.max_slippage)
+        # 向盘口方向取整，不超出最大滑点
+        limit_price = self.precision.price_str(limit, spot, up=not buy)
+
+        def best_price():
+            book = self.books.get(instId)
+            px = book['asks' if buy else 'bids'][0][0] if book else price
+            # 盘口价格超过最大滑点时取最差可接受价格
+            if (float(px) > limit) if buy else (float(px) < limit):
+                return limit_price
+            return px
+
+        async def take(order_type, sz, px):
+            if spot:
+                return await self.tradeAPI.take_spot_order(instId=instId, side=side, size=sz, price=px,
+                                                           order_type=order_type)
+            else:
+                return await self.tradeAPI.take_swap_order(instId=instId, side=side, size=sz, price=px,
+                                                           order_type=order_type, reduceOnly=reduce_only)
+
+        filled = notional = fee = 0.
+        total = float(size)
+        current = best_price()
+        order = await take('limit', size, current)
+        if order['ordId'] == '-1':
+            return dict(order, state='canceled', accFillSz='0', avgPx='0', fee='0')
+        deadline = time.monotonic() + self.chase_timeout
+        while True:
+            await asyncio.sleep(self.chase_interval)
+            info = await self.tradeAPI.get_order_info(instId=instId, order_id=order['ordId'])
+            if info['state'] in ('filled', 'canceled'):
+                break
+            if time.monotonic() > deadline:
+                cancelled = await self.tradeAPI.cancel_order(instId=instId, order_id=order['ordId'])
+                if cancelled['ordId'] == '-1':
+                    # 撤单时已成交则下次循环退出，否则重新撤单
+                    continue
+                # 撤单生效后accFillSz才是最终成交数量，之后IOC的数量不会超出
+                info = await self.tradeAPI.get_order_info(instId=instId, order_id=order['ordId'])
+                while info['state'] not in ('filled', 'canceled'):
+                    await asyncio.sleep(self.chase_interval)
+                    info = await self.tradeAPI.get_order_info(instId=instId, order_id=order['ordId'])
+                break
+            # 按最新盘口改价
+            if (new_price := best_price()) != current:
+                amended = await self.tradeAPI.amend_order(instId=instId, order_id=order['ordId'], new_price=new_price)
+                if amended['ordId'] != '-1':
+                    current = new_price
+
+        def merge(n: dict):
+            nonlocal filled, notional, fee
+            if fill_size := float(n['accFillSz'] or 0):
+                filled += fill_size
+                notional += fill_size * float(n['avgPx'])
+                fee += float(n['fee'] or 0)
+
+        merge(info)
+        remaining = total - filled
+        if remaining > 0:
+            # 超时，以最大滑点价格IOC成交剩余数量
+            sz = float_str(remaining, num_decimals(size))
+            fprint(lang.chase_timeout.format(instId, sz))
+            order = await take('ioc', sz, limit_price)
+            if order['ordId'] != '-1':
+                info = await self.tradeAPI.get_order_info(instId=instId, order_id=order['ordId'])
+                while info['state'] not in ('filled', 'canceled'):
+                    await asyncio.sleep(self.chase_interval)
+                    info = await self.tradeAPI.get_order_info(instId=instId, order_id=order['ordId'])
+                merge(info)
+        state = 'filled' if total - filled < total * 1e-9 else 'canceled'
+        return dict(info, state=state, accFillSz=str(filled), avgPx=str(notional / filled if filled else 0.),
+                    fee=str(fee))
+
+    async def wait_chunks(self, chunks: List[asyncio.Task]):
+        """等待全部已提交的对冲完成并取回每组的异常。有一组失败时抛出异常，调用者不再记账，保留OP记录
+
+        :param chunks: 全部对冲任务，包括已完成的
+        """
+        failed = [n for n in await gather(*chunks, return_exceptions=True) if isinstance(n, BaseException)]
+        for e in failed:
+            fprint(lang.chunk_failed.format(self.coin, e))
+        if failed:
+            raise failed[0]
+
+    async def hedge_chunk(self, spot_side: str, spot_size: str, spot_price: str, contract_size: str,
+                          swap_price: str):
+        """期现两腿同时FOK下单，其中一腿撤销时追单，直到两腿都成交或都撤销
+
+        :param spot_side: 现货方向，buy为开仓，sell为平仓
+        :param spot_size: 现货数量
+        :param spot_price: 现货价格
+        :param contract_size: 合约张数
+        :param swap_price: 合约价格
+        :return: 现货和合约订单信息，都撤销或失败时返回None
+        """
+        swap_side = 'sell' if spot_side == 'buy' else 'buy'
+        reduce_only = spot_side == 'sell'
+        spot_order_info = swap_order_info = spot_order_state = swap_order_state = dict()
+        # 其他组失败时本组仍需完成追单，只用本组状态判断
+        failed = False
+
+        spot_task = create_task(
+            self.tradeAPI.take_spot_order(instId=self.spot_ID, side=spot_side, size=spot_size, price=spot_price,
+                                          order_type='fok'))
+        swap_task = create_task(
+            self.tradeAPI.take_swap_order(instId=self.swap_ID, side=swap_side, size=contract_size, price=swap_price,
+                                          order_type='fok', reduceOnly=reduce_only))
+        spot_res, swap_res = await gather(spot_task, swap_task, return_exceptions=True)
+
+        if (not isinstance(spot_res, OkexException)) and (not isinstance(swap_res, OkexException)):
+            spot_order, swap_order = spot_task.result(), swap_task.result()
+        # 下单失败
+        else:
+            if isinstance(spot_res, OkexException) and not isinstance(swap_res, OkexException):
+                swap_order = swap_task.result()
+                swap_order_info = await self.tradeAPI.get_order_info(instId=self.swap_ID, order_id=swap_order['ordId'])
+                fprint(swap_order_info)
+                fprint(spot_res)
+            elif isinstance(swap_res, OkexException) and not isinstance(spot_res, OkexException):
+                spot_order = spot_task.result()
+                if getattr(swap_res, 'code', '') in ('50026', '51022'):
+                    fprint(lang.futures_market_down)
+                spot_order_info = await self.tradeAPI.get_order_info(instId=self.spot_ID, order_id=spot_order['ordId'])
+                fprint(spot_order_info)
+                fprint(swap_res)
+            else:
+                fprint(spot_res)
+                fprint(swap_res)
+            self.exitFlag = True
+            return None
+
+        async def check_order():
+            nonlocal spot_order_info, swap_order_info, spot_order_state, swap_order_state, failed
+            # 查询订单信息
+            if spot_order['ordId'] != '-1' and swap_order['ordId'] != '-1':
+                spot_order_info, swap_order_info = await gather(
+                    self.tradeAPI.get_order_info(instId=self.spot_ID, order_id=spot_order['ordId']),
+                    self.tradeAPI.get_order_info(instId=self.swap_ID, order_id=swap_order['ordId']))
+                spot_order_state = spot_order_info['state']
+                swap_order_state = swap_order_info['state']
+            # 下单失败
+            else:
+                if spot_order['ordId'] == '-1':
+                    fprint(lang.spot_order_failed)
+                    fprint(spot_order)
+                    failed = True
+                else:
+                    fprint(lang.swap_order_failed)
+                    fprint(swap_order)
+                    if swap_order['code'] in ('50023', '51030'):
+                        kwargs = dict(instId=self.spot_ID, order_id=spot_order['ordId'])
+                        spot_order_info = await self.tradeAPI.get_order_info(**kwargs)
+                        spot_order_state = spot_order_info['state']
+                        await self.funding_settled()
+                        swap_order_state = 'canceled'
+                    else:
+                        if swap_order['code'] in ('50026', '51022'):
+                            fprint(lang.futures_market_down)
+                        failed = True
+
+        await check_order()
+        if failed:
+            self.exitFlag = True
+            return None
+
+        # 其中一单撤销，追单
+        while spot_order_state != 'filled' or swap_order_state != 'filled':
+            if spot_order_state == 'filled':
+                if swap_order_state == 'canceled':
+                    fprint(lang.swap_order_retract, swap_order_state)
+                    try:
+                        swap_order_info = await self.chase_leg(self.swap_ID, swap_side, contract_size, swap_price,
+                                                               reduce_only)
+                    except OkexException as e:
+                        fprint(e)
+                        failed = True
+                        break
+                    swap_order_state = swap_order_info['state']
+                    if swap_order_state != 'filled':
+                        fprint(lang.swap_order_state, swap_order_state)
+                        failed = True
+                        break
+                    continue
+                else:
+                    fprint(lang.swap_order_state, swap_order_state)
+                    fprint(lang.await_status_update)
+            elif swap_order_state == 'filled':
+                if spot_order_state == 'canceled':
+                    fprint(lang.spot_order_retract, spot_order_state)
+                    try:
+                        spot_order_info = await self.chase_leg(self.spot_ID, spot_side, spot_size, spot_price)
+                    except OkexException as e:
+                        fprint(e)
+                        failed = True
+                        break
+                    spot_order_state = spot_order_info['state']
+                    if spot_order_state != 'filled':
+                        fprint(lang.spot_order_state, spot_order_state)
+                        failed = True
+                        break
+                    continue
+                else:
+                    fprint(lang.spot_order_state, spot_order_state)
+                    fprint(lang.await_status_update)
+            elif spot_order_state == 'canceled' and swap_order_state == 'canceled':
+                # fprint(lang.both_order_failed)
+                break
+            else:
+                fprint(lang.await_status_update)
+
+            await check_order()
+            if failed:
+                break
+
+        if spot_order_state == 'filled' and swap_order_state == 'filled':
+            return spot_order_info, swap_order_info
+        elif spot_order_state == 'canceled' and swap_order_state == 'canceled':
+            return None
+        else:
+            self.exitFlag = True
+            return None
+
     async def swap_holding(self, swap_ID=None):
         """获取合约持仓
         """
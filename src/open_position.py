@@ -1,3 +1,5 @@
+from src.allocator import USDTAllocator
+from src.scheduler import Schedule
 from src.okex_api import *
 
 
@@ -104,7 +106,8 @@ class AddPosition(OKExAPI):
             return 0
 
     @manager.submit
-    async def add(self, usdt_size=0.0, target_size=0.0, leverage=0, price_diff=0.002, accelerate_after=0):
+    async def add(self, usdt_size=0.0, target_size=0.0, leverage=0, price_diff=0.002, accelerate_after=0,
+                  horizon=0, allocator: USDTAllocator = None):
         """加仓期现组合
 
         :param usdt_size: U本位目标仓位
@@ -112,6 +115,8 @@ class AddPosition(OKExAPI):
         :param leverage: 杠杆
         :param price_diff: 期现差价
         :param accelerate_after: 几小时后加速
+        :param horizon: 按TWAP计划在几小时内完成，代替accelerate_after
+        :param allocator: 多币种同时建仓时的USDT预算，代替账户余额
         :return: 加仓金额
         :rtype: float
         """
@@ -123,8 +128,13 @@ class AddPosition(OKExAPI):
             target_position = target_size
         fprint(self.coin, lang.amount_to_add, target_position)
 
-        # 查询现货手续费率, 账户余额
-        trade_fee, usdt_balance = await gather(self.spot_trade_fee(), self.usdt_balance())
+        # 查询手续费率, 账户余额
+        trade_fee, swap_fee, usdt_balance = await gather(self.spot_trade_fee(), self.swap_trade_fee(),
+                                                         self.usdt_balance())
+        # 手续费为负，两腿吃单成本
+        fee = - trade_fee - swap_fee
+        if allocator:
+            usdt_balance = allocator.reserved[self.coin]
 
         spot_filled_sum = 0.
         swap_filled_sum = 0.
@@ -141,228 +151,160 @@ class AddPosition(OKExAPI):
         OP = Record('OP')
         mydict = dict(account=self.account, instrument=self.coin, op='add', size=target_position)
         OP.insert(mydict)
+        schedule = Schedule(target_position, horizon) if horizon else None
+        # 计划内的期现差价和落后时的最宽期现差价
+        planned_pd = loose_pd = price_diff
 
-        channels = [dict(channel='tickers', instId=self.spot_ID), dict(channel='tickers', instId=self.swap_ID)]
-        spot_ticker = swap_ticker = None
+        channels = [dict(channel=self.quote_channel, instId=self.spot_ID),
+                    dict(channel=self.quote_channel, instId=self.swap_ID)]
+        spot_book = swap_book = None
         self.exitFlag = False
-
-        # 如果仍未建仓完毕
-        while target_position >= self.contract_val and not self.exitFlag:
-            # 下单后重新订阅
-            async for ticker in subscribe_without_login(self.public_url, channels, verbose=False):
-                if self.exitFlag:
-                    break
-                # 判断是否加速
-                if accelerate_after and datetime.utcnow() > time_to_accelerate:
-                    Stat = trading_data.Stat(self.coin)
-                    assert (recent := Stat.recent_open_stat(accelerate_after)), lang.fetch_ticker_first
-                    price_diff = recent['avg'] + 2 * recent['std']
-                    time_to_accelerate = datetime.utcnow() + timedelta(hours=accelerate_after)
-
-                ticker = ticker['data'][0]
-                if ticker['instId'] == self.spot_ID:
-                    spot_ticker = ticker
-                elif ticker['instId'] == self.swap_ID:
-                    swap_ticker = ticker
+        await self.warm_up()
+
+        # 在途订单组及其数量，chunks为本次全部订单组
+        in_flight = set()
+        chunks: List[asyncio.Task] = []
+        pending = 0.
+        accounting = asyncio.Lock()
+
+        async def execute(order_size, spot_size, spot_price, contract_size, swap_price):
+            """执行一组对冲并记账，多组同时在途时只串行记账
+            """
+            nonlocal pending, target_position, usdt_balance, spot_filled_sum, swap_filled_sum, fee_total
+            nonlocal spot_notional, swap_notional
+            try:
+                result = await self.hedge_chunk('buy', spot_size, spot_price, contract_size, swap_price)
+            except Exception:
+                self.exitFlag = True
+                raise
+            finally:
+                pending -= order_size
+            if not result:
+                return
+            spot_order_info, swap_order_info = result
+            async with accounting:
+                # 手续费扣币
+                spot_filled = float(spot_order_info['accFillSz']) + float(spot_order_info['fee'])
+                swap_filled = float(swap_order_info['accFillSz']) * self.contract_val
+                spot_filled_sum += spot_filled
+                swap_filled_sum += swap_filled
+                spot_avg = float(spot_order_info['avgPx'])
+                swap_avg = float(swap_order_info['avgPx'])
+                spot_fee = float(spot_order_info['fee']) * spot_avg
+                swap_fee = float(swap_order_info['fee'])
+                fee_total += spot_fee + swap_fee
+                spot_notional -= spot_filled * spot_avg
+                swap_notional += swap_filled * swap_avg
+
+                # 对冲检查
+                if abs(spot_filled - swap_filled) < self.contract_val:
+                    target_position_prev = target_position
+                    target_position -= swap_filled
+                    fprint(lang.hedge_success.format(swap_filled, self.coin), lang.remaining.format(target_position))
+                    mydict = dict(account=self.account, instrument=self.coin, op='add', size=target_position_prev)
+                    OP.mycol.find_one_and_update(mydict, {'$set': {'size': target_position}})
                 else:
-                    continue
-                if not (spot_ticker and swap_ticker):
-                    continue
-
-                last = float(spot_ticker['last'])
-                # 现货最低买入价
-                best_ask = float(spot_ticker['askPx'])
-                # 合约最高卖出价
-                best_bid = float(swap_ticker['bidPx'])
-
-                # 如果不满足期现溢价
-                if best_bid < best_ask * (1 + price_diff):
-                    # print(f'当前期现差价: {(best_bid - best_ask) / best_ask:.3%} < {price_diff:.3%}')
-                    pass
+                    fprint(lang.hedge_fail.format(self.coin, spot_filled, swap_filled))
+                    self.exitFlag = True
+                    return
+
+                # 没有其他在途订单时更新余额
+                if allocator:
+                    usdt_balance = allocator.reserved[self.coin] + spot_notional + fee_total - swap_notional / leverage
+                    target_position = min(target_position, usdt_balance * leverage / (leverage + 1) / spot_avg)
+                elif len(in_flight) == 1:
+                    usdt_balance = await self.usdt_balance()
+                    target_position = min(target_position, usdt_balance * leverage / (leverage + 1) / spot_avg)
+
+        # 如果仍未建仓完毕，下单后沿用同一行情流，丢弃下单前的行情
+        fresh_after = 0
+        stream = self.market_stream(self.public_url, channels, verbose=False)
+        async for book in stream:
+            if self.exitFlag or (target_position < self.contract_val and not in_flight):
+                break
+            if schedule:
+                # 每个时间片更新近期期现差价，落后于计划时向均值放宽
+                if schedule.next_slice(swap_filled_sum):
+                    if recent := trading_data.Stat(self.coin).recent_open_stat(schedule.window):
+                        loose_pd = min(recent['avg'], planned_pd)
+                    planned = schedule.planned(schedule.elapsed_slices())
+                    fprint(lang.schedule_progress.format(self.coin, swap_filled_sum, planned,
+                                                         schedule.tracking_error()))
+                price_diff = schedule.premium(swap_filled_sum, planned_pd, loose_pd)
+            # 判断是否加速
+            elif accelerate_after and datetime.utcnow() > time_to_accelerate:
+                Stat = trading_data.Stat(self.coin)
+                assert (recent := Stat.recent_open_stat(accelerate_after)), lang.fetch_ticker_first
+                price_diff = recent['avg'] + 2 * recent['std']
+                time_to_accelerate = datetime.utcnow() + timedelta(hours=accelerate_after)
+
+            quote = to_quote(book)
+            # 供追单改价使用
+            self.books[quote['instId']] = quote
+            if quote['ts'] <= fresh_after:
+                continue
+            if quote['instId'] == self.spot_ID:
+                spot_book = quote
+            elif quote['instId'] == self.swap_ID:
+                swap_book = quote
+            else:
+                continue
+            if not (spot_book and swap_book) or len(in_flight) >= self.chunks_in_flight:
+                continue
+            # 其他币种提前结束，领取分给本币种的预算
+            if allocator and (extra := allocator.take_extra(self.coin)):
+                usdt_balance += extra
+                target_position_prev = target_position
+                target_position += extra * leverage / (leverage + 1) / float(spot_book['asks'][0][0])
+                mydict = dict(account=self.account, instrument=self.coin, op='add', size=target_position_prev)
+                OP.mycol.find_one_and_update(mydict, {'$set': {'size': target_position}})
+                fprint(lang.basket_extra.format(self.coin, extra), lang.remaining.format(target_position))
+
+            # 现货扣币后的可得数量
+            spot_asks = [[n[0], float(n[1]) * (1 + trade_fee)] for n in spot_book['asks']]
+            # 按深度计算VWAP溢价满足price_diff的最大数量，以及现货最高买入价、合约最低卖出价，扣除在途数量
+            depth, spot_price, swap_price = depth_size(spot_asks, swap_book['bids'], target_position - pending,
+                                                       price_diff, fee, self.contract_val)
+            # 按计划只放出本时间片的数量，并只吃掉部分深度
+            if schedule:
+                depth = schedule.size(swap_filled_sum, pending, depth)
+
+            # 如果不满足期现溢价
+            if depth < self.contract_val:
+                pass
+            else:
+                last = float(spot_book['asks'][0][0])
+                if usdt_balance < target_position * last * (1 + 1 / leverage):
+                    while usdt_balance < target_position * last * (1 + 1 / leverage):
+                        target_position -= self.min_size
+                    if target_position < self.min_size:
+                        fprint(lang.insufficient_USDT)
+                        self.exitFlag = True
+                        break
                 else:
-                    if usdt_balance < target_position * last * (1 + 1 / leverage):
-                        while usdt_balance < target_position * last * (1 + 1 / leverage):
-                            target_position -= self.min_size
-                        if target_position < self.min_size:
-                            fprint(lang.insufficient_USDT)
-                            self.exitFlag = True
-                            break
+                    # 计算下单数量，考虑现货手续费，分别计算现货数量与合约张数
+                    units, spot_size, contract_size = self.precision.hedge_sizes(depth, trade_fee)
+                    order_size = self.precision.size(units)
+                    # print(order_size, contract_size, spot_size)
+
+                    # 下单，如果资金费不是马上更新
+                    if order_size > 0 and not self.funding_settling():
+                        # 以边际档位价格FOK下单
+                        pending += order_size
+                        task = create_task(execute(order_size, spot_size, spot_price, contract_size, swap_price))
+                        in_flight.add(task)
+                        chunks.append(task)
+                        task.add_done_callback(in_flight.discard)
+                        # 等待下单后的新行情
+                        fresh_after = self.update_time(spot_book, swap_book)
+                        spot_book = swap_book = None
                     else:
-                        # 计算下单数量
-                        best_ask_size = float(spot_ticker['askSz'])
-                        best_bid_size = float(swap_ticker['bidSz'])
-                        # print(best_ask_size, best_bid_size)
-                        # continue
-                        order_size = min(target_position, best_ask_size, best_bid_size * self.contract_val)
-                        order_size = round_to(order_size, self.min_size)
-                        order_size = round_to(order_size, self.contract_val)
-
-                        # 考虑现货手续费，分别计算现货数量与合约张数
-                        spot_size = round_to(order_size / (1 + trade_fee), self.size_increment)
-                        if spot_size > best_ask_size:
-                            order_size -= self.min_size
-                            order_size = round_to(order_size, self.contract_val)
-                            spot_size = round_to(order_size / (1 + trade_fee), self.size_increment)
-                        spot_size = float_str(spot_size, self.size_decimals)
-                        contract_size = round(order_size / self.contract_val)
-                        contract_size = f'{contract_size:d}'
-                        # print(order_size, contract_size, spot_size)
-
-                        spot_order_info = swap_order_info = spot_order_state = swap_order_state = dict()
-                        # 下单，如果资金费不是马上更新
-                        if order_size > 0 and not self.funding_settling():
-                            spot_task = create_task(
-                                self.tradeAPI.take_spot_order(instId=self.spot_ID, side='buy', size=spot_size,
-                                                              price=spot_ticker['askPx'], order_type='fok'))
-                            swap_task = create_task(
-                                self.tradeAPI.take_swap_order(instId=self.swap_ID, side='sell', size=contract_size,
-                                                              price=swap_ticker['bidPx'], order_type='fok'))
-                            spot_res, swap_res = await gather(spot_task, swap_task, return_exceptions=True)
-
-                            if ((not isinstance(spot_res, OkexAPIException)) and
-                                    (not isinstance(swap_res, OkexAPIException))):
-                                spot_order, swap_order = spot_task.result(), swap_task.result()
-                            # 下单失败
-                            else:
-                                if spot_res is OkexAPIException:
-                                    swap_order = swap_task.result()
-                                    kwargs = dict(instId=self.swap_ID, order_id=swap_order['ordId'])
-                                    swap_order_info = await self.tradeAPI.get_order_info(**kwargs)
-                                    fprint(swap_order_info)
-                                    fprint(spot_res)
-                                elif swap_res is OkexAPIException:
-                                    spot_order = spot_task.result()
-                                    if swap_res.code in ('50026', '51022'):
-                                        fprint(lang.futures_market_down)
-                                    kwargs = dict(instId=self.spot_ID, order_id=spot_order['ordId'])
-                                    spot_order_info = await self.tradeAPI.get_order_info(**kwargs)
-                                    fprint(spot_order_info)
-                                    fprint(swap_res)
-                                self.exitFlag = True
-                                break
-
-                            swap_order_info = dict()
-
-                            async def check_order():
-                                nonlocal spot_order_info, swap_order_info, spot_order_state, swap_order_state
-                                # 查询订单信息
-                                if spot_order['ordId'] != '-1' and swap_order['ordId'] != '-1':
-                                    spot_order_info, swap_order_info = await gather(
-                                        self.tradeAPI.get_order_info(instId=self.spot_ID, order_id=spot_order['ordId']),
-                                        self.tradeAPI.get_order_info(instId=self.swap_ID, order_id=swap_order['ordId']))
-                                    spot_order_state = spot_order_info['state']
-                                    swap_order_state = swap_order_info['state']
-                                # 下单失败
-                                else:
-                                    if spot_order['ordId'] == '-1':
-                                        fprint(lang.spot_order_failed)
-                                        fprint(spot_order)
-                                        self.exitFlag = True
-                                    else:
-                                        fprint(lang.swap_order_failed)
-                                        fprint(swap_order)
-                                        if swap_order['code'] in ('50023', '51030'):
-                                            kwargs = dict(instId=self.spot_ID, order_id=spot_order['ordId'])
-                                            spot_order_info = await self.tradeAPI.get_order_info(**kwargs)
-                                            spot_order_state = spot_order_info['state']
-                                            await self.funding_settled()
-                                            swap_order_state = 'canceled'
-                                        else:
-                                            if swap_order['code'] in ('50026', '51022'):
-                                                fprint(lang.futures_market_down)
-                                            self.exitFlag = True
-
-                            await check_order()
-                            if self.exitFlag:
-                                break
-
-                            # 其中一单撤销
-                            while spot_order_state != 'filled' or swap_order_state != 'filled':
-                                # print(spot_order_state+','+swap_order_state)
-                                if spot_order_state == 'filled':
-                                    if swap_order_state == 'canceled':
-                                        fprint(lang.swap_order_retract, swap_order_state)
-                                        try:
-                                            sell_price = round_to(0.99 * best_bid, self.tick_size)
-                                            sell_price = float_str(sell_price, self.tick_decimals)
-                                            kwargs = dict(instId=self.swap_ID, side='sell', size=contract_size,
-                                                          price=sell_price, order_type='limit')
-                                            swap_order = await self.tradeAPI.take_swap_order(**kwargs)
-                                        except OkexAPIException as e:
-                                            fprint(e)
-                                            self.exitFlag = True
-                                            break
-                                    else:
-                                        fprint(lang.swap_order_state, swap_order_state)
-                                        fprint(lang.await_status_update)
-                                elif swap_order_state == 'filled':
-                                    if spot_order_state == 'canceled':
-                                        fprint(lang.spot_order_retract, spot_order_state)
-                                        try:
-                                            buy_price = round_to(1.01 * best_ask, self.tick_size)
-                                            buy_price = float_str(buy_price, self.tick_decimals)
-                                            kwargs = dict(instId=self.spot_ID, side='buy', size=spot_size,
-                                                          price=buy_price, order_type='limit')
-                                            spot_order = await self.tradeAPI.take_spot_order(**kwargs)
-                                        except OkexAPIException as e:
-                                            fprint(e)
-                                            self.exitFlag = True
-                                            break
-                                    else:
-                                        fprint(lang.spot_order_state, spot_order_state)
-                                        fprint(lang.await_status_update)
-                                elif spot_order_state == 'canceled' and swap_order_state == 'canceled':
-                                    # fprint(lang.both_order_failed)
-                                    break
-                                else:
-                                    fprint(lang.await_status_update)
-
-                                await check_order()
-                                if self.exitFlag:
-                                    break
-
-                            # 下单成功
-                            if spot_order_state == 'filled' and swap_order_state == 'filled':
-                                # 手续费扣币
-                                spot_filled = float(spot_order_info['accFillSz']) + float(spot_order_info['fee'])
-                                swap_filled = float(swap_order_info['accFillSz']) * self.contract_val
-                                spot_filled_sum += spot_filled
-                                swap_filled_sum += swap_filled
-                                spot_price = float(spot_order_info['avgPx'])
-                                swap_price = float(swap_order_info['avgPx'])
-                                spot_fee = float(spot_order_info['fee']) * spot_price
-                                swap_fee = float(swap_order_info['fee'])
-                                fee_total += spot_fee + swap_fee
-                                spot_notional -= spot_filled * spot_price
-                                swap_notional += swap_filled * swap_price
-
-                                # 对冲检查
-                                if abs(spot_filled - swap_filled) < self.contract_val:
-                                    target_position_prev = target_position
-                                    target_position -= swap_filled
-                                    fprint(lang.hedge_success.format(swap_filled, self.coin),
-                                           lang.remaining.format(target_position))
-                                    mydict = dict(account=self.account, instrument=self.coin, op='add',
-                                                  size=target_position_prev)
-                                    OP.mycol.find_one_and_update(mydict, {'$set': {'size': target_position}})
-                                else:
-                                    fprint(lang.hedge_fail.format(self.coin, spot_filled, swap_filled))
-                                    self.exitFlag = True
-                                    break
-                            elif spot_order_state == 'canceled' and swap_order_state == 'canceled':
-                                break
-                            else:
-                                self.exitFlag = True
-                                break
-
-                            usdt_balance = await self.usdt_balance()
-                            target_position = min(target_position, usdt_balance * leverage / (leverage + 1) / best_ask)
-                            # print(usdt_balance, target_position)
-                            # 重新订阅
-                            break
-                        else:
-                            # print('订单太小', order_size)
-                            pass
+                        # print('订单太小', order_size)
+                        pass
+
+        await stream.aclose()
+        # 等待全部订单组完成，有一组失败时不记账
+        await self.wait_chunks(chunks)
 
         if spot_notional:
             Ledger = Record('Ledger')
@@ -379,6 +321,9 @@ class AddPosition(OKExAPI):
         OP.delete(mydict)
         await self.update_portfolio()
         fprint(lang.added_amount.format(swap_filled_sum, self.coin))
+        if schedule:
+            schedule.track(swap_filled_sum)
+            fprint(lang.tracking_error.format(self.coin, schedule.tracking_error()))
         if await self.is_hedged():
             fprint(lang.hedge_success.format(swap_filled_sum, self.coin))
         else:
@@ -387,7 +332,8 @@ class AddPosition(OKExAPI):
         return usdt_size
 
     @call_coroutine
-    async def open(self, usdt_size=0.0, target_size=0.0, leverage=2., price_diff=0.002, accelerate_after=0):
+    async def open(self, usdt_size=0.0, target_size=0.0, leverage=2., price_diff=0.002, accelerate_after=0,
+                   allocator: USDTAllocator = None):
         """建仓期现组合
 
         :param usdt_size: U本位目标仓位
@@ -395,6 +341,7 @@ class AddPosition(OKExAPI):
         :param leverage: 杠杆
         :param price_diff: 期现差价
         :param accelerate_after: 几小时后加速
+        :param allocator: 多币种同时建仓时的USDT预算
         :return: 建仓金额
         :rtype: float
         """
@@ -402,7 +349,8 @@ class AddPosition(OKExAPI):
         result = Ledger.find_last(dict(account=self.account, instrument=self.coin))
         if result and result['title'] != '平仓' and (swap_position := await self.swap_position()):
             fprint(lang.position_exist.format(swap_position, self.coin))
-            return await self.add(usdt_size=usdt_size, price_diff=price_diff, accelerate_after=accelerate_after)
+            return await self.add(usdt_size=usdt_size, price_diff=price_diff, accelerate_after=accelerate_after,
+                                  allocator=allocator)
         else:
             usdt_balance = await self.usdt_balance()
             if target_size:
@@ -415,7 +363,55 @@ class AddPosition(OKExAPI):
                 Record('Portfolio').mycol.insert_one(
                     dict(account=self.account, instrument=self.coin, leverage=leverage))
                 await self.set_swap_lever(leverage)
-                return await self.add(usdt_size=usdt_size, price_diff=price_diff, accelerate_after=accelerate_after)
+                return await self.add(usdt_size=usdt_size, price_diff=price_diff, accelerate_after=accelerate_after,
+                                      allocator=allocator)
             else:
                 fprint(lang.insufficient_USDT)
                 return 0.
+
+    @staticmethod
+    async def open_basket(weights: Dict[str, float], usdt_size: float, leverage=2., price_diff: Dict[str, float] = None,
+                          accelerate_after=0, account=3):
+        """按权重同时建仓多个币种，共用一份USDT预算，某个币种提前结束时把剩余预算分给其他币种
+
+        :param weights: {币种: 权重}
+        :param usdt_size: 总USDT
+        :param leverage: 杠杆
+        :param price_diff: {币种: 期现差价}
+        :param accelerate_after: 几小时后加速
+        :param account: 账号id
+        :return: {币种: 建仓金额}
+        """
+        positions = await gather(*[AddPosition(coin=coin, account=account) for coin in weights])
+        positions = [n for n in positions if n.exist]
+        if not positions:
+            return dict()
+        usdt_size = min(usdt_size, await positions[0].usdt_balance())
+        allocator = USDTAllocator(usdt_size, {n.coin: weights[n.coin] for n in positions})
+        if not price_diff: price_diff = dict()
+        # 各币种同时设置杠杆并开始加仓
+        results = await gather(*[n.open(usdt_size=allocator.reserved[n.coin], leverage=leverage,
+                                        price_diff=price_diff.get(n.coin, 0.002), accelerate_after=accelerate_after,
+                                        allocator=allocator) for n in positions])
+        usdt = dict()
+        tasks = dict()
+        for n, result in zip(positions, results):
+            if isinstance(result, asyncio.Future):
+                tasks[result] = n.coin
+            else:
+                usdt[n.coin] = result
+                allocator.release(n.coin, result)
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                coin = tasks[task]
+                if task.exception():
+                    # 用量未知，不再分配
+                    usdt[coin] = allocator.reserved[coin]
+                else:
+                    # 同一币种已有加仓任务时结果为None
+                    usdt[coin] = task.result() or 0.
+                if unused := allocator.release(coin, usdt[coin]):
+                    fprint(lang.basket_released.format(coin, unused))
+        return usdt
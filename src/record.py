@@ -1,3 +1,4 @@
+from okex.exceptions import OkexRequestException
 from okex.public import PublicAPI
 import pymongo
 import src.funding_rate as funding_rate
@@ -38,7 +39,10 @@ class Record:
         self.mycol.delete_one(match)
 
 
+# 本进程在记录行情，资金费率频道的结算也由本进程写入Funding
 recording = False
+# Ticker保留的小时数，回测更长时间需调大
+ticker_hours = 48
 
 
 def record_ticker():
@@ -49,11 +53,52 @@ def record_ticker():
         while True:
             try:
                 loop.run_until_complete(record())
-            except aiohttp.ClientError:
+            except (aiohttp.ClientError, OkexRequestException):
                 print(lang.network_interruption)
                 time.sleep(30)
 
 
+async def record_funding(funding: Record, instrumentsID: List[str], publicAPI: PublicAPI, timeout=120):
+    """记录本期结算的实际资金费。先等待资金费率频道的结算查询，只轮询频道漏掉的合约
+
+    :param funding: Funding集合
+    :param instrumentsID: 全部合约
+    :param publicAPI: PublicAPI实例
+    :param timeout: 等待频道结算查询的最长秒数
+    """
+    if tasks := list(funding_rate.FundingRate.settle_tasks):
+        await asyncio.wait(tasks, timeout=timeout)
+    funding_rate_list = []
+    # 资金费率频道已记录本期结算的合约无需查询历史
+    settled = int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp() * 1000) - 3600 * 1000
+    missing = [m for m in instrumentsID if funding_rate.FundingRate.settled.get(m, 0) < settled]
+    tasks = [publicAPI.get_historical_funding_rate(instId=m) for m in missing]
+    try:
+        res = await asyncio.gather(*tasks)
+    except (aiohttp.ClientError, OkexRequestException):
+        # 下次轮询时补上
+        print(lang.network_interruption)
+        return
+    for m, historical_funding_rate in zip(missing, res):
+        instrument = m[:m.find('-')]
+        pipeline = [{'$match': {'instrument': instrument}}]
+        # Results in DB
+        db_funding = [n for n in funding.mycol.aggregate(pipeline)]
+        for n in historical_funding_rate:
+            timestamp = funding_rate.utcfrommillisecs(n['fundingTime'])
+            realized_rate = float(n['realizedRate'])
+            for item in db_funding:
+                if item['funding'] == realized_rate:
+                    if item['timestamp'] == timestamp:
+                        break
+            else:
+                mydict = {'instrument': instrument, 'timestamp': timestamp,
+                          'funding': realized_rate}
+                funding_rate_list.append(mydict)
+    if funding_rate_list:
+        funding.mycol.insert_many(funding_rate_list)
+
+
 async def record():
     print(lang.record_ticker)
     ticker = Record('Ticker')
@@ -63,31 +108,15 @@ async def record():
     publicAPI = PublicAPI()
     ten_seconds = Looper(interval=10)
     funding_time = FundingTime()
+    fundingRate.start_stream()
+    funding_task: Optional[asyncio.Task] = None
     async for event in EventChain(ten_seconds, funding_time):
         timestamp = datetime.utcnow()
-        # 每8小时记录资金费
+        # 每8小时记录资金费，在单独的任务中等待结算查询，不中断记录Ticker
         if event == funding_time:
-            funding_rate_list = []
-            tasks = [publicAPI.get_historical_funding_rate(instId=m) for m in instrumentsID]
-            res = await asyncio.gather(*tasks)
-            for m, historical_funding_rate in zip(instrumentsID, res):
-                instrument = m[:m.find('-')]
-                pipeline = [{'$match': {'instrument': instrument}}]
-                # Results in DB
-                db_funding = [n for n in funding.mycol.aggregate(pipeline)]
-                for n in historical_funding_rate:
-                    timestamp = funding_rate.utcfrommillisecs(n['fundingTime'])
-                    realized_rate = float(n['realizedRate'])
-                    for item in db_funding:
-                        if item['funding'] == realized_rate:
-                            if item['timestamp'] == timestamp:
-                                break
-                    else:
-                        mydict = {'instrument': instrument, 'timestamp': timestamp,
-                                  'funding': realized_rate}
-                        funding_rate_list.append(mydict)
-            funding.mycol.insert_many(funding_rate_list)
-            myquery = {'timestamp': {'$lt': timestamp - timedelta(hours=48)}}
+            if not funding_task or funding_task.done():
+                funding_task = asyncio.create_task(record_funding(funding, instrumentsID, publicAPI))
+            myquery = {'timestamp': {'$lt': timestamp - timedelta(hours=ticker_hours)}}
             ticker.mycol.delete_many(myquery)
         elif event == ten_seconds:
             assert (spot_ticker := await publicAPI.get_tickers('SPOT'))
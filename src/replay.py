@@ -0,0 +1,155 @@
+import json
+from typing import Callable, Set, Tuple
+from src.capture import CaptureReader, frame_instrument
+from src.okex_api import OKExAPI
+from src.scheduler import Schedule
+from src.websocket import is_incremental, subscribe_without_login
+from src.utils import *
+
+
+class Replay:
+    """按接收时间回放CaptureWriter采集的推送，subscribe与subscribe_without_login接口相同。
+    install()后add、reduce、close的行情流和TWAP计划的时钟都来自回放，交易逻辑无需修改。
+    一个读取任务按时间顺序分发推送给全部订阅者和监听者，多个币种同时回放时共用同一时钟。
+    """
+
+    def __init__(self, path='capture', begin=0, end=0, speed=1.):
+        """
+        :param path: 采集目录
+        :param begin: 开始时间ns，0为最早
+        :param end: 结束时间ns，0为最晚
+        :param speed: 回放倍速，按原推送间隔等待；0为不等待，订阅者取走上一条推送才发送下一条，
+            因此订阅者在循环内等待成交时回放时间不前进，下单应像add一样放在单独的任务中
+        """
+        self.reader = CaptureReader(path)
+        self.begin = begin
+        self.end = end
+        self.speed = speed
+        # 回放时间ns，即最近一条推送的接收时间
+        self.clock = begin
+        # 回放时间与本机时间的对应 (回放时间ns, time.monotonic())
+        self.anchor: Tuple[int, float] = (begin, 0.)
+        self.subscribers: Dict[Tuple[str, str], List[asyncio.Queue]] = dict()
+        # 模拟交易所等按回放时间更新的监听者，listener(接收时间ns, 推送)，回放结束时推送为None
+        self.listeners: List[Callable[[int, dict], Any]] = []
+        # 已订阅的instId，其他产品的推送不解析
+        self.instruments: Set[str] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.finished = False
+        self.frames = 0
+
+    def install(self):
+        """交易循环改用回放行情流和回放时钟
+        """
+        OKExAPI.market_stream = staticmethod(self.subscribe)
+        Schedule.clock = staticmethod(self.monotonic)
+
+    @staticmethod
+    def uninstall():
+        OKExAPI.market_stream = staticmethod(subscribe_without_login)
+        Schedule.clock = staticmethod(time.monotonic)
+
+    def time(self) -> float:
+        """回放时间，秒
+        """
+        return self.clock / 10 ** 9
+
+    def monotonic(self) -> float:
+        return self.time()
+
+    def seek(self, timestamp: int):
+        """跳到指定时间继续回放，丢弃尚未处理的推送，增量深度频道等待下一个全量推送
+
+        :param timestamp: 接收时间ns
+        """
+        self.begin = self.clock = timestamp
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        # 已回放完毕时重新开始
+        self.finished = False
+        for queues in self.subscribers.values():
+            for queue in queues:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(timestamp)
+        self.start()
+
+    def start(self):
+        if not self.task and not self.finished:
+            self.anchor = (self.begin, time.monotonic())
+            self.task = asyncio.get_event_loop().create_task(self.run())
+
+    async def run(self):
+        """读取推送，按倍速等待后分发，结束时通知订阅者
+        """
+        try:
+            for ts, frame in self.reader.frames(self.begin, self.end):
+                if (instId := frame_instrument(frame)) not in self.instruments and not self.listeners:
+                    continue
+                if not self.anchor[0]:
+                    # 未指定开始时间，从第一条推送开始计时
+                    self.anchor = (ts, time.monotonic())
+                if self.speed:
+                    delay = self.anchor[1] + (ts - self.anchor[0]) / 10 ** 9 / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                self.clock = ts
+                res = json.loads(frame)
+                self.frames += 1
+                for listener in self.listeners:
+                    listener(ts, res)
+                for queue in self.subscribers.get((res['arg']['channel'], instId), []):
+                    await queue.put(res)
+                if not self.speed:
+                    # 让订阅者和在途订单处理完再继续
+                    await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            # seek
+            return
+        self.finished = True
+        for listener in self.listeners:
+            listener(self.clock, None)
+        for queues in list(self.subscribers.values()):
+            for queue in queues:
+                await queue.put(None)
+
+    async def subscribe(self, url, channels, verbose=False):
+        """与subscribe_without_login相同的接口，回放结束时停止
+
+        :param url: 不使用
+        :param channels: 频道列表
+        :param verbose: 输出推送
+        """
+        queue = asyncio.Queue(maxsize=0 if self.speed else 1)
+        keys = [(n['channel'], n['instId']) for n in channels]
+        for key in keys:
+            self.subscribers.setdefault(key, []).append(queue)
+            self.instruments.add(key[1])
+        # 增量深度频道从全量推送开始
+        snapshots = set()
+        try:
+            self.start()
+            while not self.finished or not queue.empty():
+                if (res := await queue.get()) is None:
+                    break
+                if isinstance(res, int):
+                    # seek
+                    snapshots.clear()
+                    continue
+                channel = res['arg']['channel']
+                if is_incremental(channel):
+                    key = (channel, res['arg']['instId'])
+                    if res['action'] == 'snapshot':
+                        snapshots.add(key)
+                    elif key not in snapshots:
+                        continue
+                if verbose:
+                    fprint(res)
+                yield res
+        finally:
+            for key in keys:
+                self.subscribers[key].remove(queue)
+            # 释放等待放入推送的读取任务
+            while not queue.empty():
+                queue.get_nowait()
@@ -0,0 +1,171 @@
+from typing import Tuple
+import numpy as np
+from src.backtest import load_premiums
+from src.funding_rate import FundingRate
+from src.sweep import DEFAULT_PARAMS, load_params
+from src.websocket import subscribe_without_login
+from src.utils import *
+
+
+class Scanner:
+    """后台订阅全部USDT现货和永续合约的tickers，每refresh秒按最新盘口一次更新全部币种期现差价的指数加权均值和方差，
+    结合资金费率频道计算持有holding_days天的预期收益：资金费 + 期现差价收敛 - 开平仓手续费，
+    并把前top_n个写入Scanner.table供菜单直接读取
+    """
+    # 最近一次刷新的排名
+    table: List[dict] = []
+    # 最近一次刷新的时间
+    updated = 0.
+    task: Optional[asyncio.Task] = None
+    # 刷新间隔秒数
+    refresh = 0.5
+    # 期现差价统计的半衰期小时数
+    half_life = 2.
+    # 至少收到几次盘口才参与排名
+    min_samples = 10
+    # 统计至少覆盖几小时才参与排名，之前标准差偏小，阈值区间过窄。启动时先用Ticker记录补上
+    warmup = 2.
+    holding_days = 7.
+    # 开仓或平仓一次期现两腿的吃单手续费率
+    fee = 0.0015
+    top_n = 20
+
+    def __init__(self, account=3):
+        """
+        :param account: 账号id，决定公共频道地址
+        """
+        self.fundingRate = FundingRate(account)
+        self.swaps: List[str] = []
+        self.coins: List[str] = []
+        # instId -> (币种序号, 0现货 1合约)
+        self.index: Dict[str, Tuple[int, int]] = dict()
+        self.last = 0.
+        # 开仓、平仓阈值的标准差倍数
+        self.sigma = np.array([[DEFAULT_PARAMS['sigma']], [-DEFAULT_PARAMS['sigma']]])
+
+    def setup(self, swaps: List[str]):
+        """按合约列表分配数组
+
+        :param swaps: USDT永续合约instId
+        """
+        self.swaps = swaps
+        self.coins = [m[:m.find('-')] for m in swaps]
+        self.index = dict()
+        for i, m in enumerate(swaps):
+            self.index[m] = (i, 1)
+            self.index[m[:m.find('-SWAP')]] = (i, 0)
+        # [现货/合约, 币种] 最新盘口
+        self.bid = np.full((2, len(swaps)), np.nan)
+        self.ask = np.full((2, len(swaps)), np.nan)
+        # [开仓/平仓期现差价, 币种] 指数加权均值、方差和样本数
+        self.mean = np.full((2, len(swaps)), np.nan)
+        self.var = np.zeros((2, len(swaps)))
+        self.samples = np.zeros(len(swaps), dtype=np.int64)
+        # 统计开始的时间戳秒
+        self.since = np.full(len(swaps), np.nan)
+        self.last = 0.
+
+    def seed(self, premiums: Dict[str, dict], now=0.):
+        """用Ticker记录的期现差价按同样的半衰期加权初始化统计
+
+        :param premiums: load_premiums的返回值
+        :param now: 时间戳秒，0为当前时间
+        """
+        position = {coin: i for i, coin in enumerate(self.coins)}
+        for coin, series in premiums.items():
+            if (i := position.get(coin)) is None:
+                continue
+            weights = 0.5 ** ((series['timestamp'][-1] - series['timestamp']) / (self.half_life * 3600))
+            weights /= weights.sum()
+            for row, name in enumerate(('open_pd', 'close_pd')):
+                self.mean[row, i] = weights @ series[name]
+                self.var[row, i] = weights @ (series[name] - self.mean[row, i]) ** 2
+            self.samples[i] = len(weights)
+            self.since[i] = series['timestamp'][0]
+            self.last = now or time.time()
+
+    def start(self):
+        if not Scanner.task or Scanner.task.done():
+            Scanner.task = asyncio.get_event_loop().create_task(self.run())
+
+    @staticmethod
+    def stop():
+        if Scanner.task:
+            Scanner.task.cancel()
+            Scanner.task = None
+
+    async def run(self):
+        """订阅tickers，定时刷新排名
+        """
+        swaps = await self.fundingRate.get_instruments_ID()
+        self.setup(swaps)
+        self.seed(load_premiums(self.coins, self.warmup / 24))
+        self.sigma = np.array([[load_params('open')['sigma']], [-load_params('close')['sigma']]])
+        self.fundingRate.start_stream()
+        channels = [dict(channel='tickers', instId=m) for m in self.index]
+        receiver = asyncio.create_task(self.receive(channels))
+        try:
+            while True:
+                await asyncio.sleep(self.refresh)
+                if receiver.done():
+                    # 网络中断
+                    receiver.result()
+                self.update()
+        finally:
+            receiver.cancel()
+
+    async def receive(self, channels):
+        async for res in subscribe_without_login(self.fundingRate.public_url, channels):
+            self.on_ticker(res)
+
+    def on_ticker(self, res: dict):
+        """只记录最新盘口，统计在update中一次计算
+        """
+        for data in res.get('data', []):
+            if key := self.index.get(data['instId']):
+                self.bid[key[1], key[0]] = float(m) if (m := data['bidPx']) else np.nan
+                self.ask[key[1], key[0]] = float(m) if (m := data['askPx']) else np.nan
+
+    def update(self, now=0.):
+        """按最新盘口更新全部币种的期现差价统计，重新排名
+
+        :param now: 时间戳秒，0为当前时间
+        """
+        now = now or time.time()
+        # [开仓, 平仓]期现差价，与record相同
+        premium = np.array([(self.bid[1] - self.ask[0]) / self.ask[0], (self.ask[1] - self.bid[0]) / self.bid[0]])
+        valid = ~np.isnan(premium).any(axis=0)
+        alpha = 1 - 0.5 ** ((now - self.last) / (self.half_life * 3600)) if self.last else 1.
+        self.last = now
+        first = valid & (self.samples == 0)
+        diff = np.where(valid, premium - self.mean, 0.)
+        self.mean = np.where(first, premium, np.where(valid, self.mean + alpha * diff, self.mean))
+        self.var = np.where(first, 0., np.where(valid, (1 - alpha) * (self.var + alpha * diff * diff), self.var))
+        self.samples += valid
+        self.since[first] = now
+
+        funding = np.array([[m['current'], m['next']] if (m := FundingRate.rates.get(n)) else [np.nan, np.nan]
+                            for n in self.swaps]).reshape(-1, 2).T
+        # 开仓阈值和平仓阈值，与add、reduce相同
+        entry, exit_ = self.mean + self.sigma * np.sqrt(self.var)
+        # 当期和预测资金费的均值，没有预测时用当期
+        carry = np.where(np.isnan(funding[1]), funding[0], funding.mean(axis=0)) * 3 * self.holding_days
+        capture = entry - exit_
+        score = carry + capture - 2 * self.fee
+        warming = ~(now - self.since >= self.warmup * 3600)
+        score[(self.samples < self.min_samples) | warming | np.isnan(score)] = -np.inf
+        top = np.argsort(-score, kind='stable')[:self.top_n]
+        Scanner.table = [dict(coin=self.coins[i], current=funding[0, i], next=funding[1, i], open_pd=premium[0, i],
+                              entry=entry[i], exit=exit_[i], carry=carry[i], capture=capture[i], score=score[i])
+                         for i in top if score[i] > -np.inf]
+        Scanner.updated = now
+
+    @staticmethod
+    def show():
+        """输出最近一次刷新的排名
+        """
+        fprint(lang.scanner_updated.format(len(Scanner.table), time.time() - Scanner.updated))
+        fprint(lang.scanner_header)
+        for n in Scanner.table:
+            fprint(f"{n['coin']:8s}{n['current']:9.3%}{n['next']:9.3%}{n['open_pd']:9.3%}{n['entry']:9.3%}"
+                   f"{n['exit']:9.3%}{n['carry']:9.3%}{n['capture']:9.3%}{n['score']:9.3%}")
@@ -0,0 +1,101 @@
+import math
+import time
+from typing import List
+
+
+class Schedule:
+    """TWAP执行计划：把目标数量均分到horizon内的各时间片，每片到期后才放出下一片。
+    按可见深度的一定比例下单（冰山），落后于计划时提高参与率并把期现差价向近期均值放宽。
+    """
+    # 未落后时每次最多吃掉满足差价深度的比例
+    participation = 0.25
+    # 落后几个时间片时参与率和差价放宽到最大
+    max_lag = 2.
+    # 近期期现差价统计的小时数
+    window = 2
+    # 每个时间片的秒数
+    slice_seconds = 300
+    # 计时函数，回放时由Replay.install()替换为回放时钟
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, target: float, horizon: float):
+        """
+        :param target: 目标数量
+        :param horizon: 执行小时数
+        """
+        self.target = target
+        self.horizon = horizon * 3600
+        self.slices = max(math.ceil(self.horizon / self.slice_seconds), 1)
+        self.slice_size = target / self.slices
+        self.begin = self.clock()
+        self.current = -1
+        # 各时间片开始时的 (计划 - 已成交) / 目标数量
+        self.errors: List[float] = []
+
+    def elapsed_slices(self) -> int:
+        """已结束的时间片数，超过horizon后继续增加
+        """
+        return int((self.clock() - self.begin) / self.slice_seconds)
+
+    def planned(self, slices: int) -> float:
+        """前slices个时间片的计划累计数量
+        """
+        return min(self.slice_size * slices, self.target)
+
+    def due(self) -> float:
+        """当前时间片结束时应成交的累计数量
+        """
+        return self.planned(self.elapsed_slices() + 1)
+
+    def next_slice(self, filled: float) -> bool:
+        """进入新的时间片时返回True并记录跟踪误差
+
+        :param filled: 已成交数量
+        """
+        if (current := self.elapsed_slices()) == self.current:
+            return False
+        self.current = current
+        self.track(filled)
+        return True
+
+    def track(self, filled: float):
+        """记录已结束时间片的计划数量与已成交数量之差
+
+        :param filled: 已成交数量
+        """
+        self.errors.append((self.planned(self.elapsed_slices()) - filled) / self.target)
+
+    def lag(self, filled: float) -> float:
+        """落后计划的程度，0为未落后，1为落后max_lag个时间片以上
+
+        :param filled: 已成交数量
+        """
+        behind = self.planned(self.elapsed_slices()) - filled
+        return min(max(behind / self.slice_size / self.max_lag, 0.), 1.)
+
+    def size(self, filled: float, pending: float, depth: float) -> float:
+        """本次可下单数量
+
+        :param filled: 已成交数量
+        :param pending: 在途数量
+        :param depth: 满足期现差价的深度
+        """
+        remaining = self.due() - filled - pending
+        if remaining <= 0:
+            return 0.
+        participation = self.participation + (1 - self.participation) * self.lag(filled)
+        return min(remaining, depth * participation)
+
+    def premium(self, filled: float, price_diff: float, loose: float) -> float:
+        """按落后程度把期现差价从price_diff向loose放宽
+
+        :param filled: 已成交数量
+        :param price_diff: 计划内的期现差价
+        :param loose: 最宽的期现差价
+        """
+        return price_diff + (loose - price_diff) * self.lag(filled)
+
+    def tracking_error(self) -> float:
+        """各时间片跟踪误差的均方根，以目标数量的比例计
+        """
+        return math.sqrt(sum(n * n for n in self.errors) / len(self.errors)) if self.errors else 0.
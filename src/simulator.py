@@ -0,0 +1,333 @@
+import heapq
+import itertools
+from typing import Callable
+from src.codedict import codes
+from src.okex_api import OKExAPI
+from src.websocket import is_incremental
+from src.utils import *
+
+
+class OrderBook:
+    """由频道推送重建的盘口 {价格: 数量}
+    """
+    __slots__ = ('bids', 'asks', 'incremental')
+
+    def __init__(self):
+        self.bids: Dict[float, float] = dict()
+        self.asks: Dict[float, float] = dict()
+        # 收到过增量深度频道后忽略books5、bbo-tbt和tickers
+        self.incremental = False
+
+    def apply(self, channel: str, data: dict, action=''):
+        """合并一条推送
+
+        :param channel: 频道
+        :param data: 推送的data[0]
+        :param action: 增量深度频道的snapshot或update
+        """
+        if is_incremental(channel):
+            self.incremental = True
+            if action == 'snapshot':
+                self.bids.clear()
+                self.asks.clear()
+            for side, levels in ((self.bids, data['bids']), (self.asks, data['asks'])):
+                for level in levels:
+                    if (size := float(level[1])) > 0:
+                        side[float(level[0])] = size
+                    else:
+                        side.pop(float(level[0]), None)
+        elif self.incremental:
+            return
+        elif channel == 'tickers':
+            self.bids = {float(data['bidPx']): float(data['bidSz'])} if data['bidPx'] else dict()
+            self.asks = {float(data['askPx']): float(data['askSz'])} if data['askPx'] else dict()
+        else:
+            self.bids = {float(n[0]): float(n[1]) for n in data['bids']}
+            self.asks = {float(n[0]): float(n[1]) for n in data['asks']}
+
+    def levels(self, side: str, limit: float = None) -> List[list]:
+        """对手盘价格不差于limit的档位，最优价在前
+
+        :param side: 己方方向buy或sell
+        :param limit: 限价，None为不限
+        :return: [[价格, 数量], ...]
+        """
+        if side == 'buy':
+            levels = [[p, s] for p, s in self.asks.items() if limit is None or p <= limit]
+            levels.sort()
+        else:
+            levels = [[p, s] for p, s in self.bids.items() if limit is None or p >= limit]
+            levels.sort(reverse=True)
+        return levels
+
+
+class SimulatedExchange:
+    """撮合模拟：下单、查询、撤单、改单接口与TradeAPI相同，按回放推送重建的盘口成交。
+    订单经过latency秒（回放时间）到达后处理，FOK、IOC、市价单和限价单的可成交部分立即按对手盘逐档成交。
+    限价单剩余部分挂在盘口，排在该价位已有数量之后：价位数量减少时先消耗排在前面的数量，超出部分成交；
+    对手盘出现不差于挂单价的新数量时也成交。成交不改变回放的盘口。
+    订单状态和手续费与OKX相同：live、partially_filled、filled、canceled，现货买入扣币，其他扣USDT。
+    """
+    # 下单、撤单、改单到达交易所的秒数
+    latency = 0.02
+    spot_taker_fee = 0.001
+    spot_maker_fee = 0.0008
+    swap_taker_fee = 0.0005
+    swap_maker_fee = 0.0002
+
+    def __init__(self, contract_val: Dict[str, float] = None):
+        """
+        :param contract_val: {合约instId: 合约面值}，未列出的为1
+        """
+        self.contract_val = contract_val or dict()
+        self.books: Dict[str, OrderBook] = collections.defaultdict(OrderBook)
+        self.orders: Dict[str, dict] = dict()
+        # 挂单 {instId: [订单]}
+        self.resting: Dict[str, List[dict]] = collections.defaultdict(list)
+        # 尚未到达的操作 [(到达时间ns, 序号, 操作, Future)]
+        self.pending: List[tuple] = []
+        self.sequence = itertools.count()
+        self.ids = itertools.count(1)
+        # 回放时间ns
+        self.clock = 0
+        self.updates = 0
+
+    def install(self, replay=None):
+        """交易循环改用模拟撮合
+
+        :param replay: Replay，推送同时更新模拟盘口
+        """
+        OKExAPI.tradeAPI = self
+        if replay:
+            replay.listeners.append(self.on_frame)
+
+    def on_frame(self, ts: int, res: Optional[dict]):
+        """回放推送：先处理已到达的操作，再更新盘口并检查挂单成交
+
+        :param ts: 接收时间ns
+        :param res: 推送，None为回放结束
+        """
+        self.clock = ts
+        while self.pending and (res is None or self.pending[0][0] <= ts):
+            self.process(heapq.heappop(self.pending))
+        if res is None or 'data' not in res:
+            return
+        channel = res['arg']['channel']
+        if channel == 'tickers':
+            instId = res['data'][0]['instId']
+        elif channel.startswith('books') or channel == 'bbo-tbt':
+            instId = res['arg']['instId']
+        else:
+            return
+        self.updates += 1
+        book = self.books[instId]
+        book.apply(channel, res['data'][0], res.get('action', ''))
+        if resting := self.resting.get(instId):
+            for order in resting[:]:
+                self.rest(order, book)
+
+    async def submit(self, action: Callable, *args):
+        """操作经过latency到达后执行，返回执行结果
+        """
+        if not self.latency:
+            return action(*args)
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.pending, (self.clock + int(self.latency * 10 ** 9), next(self.sequence),
+                                      functools.partial(action, *args), future))
+        return await future
+
+    @staticmethod
+    def process(item: tuple):
+        arrival, _, action, future = item
+        if not future.done():
+            future.set_result(action())
+
+    @staticmethod
+    def response(order: dict, code='0') -> dict:
+        """与OKX相同，每个订单结果都有code、msg、sCode、sMsg
+        """
+        if code != '0':
+            return dict(ordId='-1', clOrdId=order.get('clOrdId', ''), code=code, msg=codes[code], sCode=code,
+                        sMsg=codes[code])
+        return dict(ordId=order['ordId'], clOrdId=order['clOrdId'], code='0', msg='', sCode='0', sMsg='')
+
+    def place(self, order: dict) -> dict:
+        """订单到达，对手盘可成交部分立即成交，限价单剩余部分挂单
+        """
+        book = self.books[order['instId']]
+        order['cTime'] = order['uTime'] = str(self.clock // 10 ** 6)
+        limit = None if order['ordType'] == 'market' else float(order['px'])
+        size = float(order['sz'])
+        levels = book.levels(order['side'], limit)
+        if order['ordType'] == 'fok' and sum(n[1] for n in levels) < size:
+            levels = []
+        for price, amount in levels:
+            if (remaining := size - order['filled']) <= 0:
+                break
+            self.fill(order, min(amount, remaining), price, taker=True)
+        if size - order['filled'] <= 0:
+            order['state'] = 'filled'
+        elif order['ordType'] == 'limit':
+            self.queue(order, book)
+            self.resting[order['instId']].append(order)
+        else:
+            order['state'] = 'canceled'
+        return order
+
+    @staticmethod
+    def queue(order: dict, book: OrderBook):
+        """挂单排在该价位已有数量之后
+        """
+        side = book.bids if order['side'] == 'buy' else book.asks
+        order['level'] = order['ahead'] = side.get(float(order['px']), 0.)
+        # 已计入成交的对手盘 {价格: 数量}，包括下单时已吃掉的
+        order['crossed'] = {px: amount for px, amount in book.levels(order['side'], float(order['px']))}
+
+    def rest(self, order: dict, book: OrderBook):
+        """盘口变化后的挂单成交
+        """
+        price = float(order['px'])
+        buy = order['side'] == 'buy'
+        side = book.bids if buy else book.asks
+        level = side.get(price, 0.)
+        # books5等只推送前几档，挂单价位移出可见范围时不能判断数量变化
+        if not level and not any(p < price if buy else p > price for p in side):
+            level = order['level']
+        # 价位数量减少，先消耗排在前面的数量
+        if level < order['level']:
+            decrease = order['level'] - level
+            consumed = min(decrease, order['ahead'])
+            order['ahead'] -= consumed
+            if decrease > consumed:
+                self.fill(order, min(decrease - consumed, float(order['sz']) - order['filled']), price, taker=False)
+        order['level'] = level
+        # 对手盘出现不差于挂单价的新数量，挂单作为maker按挂单价成交
+        crossed = dict()
+        for px, amount in book.levels(order['side'], price):
+            crossed[px] = amount
+            if (new := amount - order['crossed'].get(px, 0.)) > 0 and float(order['sz']) > order['filled']:
+                self.fill(order, min(new, float(order['sz']) - order['filled']), price, taker=False)
+        order['crossed'] = crossed
+        if float(order['sz']) - order['filled'] <= 0:
+            order['state'] = 'filled'
+            self.resting[order['instId']].remove(order)
+
+    def fill(self, order: dict, size: float, price: float, taker: bool):
+        """记录成交及手续费，现货买入扣币，现货卖出和合约扣USDT
+        """
+        if size <= 0:
+            return
+        spot = not order['instId'].endswith('-SWAP')
+        if spot:
+            rate = self.spot_taker_fee if taker else self.spot_maker_fee
+            fee = size * rate if order['side'] == 'buy' else size * price * rate
+        else:
+            rate = self.swap_taker_fee if taker else self.swap_maker_fee
+            fee = size * self.contract_val.get(order['instId'], 1.) * price * rate
+        order['notional'] += size * price
+        order['filled'] += size
+        order['paid'] += fee
+        order['state'] = 'partially_filled'
+        order['uTime'] = str(self.clock // 10 ** 6)
+
+    def cancel(self, order: dict) -> dict:
+        if order['state'] in ('filled', 'canceled'):
+            return self.response(order, '51402' if order['state'] == 'filled' else '51401')
+        order['state'] = 'canceled'
+        order['uTime'] = str(self.clock // 10 ** 6)
+        if order in self.resting[order['instId']]:
+            self.resting[order['instId']].remove(order)
+        return self.response(order)
+
+    def amend(self, order: dict, new_size: str, new_price: str) -> dict:
+        """改价后重新排队，剩余部分按新价格重新撮合
+        """
+        if order['state'] in ('filled', 'canceled'):
+            return self.response(order, '51510' if order['state'] == 'filled' else '51509')
+        if order['ordType'] != 'limit':
+            return self.response(order, '51506')
+        self.resting[order['instId']].remove(order)
+        if new_size:
+            order['sz'] = new_size
+        if new_price:
+            order['px'] = new_price
+        book = self.books[order['instId']]
+        for price, amount in book.levels(order['side'], float(order['px'])):
+            if (remaining := float(order['sz']) - order['filled']) <= 0:
+                break
+            self.fill(order, min(amount, remaining), price, taker=True)
+        if float(order['sz']) - order['filled'] <= 0:
+            order['state'] = 'filled'
+        else:
+            self.queue(order, book)
+            self.resting[order['instId']].append(order)
+        return self.response(order)
+
+    def info(self, order: dict) -> dict:
+        """OKX格式的订单信息
+        """
+        spot = not order['instId'].endswith('-SWAP')
+        fee_ccy = order['instId'][:order['instId'].find('-')] if spot and order['side'] == 'buy' else 'USDT'
+        avg = order['notional'] / order['filled'] if order['filled'] else 0.
+        return dict(instId=order['instId'], ordId=order['ordId'], clOrdId=order['clOrdId'], side=order['side'],
+                    ordType=order['ordType'], px=order['px'], sz=order['sz'], state=order['state'],
+                    accFillSz=f"{order['filled']:.10g}", avgPx=f'{avg:.10g}', fee=f"{-order['paid']:.10g}",
+                    feeCcy=fee_ccy, reduceOnly=str(order['reduceOnly']).lower(), cTime=order['cTime'],
+                    uTime=order['uTime'])
+
+    async def _place_order(self, params: dict) -> dict:
+        order = dict(params, ordId=str(next(self.ids)), state='live', filled=0., notional=0., paid=0., cTime='',
+                     uTime='')
+        order.setdefault('reduceOnly', False)
+        # 批量下单的市价单没有px
+        order.setdefault('px', '')
+        order['clOrdId'] = order.get('clOrdId') or order['ordId']
+        self.orders[order['ordId']] = order
+        await self.submit(self.place, order)
+        return self.response(order)
+
+    async def take_spot_order(self, instId, side, order_type, size, price='', tgtCcy='', client_oid='') -> dict:
+        params = dict(instId=instId, tdMode='cash', side=side, ordType=order_type, sz=size, px=price,
+                      clOrdId=client_oid)
+        return await self._place_order(params)
+
+    async def take_swap_order(self, instId, side, order_type, size, price='', client_oid='', reduceOnly=False) -> dict:
+        params = dict(instId=instId, tdMode='isolated', side=side, ordType=order_type, sz=size, px=price,
+                      clOrdId=client_oid, reduceOnly=reduceOnly)
+        return await self._place_order(params)
+
+    async def batch_order(self, orders: List[dict]) -> List[dict]:
+        return list(await asyncio.gather(*[self._place_order(dict(n)) for n in orders]))
+
+    def find(self, order_id='', client_oid='') -> Optional[dict]:
+        if order_id:
+            return self.orders.get(order_id)
+        for order in self.orders.values():
+            if order['clOrdId'] == client_oid:
+                return order
+
+    async def get_order_info(self, instId, order_id='', client_oid='', deadline=None) -> dict:
+        await asyncio.sleep(0)
+        order = self.find(order_id, client_oid)
+        assert order and order['instId'] == instId, codes['51603']
+        return self.info(order)
+
+    async def cancel_order(self, instId, order_id='', client_oid='') -> dict:
+        if not (order := self.find(order_id, client_oid)):
+            return self.response(dict(clOrdId=client_oid), '51400')
+        return await self.submit(self.cancel, order)
+
+    async def amend_order(self, instId, order_id='', client_oid='', new_size='', new_price='',
+                          cxlOnFail=False) -> dict:
+        if not (order := self.find(order_id, client_oid)):
+            return self.response(dict(clOrdId=client_oid), '51503')
+        return await self.submit(self.amend, order, new_size, new_price)
+
+    async def warm_up(self, connections=0):
+        pass
+
+    async def keep_warm(self, owner: asyncio.Task, connections=0):
+        pass
+
+    async def aclose(self):
+        pass
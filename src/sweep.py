@@ -0,0 +1,193 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import src.record as record
+from src.backtest import backtest, load_premiums
+from src.utils import *
+
+# 默认网格：标准差倍数、开始时统计的小时数、重设阈值的间隔小时数、每次成交比例
+SIGMAS = (1., 1.5, 2., 2.5, 3.)
+LOOKBACKS = (1., 2., 4., 8.)
+ACCELERATE_AFTER = (1., 2., 4.)
+CHUNKS = (0.05, 0.1, 0.2)
+# 未回测时add、reduce、close使用的参数
+DEFAULT_PARAMS = dict(sigma=2., lookback=2., accelerate_after=2.)
+ROWS = ('timestamp', 'open_pd', 'close_pd')
+
+# 子进程中的共享内存及各币种数组视图
+_shared: Optional[shared_memory.SharedMemory] = None
+_series: Dict[str, np.ndarray] = dict()
+
+
+def grid(sigmas=SIGMAS, lookbacks=LOOKBACKS, accelerate_after=ACCELERATE_AFTER, chunks=CHUNKS) -> List[tuple]:
+    """全部参数组合 (sigma, lookback, accelerate_after, chunk)
+    """
+    return list(itertools.product(sigmas, lookbacks, accelerate_after, chunks))
+
+
+def share(premiums: Dict[str, dict]):
+    """把各币种的timestamp、open_pd、close_pd放入同一块共享内存，子进程只按名称和偏移取视图，任务不传数组
+
+    :param premiums: load_premiums的返回值
+    :return: 共享内存, {币种: (开始, 结束)}, 总长度
+    """
+    layout, total = dict(), 0
+    for coin, series in premiums.items():
+        layout[coin] = (total, total + len(series['timestamp']))
+        total += len(series['timestamp'])
+    shm = shared_memory.SharedMemory(create=True, size=max(len(ROWS) * total * 8, 1))
+    array = np.ndarray((len(ROWS), total), dtype=np.float64, buffer=shm.buf)
+    for coin, (begin, end) in layout.items():
+        for row, name in enumerate(ROWS):
+            array[row, begin:end] = premiums[coin][name]
+    return shm, layout, total
+
+
+def attach(name: str, layout: Dict[str, tuple], total: int):
+    """子进程初始化：连接共享内存
+    """
+    global _shared
+    # 子进程与主进程共用resource_tracker，由主进程unlink
+    _shared = shared_memory.SharedMemory(name=name)
+    array = np.ndarray((len(ROWS), total), dtype=np.float64, buffer=_shared.buf)
+    for coin, (begin, end) in layout.items():
+        _series[coin] = array[:, begin:end]
+
+
+def evaluate(coin: str, close: bool, configs: List[tuple], kwargs: dict) -> List[dict]:
+    """在子进程中回测一个币种的一批参数
+
+    :param coin: 币种
+    :param close: 减仓
+    :param configs: [(sigma, lookback, accelerate_after, chunk)]
+    :param kwargs: backtest的其他参数
+    """
+    timestamp, values = _series[coin][0], _series[coin][2 if close else 1]
+    res = []
+    for sigma, lookback, accelerate_after, chunk in configs:
+        result = backtest(timestamp, values, close, sigma=sigma, lookback=lookback, accelerate_after=accelerate_after,
+                          chunk=chunk, **kwargs)
+        res.append(dict(sigma=sigma, lookback=lookback, accelerate_after=accelerate_after, chunk=chunk, **result))
+    return res
+
+
+def rank(results: List[dict], min_completed=0.9) -> List[dict]:
+    """完成比例不低于min_completed的排在前面，其中扣除手续费后的收益率高的在前
+
+    :param results: evaluate的返回值
+    :param min_completed: 最低完成比例
+    """
+    return sorted(results, key=lambda n: (n['completed'] >= min_completed, n['net'], n['completed']), reverse=True)
+
+
+def recommend(table: Dict[str, List[dict]], min_completed=0.9) -> Optional[dict]:
+    """各币种共用的参数：达到完成比例的币种数最多，其次各币种平均收益率最高
+
+    :param table: {币种: evaluate的返回值}
+    :param min_completed: 最低完成比例
+    """
+    configs = dict()
+    for results in table.values():
+        for n in results:
+            key = (n['sigma'], n['lookback'], n['accelerate_after'], n['chunk'])
+            configs.setdefault(key, []).append(n)
+    if not configs:
+        return None
+    key, results = max(configs.items(), key=lambda item: (sum(n['completed'] >= min_completed for n in item[1]),
+                                                           np.mean([n['net'] for n in item[1]])))
+    return dict(sigma=key[0], lookback=key[1], accelerate_after=key[2], chunk=key[3],
+                completed=float(np.mean([n['completed'] for n in results])),
+                net=float(np.mean([n['net'] for n in results])))
+
+
+def sweep(premiums: Dict[str, dict], configs: List[tuple] = None, close=False, workers=0, batch=8,
+          min_completed=0.9, **kwargs):
+    """多进程回测参数网格，输入数组放在共享内存中
+
+    :param premiums: load_premiums的返回值
+    :param configs: grid的返回值
+    :param close: 减仓
+    :param workers: 进程数，0为CPU核数
+    :param batch: 每个任务的参数组合数
+    :param min_completed: 最低完成比例
+    :param kwargs: backtest的其他参数
+    :return: {币种: 排序后的结果}, 每秒回测的参数组合数
+    """
+    configs = configs or grid()
+    shm, layout, total = share(premiums)
+    table = {coin: [] for coin in premiums}
+    try:
+        begin = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=attach,
+                                 initargs=(shm.name, layout, total)) as executor:
+            futures = {executor.submit(evaluate, coin, close, configs[i:i + batch], kwargs): coin
+                       for coin in premiums for i in range(0, len(configs), batch)}
+            for future, coin in futures.items():
+                table[coin] += future.result()
+        rate = len(premiums) * len(configs) / (time.perf_counter() - begin)
+    finally:
+        shm.close()
+        shm.unlink()
+    return {coin: rank(results, min_completed) for coin, results in table.items()}, rate
+
+
+def save_params(side: str, params: dict, coin=''):
+    """保存回测得出的参数
+
+    :param side: 'open'或'close'
+    :param params: recommend的返回值或rank后的第一行
+    :param coin: 币种，空为各币种共用
+    """
+    Params = record.Record('Params')
+    mydict = dict(side=side, coin=coin, timestamp=datetime.utcnow(),
+                  **{k: params[k] for k in ('sigma', 'lookback', 'accelerate_after', 'chunk', 'completed', 'net')})
+    Params.mycol.replace_one({'side': side, 'coin': coin}, mydict, upsert=True)
+
+
+def load_params(side: str, coin='') -> dict:
+    """add、reduce、close使用的期现差价阈值参数，依次取该币种的、共用的、默认的
+
+    :param side: 'open'或'close'
+    :param coin: 币种
+    :return: dict(sigma=标准差倍数, lookback=统计小时数, accelerate_after=重设阈值的间隔小时数)
+    """
+    Params = record.Record('Params')
+    for match in ([{'side': side, 'coin': coin}] if coin else []) + [{'side': side, 'coin': ''}]:
+        if params := Params.mycol.find_one(match):
+            return {k: params[k] for k in DEFAULT_PARAMS}
+    return DEFAULT_PARAMS.copy()
+
+
+def print_table(coin: str, results: List[dict], top=5):
+    fprint(lang.sweep_coin.format(coin))
+    print(lang.sweep_header)
+    for n in results[:top]:
+        print(f"{n['sigma']:5.1f} {n['lookback']:8.0f} {n['accelerate_after']:10.0f} {n['chunk']:6.2f} "
+              f"{n['completed']:9.0%} {n['fills']:6.1f} {n['net']:9.4%} {n['median_hours']:6.1f}")
+
+
+def sweep_recorded(days=0, top=5, workers=0):
+    """回测Ticker中全部币种的参数网格，输出各币种排名并保存推荐参数
+
+    :param days: 最近几天，0为Ticker保留的全部记录
+    :param top: 每个币种输出的行数
+    :param workers: 进程数，0为CPU核数
+    """
+    coins = record.Record('Ticker').mycol.distinct('instrument')
+    premiums = load_premiums(coins, days or record.ticker_hours / 24)
+    if not premiums:
+        fprint(lang.fetch_ticker_first)
+        return
+    for side in ('open', 'close'):
+        table, rate = sweep(premiums, close=side == 'close', workers=workers)
+        fprint(lang.sweep_rate.format(side, len(table) * len(grid()), rate))
+        for coin, results in table.items():
+            print_table(coin, results, top)
+            if results:
+                save_params(side, results[0], coin)
+        if params := recommend(table):
+            save_params(side, params)
+            fprint(lang.sweep_recommended.format(side, params['sigma'], params['lookback'],
+                                                 params['accelerate_after'], params['chunk'], params['net']))
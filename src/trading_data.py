@@ -46,6 +46,76 @@ def average_true_range(candles: List[List], days, bar='4H'):
     return np.mean(tr)
 
 
+def bar_minutes(bar: str) -> int:
+    """K线粒度的分钟数
+
+    :param bar: 如 [1m/3m/5m/15m/30m/1H/2H/4H/6H/12H/1D/1W/1M/3M/6M/1Y]
+    """
+    return int(rtruncate(bar, 1)) * dict(m=1, H=60, D=1440, W=10080, M=43200, Y=525600)[bar[-1]]
+
+
+def candle_matrix(candles: List[List[list]]):
+    """把各产品K线按开始时间对齐，从旧到新
+
+    :param candles: 各产品get_kline的结果
+    :return: K线开始时间ms, 产品 x K线 x (开, 高, 低, 收)（缺失为NaN）
+    """
+    bars = np.unique(np.concatenate([np.array([int(m[0]) for m in n], dtype=np.int64) for n in candles if n]
+                                    or [np.zeros(0, dtype=np.int64)]))
+    matrix = np.full((len(candles), len(bars), 4), np.nan)
+    for i, n in enumerate(candles):
+        if n:
+            array = np.asarray([m[:5] for m in n], dtype=np.float64)
+            matrix[i, np.searchsorted(bars, array[:, 0].astype(np.int64))] = array[:, 1:5]
+    return bars, matrix
+
+
+def true_range_matrix(candles: np.ndarray) -> np.ndarray:
+    """各K线相对振幅，与true_range相同，第一根K线为NaN
+
+    :param candles: candle_matrix的K线矩阵
+    """
+    high, low, close = candles[:, 1:, 1], candles[:, 1:, 2], candles[:, :-1, 3]
+    tr = np.maximum(high - low, np.maximum(np.abs(high - close), np.abs(low - close))) / close
+    return np.concatenate((np.full((len(candles), 1), np.nan), tr), axis=1)
+
+
+def volatility(candles: np.ndarray, window: int, bars_per_year=0.) -> dict:
+    """一次计算全部产品最近window根K线的波动率，缺失的K线不计
+
+    :param candles: candle_matrix的K线矩阵
+    :param window: K线根数
+    :param bars_per_year: 非0时把parkinson、garman_klass、close_to_close年化
+    :return: dict(natr=平均相对振幅，即average_true_range, parkinson=高低价波动率, garman_klass=开高低收波动率,
+        close_to_close=收盘价对数收益率标准差, count=K线根数)，每个产品一个值，没有K线的为NaN
+    """
+    # 多取一根K线作为第一根的上一收盘价
+    candles = candles[:, -window - 1:]
+    previous, candles = candles[:, :-1, 3], candles[:, 1:]
+    open_, high, low, close = candles[:, :, 0], candles[:, :, 1], candles[:, :, 2], candles[:, :, 3]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tr = np.maximum(high - low, np.maximum(np.abs(high - previous), np.abs(low - previous))) / previous
+        hl = np.log(high / low) ** 2
+        co = np.log(close / open_) ** 2
+        returns = np.log(close / previous)
+        valid = ~np.isnan(tr)
+        count = valid.sum(axis=1)
+
+        def mean(x):
+            return np.where(valid, x, 0.).sum(axis=1) / count
+
+        r = returns - mean(returns)[:, None]
+        res = dict(natr=mean(tr), parkinson=np.sqrt(mean(hl) / (4 * np.log(2))),
+                   garman_klass=np.sqrt(mean(0.5 * hl - (2 * np.log(2) - 1) * co)),
+                   close_to_close=np.sqrt(np.where(valid, r * r, 0.).sum(axis=1) / (count - 1)))
+    res['close_to_close'][count < 2] = np.nan
+    if bars_per_year:
+        for key in ('parkinson', 'garman_klass', 'close_to_close'):
+            res[key] *= np.sqrt(bars_per_year)
+    res['count'] = count
+    return res
+
+
 class Stat:
     """交易数据统计功能类
     """
@@ -106,31 +176,30 @@ class Stat:
         return await query_with_pagination(self.publicAPI.history_kline, tag=0, page_size=100, limit=limit,
                                            instId=instId, bar=bar)
 
+    async def volatilities(self, instIds: List[str], days=7, bar='4H', annualize=False) -> dict:
+        """下载各产品K线，一次计算全部产品最近days天的波动率
+
+        :param instIds: 产品ID列表
+        :param days: 最近几天
+        :param bar: 时间粒度
+        :param annualize: parkinson、garman_klass、close_to_close年化
+        :return: volatility的返回值，顺序与instIds相同
+        """
+        window = days * 1440 // bar_minutes(bar)
+        if window <= 1440:
+            task_list = [self.get_candles(m, days, bar) for m in instIds]
+        else:
+            task_list = [self.history_candles(m, days, bar) for m in instIds]
+        _, candles = candle_matrix(await asyncio.gather(*task_list))
+        return volatility(candles, window, 525600 / bar_minutes(bar) if annualize else 0.)
+
     # @debug_timer
     async def profitability(self, funding_rate_list, days=7) -> List[dict]:
         """显示各币种资金费率除以波动率
         """
-        bar = '4H'
-        if bar.endswith('m'):
-            limit = days * 1440 // int(rtruncate(bar, 1)) + 1
-        elif bar.endswith('H'):
-            limit = days * 24 // int(rtruncate(bar, 1)) + 1
-        elif bar.endswith('D'):
-            limit = days + 1
-        elif bar.endswith('W'):
-            limit = days // 7 + 1
-        elif bar.endswith('M'):
-            limit = days // (30 * int(rtruncate(bar, 1))) + 1
-        else:
-            limit = days // 365 + 1
-        if limit <= 1440:
-            task_list = [self.get_candles(n['instrument'] + '-USDT', days, bar) for n in funding_rate_list]
-        else:
-            task_list = [self.history_candles(n['instrument'] + '-USDT', days, bar) for n in funding_rate_list]
-        gather_result = await asyncio.gather(*task_list)
-        for n in range(len(funding_rate_list)):
-            atr = average_true_range(gather_result[n], days, '4H')
-            funding_rate_list[n]['profitability'] = int(funding_rate_list[n]['funding_rate'] / np.sqrt(atr) * 10000)
+        res = await self.volatilities([n['instrument'] + '-USDT' for n in funding_rate_list], days, '4H')
+        for n, atr in zip(funding_rate_list, res['natr']):
+            n['profitability'] = int(n['funding_rate'] / np.sqrt(atr) * 10000) if atr > 0 else 0
         funding_rate_list.sort(key=lambda x: x['profitability'], reverse=True)
         funding_rate_list = funding_rate_list[:10]
         fprint(coin_funding_value)
@@ -139,8 +208,16 @@ class Stat:
                    f"{n['funding_rate'] * 3 * 365:8.2%}{n['profitability']:8d}")
         return funding_rate_list
 
-    async def historical_volatility(self, instId):
-        pass
+    async def historical_volatility(self, instId, days=7, bar='4H', annualize=True) -> dict:
+        """单个产品最近days天的波动率
+
+        :param instId: 产品ID
+        :param days: 最近几天
+        :param bar: 时间粒度
+        :param annualize: parkinson、garman_klass、close_to_close年化
+        :return: dict(natr, parkinson, garman_klass, close_to_close, count)
+        """
+        return {k: v[0].item() for k, v in (await self.volatilities([instId], days, bar, annualize)).items()}
 
     def open_dist(self, hours=4):
         """开仓期现差价正态分布统计
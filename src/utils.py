@@ -1,4 +1,4 @@
-from typing import List, ContextManager, Optional, Any
+from typing import Dict, List, ContextManager, Optional, Any
 import collections
 import functools
 import inspect
@@ -71,6 +71,148 @@ def round_to(number, divider) -> float:
         return round(number / divider // 1 * divider)
 
 
+def depth_size(spot_levels, swap_levels, target, price_diff, fee=0., contract_val=1., close=False):
+    """Max size whose VWAP premium of swap over spot satisfies `price_diff` after fees
+
+    :param spot_levels: Spot levels to take, best first, [[price, size, ...], ...]
+    :param swap_levels: Swap levels to take, best first, [[price, contracts, ...], ...]
+    :param target: Max size in coin
+    :param price_diff: Min premium to open, max premium to close
+    :param fee: Taker fee of both legs
+    :param contract_val: Contract value
+    :param close: Sell spot and buy swap
+    :return: size, marginal spot price, marginal swap price as in the levels. The marginal prices are those of the
+        last levels taken from, or the best levels when nothing can be taken.
+    """
+    # 开仓 swap_vwap >= k * spot_vwap，平仓 swap_vwap <= k * spot_vwap
+    k = 1 + price_diff - fee if close else 1 + price_diff + fee
+    sign = -1 if close else 1
+    size = spot_cost = swap_cost = 0.
+    spot_price = swap_price = 0.
+    # 已吃到的最差价格，刚取出的下一档吃不到时不计入
+    spot_px = spot_levels[0][0] if spot_levels else ''
+    swap_px = swap_levels[0][0] if swap_levels else ''
+    spot_level = swap_level = ''
+    i = j = 0
+    spot_left = swap_left = 0.
+    while size < target:
+        if not spot_left:
+            if i == len(spot_levels):
+                break
+            spot_level, spot_left = spot_levels[i][0], float(spot_levels[i][1])
+            spot_price = float(spot_level)
+            i += 1
+        if not swap_left:
+            if j == len(swap_levels):
+                break
+            swap_level, swap_left = swap_levels[j][0], float(swap_levels[j][1]) * contract_val
+            swap_price = float(swap_level)
+            j += 1
+        take = min(spot_left, swap_left, target - size)
+        if sign * (swap_price - k * spot_price) < 0:
+            # 本档只能吃掉部分，VWAP溢价恰好等于price_diff
+            take = min(take, (k * spot_cost - swap_cost) / (swap_price - k * spot_price))
+            if take <= 0:
+                break
+            size += take
+            spot_px, swap_px = spot_level, swap_level
+            break
+        size += take
+        spot_px, swap_px = spot_level, swap_level
+        spot_cost += take * spot_price
+        swap_cost += take * swap_price
+        spot_left -= take
+        swap_left -= take
+    return size, spot_px, swap_px
+
+
+class Precision:
+    """现货数量、合约面值和价格的整数精度模型，每个币种初始化一次
+
+    数量以最细的精度为单位换算成整数，取整、换算张数都用整数运算，下单字符串用预先生成的模板输出。
+    """
+    # 吸收浮点表示误差，如10.12 * 100 = 1011.9999999999999
+    epsilon = 1e-6
+
+    def __init__(self, spot_info: dict, swap_info: dict):
+        """
+        :param spot_info: 现货产品信息
+        :param swap_info: 合约产品信息
+        """
+        lot, minimum, contract = spot_info['lotSz'], spot_info['minSz'], swap_info['ctVal']
+        self.decimals = max(num_decimals(n) for n in (lot, minimum, contract))
+        self.scale = 10 ** self.decimals
+        self.lot_units = self.parse(lot)
+        self.min_units = self.parse(minimum)
+        self.ct_units = self.parse(contract)
+        # 现货数量按lotSz的小数位数输出
+        size_decimals = num_decimals(lot)
+        self.size_divider = 10 ** (self.decimals - size_decimals)
+        self.size_scale = 10 ** size_decimals
+        self.size_template = f'{{}}.{{:0{size_decimals}d}}' if size_decimals else '{}'
+        # 价格 {是否现货: (最小变动价格, 模板)}
+        self.ticks = dict()
+        for spot, tick in ((True, spot_info['tickSz']), (False, swap_info['tickSz'])):
+            tick_decimals = num_decimals(tick)
+            tick_scale = 10 ** tick_decimals
+            template = f'{{}}.{{:0{tick_decimals}d}}' if tick_decimals else '{}'
+            self.ticks[spot] = (round(float(tick) * tick_scale), tick_scale, template)
+
+    def parse(self, number: str) -> int:
+        """精确换算产品信息中的数量字符串
+        """
+        integer, _, fraction = number.partition('.')
+        return int(integer + fraction.ljust(self.decimals, '0')) if self.decimals else int(integer)
+
+    def units(self, size: float) -> int:
+        """数量向下取整为整数单位
+        """
+        return int(size * self.scale + self.epsilon)
+
+    def size(self, units: int) -> float:
+        return units / self.scale
+
+    def spot_str(self, units: int) -> str:
+        """按lotSz向下取整后输出现货数量
+        """
+        units -= units % self.lot_units
+        return self.size_template.format(*divmod(units // self.size_divider, self.size_scale))
+
+    def hedge_units(self, size: float) -> int:
+        """按minSz和ctVal向下取整的对冲数量
+        """
+        units = self.units(size)
+        units -= units % self.min_units
+        return units - units % self.ct_units
+
+    def hedge_sizes(self, size: float, fee=0.):
+        """一组对冲的下单数量
+
+        :param size: 可下单数量
+        :param fee: 现货买入扣币的手续费率，为负
+        :return: 整数单位的对冲数量, 现货数量, 合约张数
+        """
+        units = self.hedge_units(size)
+        spot = int(units / (1 + fee) + self.epsilon) if fee else units
+        return units, self.spot_str(spot), str(units // self.ct_units)
+
+    def price_str(self, price: float, spot: bool, up=False) -> str:
+        """价格取整到tickSz后输出
+
+        :param price: 价格
+        :param spot: 现货或合约
+        :param up: 向上取整，默认向下
+        """
+        tick, tick_scale, template = self.ticks[spot]
+        if up:
+            ticks = math.ceil(price * tick_scale - self.epsilon)
+            ticks += -ticks % tick
+        else:
+            ticks = int(price * tick_scale + self.epsilon)
+            ticks -= ticks % tick
+        return template.format(*divmod(ticks, tick_scale))
+
+
 class REST_Semaphore(asyncio.Semaphore):
     """A custom semaphore to be used with REST API with velocity limit under asyncio
     """
@@ -42,6 +42,44 @@ def login_params(timestamp, api_key, passphrase, secret_key):
     return login_str
 
 
+def subscription_messages(op, channels, limit=4096):
+    """Split `channels` into messages of at most `limit` bytes
+
+    :param op: subscribe or unsubscribe
+    :param channels: List of channel args
+    :param limit: Max length of one message
+    """
+    messages = []
+    args = []
+    size = len(json.dumps({"op": op, "args": []}))
+    for channel in channels:
+        length = len(json.dumps(channel)) + 2
+        if args and size + length > limit:
+            messages.append(json.dumps({"op": op, "args": args}))
+            args = []
+            size = len(json.dumps({"op": op, "args": []}))
+        args.append(channel)
+        size += length
+    if args:
+        messages.append(json.dumps({"op": op, "args": args}))
+    return messages
+
+
+def to_quote(res) -> dict:
+    """把tickers、books5或bbo-tbt频道的推送转换为统一的盘口格式
+
+    :param res: 频道推送
+    :return: dict(instId, ts, bids, asks)，bids和asks为[[价格, 数量, ...], ...]，最优价在前
+    """
+    data = res['data'][0]
+    if res['arg']['channel'] == 'tickers':
+        bids = [[data['bidPx'], data['bidSz']]] if data['bidPx'] else []
+        asks = [[data['askPx'], data['askSz']]] if data['askPx'] else []
+        return dict(instId=data['instId'], ts=int(data['ts']), bids=bids, asks=asks)
+    else:
+        return dict(instId=res['arg']['instId'], ts=int(data['ts']), bids=data['bids'], asks=data['asks'])
+
+
 def partial(res):
     data_obj = res['data'][0]
     bids = data_obj['bids']
@@ -171,17 +209,56 @@ def change(num_old):
     return out
 
 
+# 深度频道重新订阅次数和恢复耗时 {(channel, instId): [次数, 总耗时, 最长耗时]}
+resync_stats = dict()
+
+
+def resync_metrics():
+    """各深度频道因序号缺失或校验失败重新订阅的次数和恢复耗时
+
+    :return: {instId channel: dict(resyncs, avg_recovery, max_recovery)}
+    """
+    res = dict()
+    for (channel, instId), (count, total, longest) in resync_stats.items():
+        res[f'{instId} {channel}'] = dict(resyncs=count, avg_recovery=total / count if count else 0.,
+                                          max_recovery=longest)
+    return res
+
+
+def is_incremental(channel: str):
+    """增量推送、需要合并的深度频道
+    """
+    return channel.startswith('books') and channel != 'books5'
+
+
 # subscribe channels un_need login
 async def subscribe_without_login(url, channels, verbose=False):
-    depth_list = []
+    # 深度频道的全量数据 {(channel, instId): dict(bids, asks, seqId)}
+    depths = dict()
+    # 重新订阅中的深度频道及开始时间
+    resyncing = dict()
     while True:
         try:
             async with websockets.connect(url) as ws:
-                sub_param = {"op": "subscribe", "args": channels}
-                sub_str = json.dumps(sub_param)
-                await ws.send(sub_str)
-                if verbose:
-                    fprint(f"send: {sub_str}")
+                depths.clear()
+                resyncing.clear()
+                for sub_str in subscription_messages("subscribe", channels):
+                    await ws.send(sub_str)
+                    if verbose:
+                        fprint(f"send: {sub_str}")
+
+                async def resync(key, reason):
+                    """只在当前连接上重新订阅该深度频道，其他频道照常推送
+                    """
+                    depths.pop(key, None)
+                    if key not in resyncing:
+                        resyncing[key] = time.monotonic()
+                    channel, instId = key
+                    if verbose:
+                        fprint(f"{instId} {channel} {reason}，正在重新订阅……")
+                    arg = dict(channel=channel, instId=instId)
+                    await ws.send(json.dumps({"op": "unsubscribe", "args": [arg]}))
+                    await ws.send(json.dumps({"op": "subscribe", "args": [arg]}))
 
                 while True:
                     try:
@@ -197,62 +274,99 @@ async def subscribe_without_login(url, channels, verbose=False):
                             fprint("连接关闭，正在重连……")
                             break
 
-                    res = eval(res)
-                    if verbose:
-                        fprint(res)
-
-                    if 'event' in res:
+                    if res == 'pong':
                         continue
-                    for i in res['arg']:
-                        if 'books' in res['arg'][i] and 'books5' not in res['arg'][i]:
-                            # 订阅频道是深度频道
+                    # 格式错误的推送只丢弃这一条，所属深度频道重新订阅，其他频道照常推送
+                    key = None
+                    try:
+                        res = json.loads(res)
+                        if verbose:
+                            fprint(res)
+
+                        if 'event' in res:
+                            continue
+                        if is_incremental(channel := res['arg']['channel']):
+                            key = (channel, res['arg']['instId'])
+                            data = res['data'][0]
                             if res['action'] == 'snapshot':
-                                for depth in depth_list:
-                                    if res['arg']['instId'] == depth['instrument_id']:
-                                        depth_list.remove(depth)
                                 # 获取首次全量深度数据
                                 bids_p, asks_p, instrument_id = partial(res)
-                                depth = {'instrument_id': instrument_id, 'bids_p': bids_p, 'asks_p': asks_p}
-                                depth_list.append(depth)
-
-                            elif res['action'] == 'update':
-                                for depth in depth_list:
-                                    if res['arg']['instId'] == depth['instrument_id']:
-                                        # 获取全量数据
-                                        bids_p = depth['bids_p']
-                                        asks_p = depth['asks_p']
-                                        # 获取合并后数据
-                                        bids_p = update_bids(res, bids_p)
-                                        asks_p = update_asks(res, asks_p)
+                                depth = depths[key] = dict(bids=bids_p, asks=asks_p)
+                                if key in resyncing:
+                                    elapsed = time.monotonic() - resyncing.pop(key)
+                                    stats = resync_stats.setdefault(key, [0, 0., 0.])
+                                    stats[0] += 1
+                                    stats[1] += elapsed
+                                    stats[2] = max(stats[2], elapsed)
+                            elif key in resyncing or key not in depths:
+                                # 等待重新订阅后的全量数据
+                                continue
+                            else:
+                                depth = depths[key]
+                                # 序号不连续，有推送丢失
+                                if data.get('prevSeqId', depth['seqId']) != depth['seqId']:
+                                    await resync(key, f"seqId {depth['seqId']} -> {data['prevSeqId']}")
+                                    continue
+                                # 获取合并后数据
+                                depth['bids'] = update_bids(res, depth['bids'])
+                                depth['asks'] = update_asks(res, depth['asks'])
+                            depth['seqId'] = data.get('seqId')
 
                             # 校验checksum
-                            checksum = res['data'][0]['checksum']
-                            # fprint('推送数据的checksum为：' + str(checksum))
-                            check_num = check(bids_p, asks_p)
-                            # fprint('校验后的checksum为：' + str(check_num))
-                            if check_num == checksum:
-                                if verbose:
-                                    fprint("校验结果为：True")
-                            else:
-                                if verbose:
-                                    fprint("校验结果为：False，正在重新订阅……")
-                                # 取消订阅
-                                await unsubscribe_without_login(url, channels)
-                                # 发送订阅
-                                async with websockets.connect(url) as ws:
-                                    sub_param = {"op": "subscribe", "args": channels}
-                                    sub_str = json.dumps(sub_param)
-                                    await ws.send(sub_str)
-                                    if verbose:
-                                        fprint(f"send: {sub_str}")
+                            checksum = data['checksum']
+                            check_num = check(depth['bids'], depth['asks'])
+                            if check_num != checksum:
+                                await resync(key, "checksum")
+                                continue
+                            if verbose:
+                                fprint("校验结果为：True")
+                    except (ValueError, KeyError, IndexError) as e:
+                        fprint(f"推送格式错误，已丢弃：{e!r}")
+                        if key:
+                            await resync(key, "推送格式错误")
+                        continue
 
                     # Generate the latest result
                     yield res
-        except Exception as e:
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+            if verbose:
+                fprint("连接断开，正在重连……")
+            continue
+
+
+async def subscribe_raw(url, channels, verbose=False):
+    """订阅公共频道，不解析、不合并深度，按收到的原始文本推送
+
+    :return: (接收时间ns, 原始推送)
+    """
+    while True:
+        try:
+            # 限制未读取的推送数量，处理不过来时由TCP反压
+            async with websockets.connect(url, max_queue=256) as ws:
+                for sub_str in subscription_messages("subscribe", channels):
+                    await ws.send(sub_str)
+                    if verbose:
+                        fprint(f"send: {sub_str}")
+                while True:
+                    try:
+                        res = await asyncio.wait_for(ws.recv(), timeout=25)
+                    except (asyncio.TimeoutError, websockets.ConnectionClosed) as e:
+                        try:
+                            await ws.send('ping')
+                            await asyncio.wait_for(ws.recv(), timeout=90)
+                            continue
+                        except Exception as e:
+                            fprint("连接关闭，正在重连……")
+                            break
+                    if res == 'pong' or res.startswith('{"event"'):
+                        if verbose:
+                            fprint(res)
+                        continue
+                    yield time.time_ns(), res
+        except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
             if verbose:
                 fprint("连接断开，正在重连……")
             continue
-    await unsubscribe_without_login(url, channels)
 
 
 # subscribe channels need login
@@ -393,15 +507,14 @@ async def unsubscribe(url, api_key, passphrase, secret_key, channels, verbose=Fa
 async def unsubscribe_without_login(url, channels, verbose=False):
     async with websockets.connect(url) as ws:
         # unsubscribe
-        sub_param = {"op": "unsubscribe", "args": channels}
-        sub_str = json.dumps(sub_param)
-        await ws.send(sub_str)
-        if verbose:
-            fprint(f"send: {sub_str}")
+        for sub_str in subscription_messages("unsubscribe", channels):
+            await ws.send(sub_str)
+            if verbose:
+                fprint(f"send: {sub_str}")
 
-        res = await ws.recv()
-        if verbose:
-            fprint(f"recv: {res}")
+            res = await ws.recv()
+            if verbose:
+                fprint(f"recv: {res}")
 
 
 api_key = ''